@@ -1,11 +1,16 @@
 from utils.process_daly_adjustments import DalyDataProcessor
 from utils.process_symptom_prevalence import SymptomPrevalenceDataProcessor
-from utils.estimate_symptom_prevalence_decay import SymptomPrevalenceEstimator
+from utils.estimate_symptom_prevalence_decay import SymptomPrevalenceEstimator, BatchedDecayEstimator
 import utils.parameters as params
-from utils.simulate_long_covid_cases import LongCovidSimulator
+from utils.simulate_long_covid_cases import LongCovidSimulator, DEFAULT_CHUNK_SIZE
 from utils.merge_data_with_simulations import DataSimulationsMerger
+from utils.posterior_store import PosteriorDrawStore
 import utils.plots as plots
+from utils.memory_profiling import StageMemoryProfiler
+from utils.pipeline import Stage, PipelineScheduler
 
+import argparse
+from functools import partial
 import pickle
 import numpy as np
 import logging
@@ -15,98 +20,234 @@ logging.basicConfig(filename='data_processing.log', level=logging.INFO, format='
 
 logging.info('Data processing started.')
 
-def main():
-    # Setup logging
-    logging.basicConfig(filename='data_processing.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-    logging.info('Data processing started.')
-
-    # Process data
+def make_simulator(seed=0, start_date=None, **kwargs):
+    """Simulator with the settings shared by full and sharded runs."""
+    return LongCovidSimulator(
+        params=params.default_params, 
+        years=5, 
+        n_simulations=10, 
+        verbose=False,
+        seed=seed,
+        start_date=start_date,
+        **kwargs
+        )
+
+def run_shard(shard, shard_dir, seed=0, start_date=None):
+    """Run shard 'i/n' of the simulations and write it to shard_dir."""
+    shard_index, n_shards = (int(x) for x in shard.split('/'))
+    lcs = make_simulator(seed=seed, start_date=start_date)
+    shard_path = lcs.run_shard(shard_index, n_shards, shard_dir)
+    logging.info('Wrote simulation shard %s to %s.', shard, shard_path)
+
+def merge_shards(shard_dir, save_path='temp/results.pkl'):
+    """Combine all shards in shard_dir into the results a single-node run would save."""
+    results = LongCovidSimulator.merge_shards(shard_dir)
+    with open(save_path, 'wb') as f:
+        pickle.dump(results, f)
+    logging.info('Merged simulation shards from %s into %s.', shard_dir, save_path)
+
+def process_daly_data():
     ddp = DalyDataProcessor('data/daly.csv')
-    data_daly = ddp.process_data()
+    return ddp.process_data()
 
+def process_symptom_prevalence_data():
     spdp = SymptomPrevalenceDataProcessor('data/prevalence_and_symptoms.csv')
-    data_symptom_prevalence = spdp.process_data(adjustment_method='conservative')
-
-    # Estimation
-    try:
-        spe = SymptomPrevalenceEstimator(data_symptom_prevalence)
-        spe.trace = spe.setup_and_sample_model()
-        df_symptom_integrals = spe.calculate_symptom_integrals()
-
-        if spe.trace is not None:
-            with open('temp/trace.pkl', 'wb') as f:
-                pickle.dump(spe.trace, f)
-        if df_symptom_integrals is not None:
-            with open('temp/df_symptom_integrals.pkl', 'wb') as f:
-                pickle.dump(df_symptom_integrals, f)
-            
-        logging.info('Successfully estimated symptom prevalence decay.')
-    except Exception as e:
-        logging.error('Error processing decay curves: %s', e)
-
-    # Simulation
-    try:
-        comparison_table = params.generate_comparison_table(
-            params.default_params, 
-            params.pessimistic_params, 
-            params.param_descriptions
-            )
-        with open('output/tables/parameters.txt', 'w') as f:
-            # Write headers
-            f.write('\t'.join(comparison_table.columns) + '\n')
-
-            # Write each row
-            for index, row in comparison_table.iterrows():
-                row_str = '\t'.join(str(x) for x in row.values)
-                f.write(row_str + '\n')
-    except:
-        logging.error('Error generating comparison table: %s', e)
-    try:
-        save_path = 'temp/results.pkl'
-        lcs = LongCovidSimulator(
-            params=params.default_params, 
-            years=5, 
-            n_simulations=10, 
-            verbose=False,
-            save_path=save_path
-            )
-        #df_simulation, df_weekly_stats = lcs.run_one_simulation()
-        results = lcs.run_many_simulations()
-        print(results)
-
-        if results is not None:
-            with open(save_path, 'wb') as f:
-                pickle.dump(results, f)
+    return spdp.process_data(adjustment_method='conservative')
 
-        logging.info('Successfully ran simulations.')
-    except:
-        logging.error('Error running simulations: %s', e)
-
-    # Merge DALY and symptom prevalence data with simulation data
+def bootstrap_symptom_prevalence_decay(n_replicates=2000, seed=0):
+    # Sampling uncertainty of the prevalence inputs, from binomial replicates of the counts
+    spdp = SymptomPrevalenceDataProcessor('data/prevalence_and_symptoms.csv')
+    bootstrap = spdp.bootstrap(n_replicates=n_replicates, adjustment_method='conservative', seed=seed)
+    estimator = BatchedDecayEstimator(bootstrap.replicates, bootstrap.months, bootstrap.symptoms).fit()
+    estimator.summary().to_csv('output/tables/bootstrap_decay.csv')
+
+    logging.info('Successfully bootstrapped symptom prevalence decay.')
+
+def estimate_symptom_prevalence_decay(data_symptom_prevalence, adaptive_sampling=False):
+    spe = SymptomPrevalenceEstimator(data_symptom_prevalence)
+    spe.trace = spe.setup_and_sample_model(adaptive=adaptive_sampling)
+    df_symptom_integrals = spe.calculate_symptom_integrals()
+
+    if spe.diagnostics is not None:
+        spe.diagnostics.to_csv('output/tables/sampling_diagnostics.csv', index=False)
+
+    if spe.trace is not None:
+        with open('temp/trace.pkl', 'wb') as f:
+            pickle.dump(spe.trace, f)
+    if df_symptom_integrals is not None:
+        with open('temp/df_symptom_integrals.pkl', 'wb') as f:
+            pickle.dump(df_symptom_integrals, f)
+
+    # Memory-mapped posterior draws for the later stages; only its path is passed between processes
+    posterior = PosteriorDrawStore.from_estimator(spe, df_symptom_integrals).save('temp/posterior_draws')
+
+    logging.info('Successfully estimated symptom prevalence decay.')
+    return spe.trace, df_symptom_integrals, posterior
+
+def write_comparison_table():
+    comparison_table = params.generate_comparison_table(
+        params.default_params, 
+        params.pessimistic_params, 
+        params.param_descriptions
+        )
+    with open('output/tables/parameters.txt', 'w') as f:
+        # Write headers
+        f.write('\t'.join(comparison_table.columns) + '\n')
+
+        # Write each row
+        for index, row in comparison_table.iterrows():
+            row_str = '\t'.join(str(x) for x in row.values)
+            f.write(row_str + '\n')
+
+def run_simulations(seed=0, n_workers=1, n_threads=1, chunk_size=DEFAULT_CHUNK_SIZE, start_date=None):
+    save_path = 'temp/results.pkl'
+    lcs = make_simulator(
+        seed=seed,
+        start_date=start_date,
+        checkpoint_dir='temp/checkpoints',
+        output_dir='temp/simulations',
+        n_threads=n_threads,
+        chunk_size=chunk_size
+        )
+    #df_simulation, df_weekly_stats = lcs.run_one_simulation()
     try:
-        wlc = DataSimulationsMerger(results, df_symptom_integrals, data_daly)
-        df_merged = wlc.calculate_welfare_loss()
-
-        if df_merged is not None:
-            with open('temp/df_merged.pkl', 'wb') as f:
-                pickle.dump(df_merged, f)
-
-        logging.info('Successfully merged data.')
-    except:
-        logging.error('Error merging data: %s', e)
-
-    # Tables and plots
-    plots.plot_daly_adjustments(data_daly) # DALYs per symptom
-    plots.plot_all_symptoms(
-        spe.trace, data_symptom_prevalence['symptom'].unique().tolist(), time_points=np.linspace(0, 18, 100)
-        ) # Symptom prevalence, decay over time
-    plots.plot_symptom_years_histograms(df_symptom_integrals, num_subplots=3) # Symptom prevalence, total years
-    # # Internal simulation outcomes over time
-    plots.plot_daly_loss_over_time(df_merged) # Total welfare loss, over time
+        results = lcs.run_many_simulations(n_workers=n_workers)
+    except BaseException:
+        lcs.release_shared_memory()
+        raise
+    print(results)
+
+    if results is not None:
+        with open(save_path, 'wb') as f:
+            pickle.dump(results, f)
+
+    logging.info('Successfully ran simulations.')
+    # With n_workers > 1 the results are a view on the simulator's shared memory, which
+    # release_simulation_memory frees once the merge is done
+    return results, lcs
+
+def load_simulations(results_path):
+    # Results saved by an earlier run or by --merge-shards; there is no simulator to release
+    with open(results_path, 'rb') as f:
+        results = pickle.load(f)
+    logging.info('Loaded simulation results from %s.', results_path)
+    return results, None
+
+def release_simulation_memory(simulator, df_merged):
+    """Frees the shared memory holding the simulation results; df_merged no longer needs them."""
+    if simulator is not None:
+        simulator.release_shared_memory()
+        logging.info('Released the shared simulation results.')
+
+def merge_data(results, posterior, data_daly, seed=0):
+    wlc = DataSimulationsMerger(results, posterior, data_daly)
+    # Welfare loss per case, and its simulations x weeks x symptoms breakdown, from the same posterior draws
+    df_merged, _, _ = wlc.calculate_welfare_loss_and_attribution(save_path='temp/symptom_attribution.npy', seed=seed)
+
+    if df_merged is not None:
+        with open('temp/df_merged.pkl', 'wb') as f:
+            pickle.dump(df_merged, f)
+
+    logging.info('Successfully merged data.')
+    return df_merged
+
+def make_plots(data_daly, trace, data_symptom_prevalence, df_symptom_integrals, df_merged):
+    # DALYs per symptom; symptom prevalence decay over time; symptom prevalence, total years;
+    # total welfare loss over time. Figures with unchanged inputs are not redrawn.
+    plots.plot_report(
+        data_daly, 
+        trace, 
+        data_symptom_prevalence['symptom'].unique().tolist(), 
+        df_symptom_integrals, 
+        df_merged, 
+        time_points=np.linspace(0, 18, 100)
+        )
+
+def main(seed=0, n_workers=1, n_threads=1, chunk_size=DEFAULT_CHUNK_SIZE, start_date=None, results_path=None, profile_memory=False, memory_budget_mb=None, adaptive_sampling=False, bootstrap_replicates=2000):
+    # Setup logging
+    logging.basicConfig(filename='data_processing.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.info('Data processing started.')
 
-    logging.info('Data processing completed.')
+    # Estimation, DALY processing and simulation are independent and run concurrently; the
+    # simulation, merge and plotting stages stay in this process as they pass large frames
+    # or start their own worker processes.
+    stages = [
+        Stage('process_daly', process_daly_data, outputs=['data_daly']),
+        Stage('process_prevalence', process_symptom_prevalence_data, outputs=['data_symptom_prevalence']),
+        Stage(
+            'estimation', partial(estimate_symptom_prevalence_decay, adaptive_sampling=adaptive_sampling),
+            inputs=['data_symptom_prevalence'], outputs=['trace', 'df_symptom_integrals', 'posterior']
+            ),
+        Stage('comparison_table', write_comparison_table),
+        Stage('bootstrap', partial(bootstrap_symptom_prevalence_decay, n_replicates=bootstrap_replicates, seed=seed)),
+        Stage(
+            'simulation',
+            partial(load_simulations, results_path) if results_path is not None else
+            partial(run_simulations, seed=seed, n_workers=n_workers, n_threads=n_threads, chunk_size=chunk_size, start_date=start_date),
+            outputs=['results', 'simulator'], mode='thread'
+            ),
+        Stage(
+            'merge', partial(merge_data, seed=seed), 
+            inputs=['results', 'posterior', 'data_daly'], outputs=['df_merged'], mode='thread'
+            ),
+        Stage('release_simulation', release_simulation_memory, inputs=['simulator', 'df_merged'], mode='thread'),
+        Stage(
+            'plotting', make_plots, 
+            inputs=['data_daly', 'trace', 'data_symptom_prevalence', 'df_symptom_integrals', 'df_merged'], mode='thread'
+            )
+    ]
+    # The results are dropped once merged, so their shared memory can be freed
+    scheduler = PipelineScheduler(stages, transient=['results'])
+
+    # Memory profiles are only attributable to a stage when stages run one at a time
+    profiler = StageMemoryProfiler(enabled=profile_memory, default_budget_mb=memory_budget_mb, report_path='output/memory_profile.json')
+    values = scheduler.run(serial=profile_memory, stage_context=profiler.stage)
+    for name, value in values.items():
+        profiler.record_output(scheduler.producers[name], name, value)
+    profiler.write_report()
+    if values.get('simulator') is not None:
+        # Frees the shared results if the merge failed or was skipped
+        values['simulator'].release_shared_memory()
+
+    failed = [name for name, status in scheduler.status.items() if status != 'done']
+    if failed:
+        logging.error('Data processing finished with failed or skipped stages: %s', failed)
+    else:
+        logging.info('Data processing completed.')
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Estimate the annual burden of long COVID.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the simulations')
+    parser.add_argument('--workers', type=int, default=1, help='Number of simulation worker processes')
+    parser.add_argument('--start-date', help='First simulated week, e.g. 2024-01-01 (default: today); required with --shard')
+    parser.add_argument('--threads', type=int, default=1, help='Number of threads updating chunks of each simulated population')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Agents per chunk with --threads > 1; at most population size / chunk size threads have work')
+    parser.add_argument('--profile-memory', action='store_true', help='Write a per-stage memory report to output/memory_profile.json')
+    parser.add_argument('--memory-budget-mb', type=float, help='Warn when a stage peaks above this RSS')
+    parser.add_argument('--adaptive-sampling', action='store_true', help='Sample the decay model in blocks until R-hat and ESS targets are met')
+    parser.add_argument('--bootstrap-replicates', type=int, default=2000, help='Binomial bootstrap replicates of the prevalence inputs')
+    parser.add_argument('--shard', help="Only run simulation shard 'i/n' (0-based i) and write it to --shard-dir")
+    parser.add_argument('--merge-shards', action='store_true', help='Combine the shards in --shard-dir into temp/results.pkl')
+    parser.add_argument('--results', help='Use simulation results saved earlier, e.g. temp/results.pkl from --merge-shards, instead of simulating')
+    parser.add_argument('--shard-dir', default='temp/shards', help='Shared directory for simulation shards')
+    args = parser.parse_args()
+
+    if args.shard is not None:
+        run_shard(args.shard, args.shard_dir, seed=args.seed, start_date=args.start_date)
+    elif args.merge_shards:
+        merge_shards(args.shard_dir)
+    else:
+        main(
+            seed=args.seed, 
+            n_workers=args.workers, 
+            n_threads=args.threads,
+            chunk_size=args.chunk_size,
+            start_date=args.start_date,
+            results_path=args.results,
+            profile_memory=args.profile_memory, 
+            memory_budget_mb=args.memory_budget_mb,
+            adaptive_sampling=args.adaptive_sampling,
+            bootstrap_replicates=args.bootstrap_replicates
+            )
 
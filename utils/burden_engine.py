@@ -0,0 +1,146 @@
+import numpy as np
+from scipy.signal import fftconvolve
+
+from utils.merge_data_with_simulations import RuleBasedSeverityModel, daly_weights_by_severity
+
+class BurdenEngine:
+    def __init__(
+            self, 
+            baseline_samples, 
+            decay_rate_samples, 
+            symptoms, 
+            data_daly, 
+            n_draws=100, 
+            normalize=True, 
+            severity_proportions=None, 
+            seed=None
+            ):
+        """
+        Turns weekly long COVID incidence into ongoing symptom prevalence and DALY loss.
+
+        Ongoing prevalence of each symptom is the convolution of the weekly incidence with the
+        posterior decay kernel baseline * exp(-decay_rate * t), computed with FFTs for all
+        simulations, posterior draws and symptoms at once. The cost depends on the number of
+        weeks, not on the number of cases.
+
+        Parameters:
+        baseline_samples (np.ndarray): Posterior draws of baseline, shape (n_samples, n_symptoms).
+        decay_rate_samples (np.ndarray): Posterior draws of decay_rate (per month), same shape.
+        symptoms (list): Symptom names, in column order of the samples.
+        data_daly (pd.DataFrame): Processed DALY data.
+        n_draws (int): Number of posterior draws to use, sampled without replacement.
+        normalize (bool): Divide baselines by their highest posterior draw per symptom, as
+            SymptomPrevalenceEstimator.calculate_symptom_integrals does.
+        severity_proportions (dict): Mild/moderate/severe mix used to weight DALY adjustments;
+            defaults to the base proportions of RuleBasedSeverityModel.
+        seed (int): Seed for the draw selection.
+        """
+        rng = np.random.default_rng(seed)
+        draws = rng.choice(len(baseline_samples), size=min(n_draws, len(baseline_samples)), replace=False)
+
+        # Only the selected draws are copied, so memory-mapped samples stay on disk
+        self.baseline = np.asarray(baseline_samples[draws], dtype=float)
+        if normalize:
+            self.baseline = self.baseline / np.max(baseline_samples, axis=0)
+        self.decay_rate = np.asarray(decay_rate_samples[draws], dtype=float)
+        self.symptoms = list(symptoms)
+
+        severity_proportions = severity_proportions or RuleBasedSeverityModel().base_proportions
+        severity = np.array([severity_proportions[level] for level in ['mild', 'moderate', 'severe']])
+        self.symptom_dalys = daly_weights_by_severity(data_daly, self.symptoms) @ severity
+
+    @classmethod
+    def from_store(cls, store, data_daly, **kwargs):
+        """Builds the engine from the baseline and decay rate draws of a PosteriorDrawStore."""
+        return cls(store.arrays['baseline'], store.arrays['decay_rate'], store.symptoms, data_daly, **kwargs)
+
+    @classmethod
+    def from_estimator(cls, estimator, data_daly, **kwargs):
+        """Builds the engine from a fitted SymptomPrevalenceEstimator."""
+        n_symptoms = estimator.n_symptoms
+        return cls(
+            estimator.trace.posterior['baseline'].values.reshape(-1, n_symptoms),
+            estimator.trace.posterior['decay_rate'].values.reshape(-1, n_symptoms),
+            estimator.data_symptom_prevalence['symptom'].unique().tolist(),
+            data_daly,
+            **kwargs
+        )
+
+    @staticmethod
+    def weekly_incidence(df_simulation, risk_weighted=True):
+        """
+        Counts new long COVID cases per simulation and week.
+
+        Parameters:
+        df_simulation (pd.DataFrame): Simulation output with a 'simulation' column.
+        risk_weighted (bool): Count each case as its long COVID risk, matching the scaling in
+            DataSimulationsMerger.calculate_case_losses.
+
+        Returns:
+        pd.DataFrame: Incidence with simulations as rows and week start dates as columns.
+        """
+        cases = df_simulation['has_long_covid'].astype(float)
+        if risk_weighted:
+            cases = cases * df_simulation['long_covid_risk']
+        if 'weight' in df_simulation:
+            cases = cases * df_simulation['weight']
+        return cases.groupby([df_simulation['simulation'], df_simulation['week_start']]).sum().unstack(fill_value=0)
+
+    def kernel(self, n_weeks):
+        """
+        Decay kernel for each draw and symptom over n_weeks weeks.
+
+        Returns:
+        np.ndarray: Shape (n_draws, n_symptoms, n_weeks).
+        """
+        months = np.arange(n_weeks) * 12 / 52
+        return self.baseline[:, :, None] * np.exp(-self.decay_rate[:, :, None] * months[None, None, :])
+
+    def prevalence(self, incidence, horizon_weeks=None):
+        """
+        Ongoing number of people with each symptom, per simulation, draw, symptom and week.
+
+        Parameters:
+        incidence (np.ndarray): Weekly incidence, shape (n_simulations, n_weeks).
+        horizon_weeks (int): Weeks to follow up; defaults to the simulated weeks. Longer
+            horizons include the tail of cases that arose during the simulation.
+
+        Returns:
+        np.ndarray: Shape (n_simulations, n_draws, n_symptoms, horizon_weeks).
+        """
+        incidence = np.asarray(incidence, dtype=float)
+        horizon_weeks = horizon_weeks or incidence.shape[1]
+        kernel = self.kernel(horizon_weeks)
+        prevalence = fftconvolve(incidence[:, None, None, :], kernel[None, :, :, :], axes=-1)
+        # FFT round-off can leave tiny negative values where incidence is zero
+        return np.clip(prevalence[..., :horizon_weeks], 0, None)
+
+    def daly_loss(self, prevalence, by_symptom=False):
+        """
+        Weekly DALY loss from ongoing prevalence; each week with a symptom costs 1/52 of its DALY adjustment.
+
+        Returns:
+        np.ndarray: Shape (n_simulations, n_draws, horizon_weeks), or with a symptom axis
+        before the weeks if by_symptom.
+        """
+        loss = prevalence * self.symptom_dalys[None, None, :, None] / 52
+        return loss if by_symptom else loss.sum(axis=2)
+
+    def run(self, df_simulation, horizon_weeks=None, risk_weighted=True):
+        """
+        Computes prevalence and DALY-loss curves for simulation output.
+
+        Returns:
+        dict: 'simulation' ids, 'week' index (weeks since start), 'symptom' names,
+        'prevalence' (simulations x draws x symptoms x weeks) and 'daly_loss'
+        (simulations x draws x weeks).
+        """
+        incidence = self.weekly_incidence(df_simulation, risk_weighted=risk_weighted)
+        prevalence = self.prevalence(incidence.to_numpy(), horizon_weeks=horizon_weeks)
+        return {
+            'simulation': incidence.index.to_numpy(),
+            'week': np.arange(prevalence.shape[-1]),
+            'symptom': self.symptoms,
+            'prevalence': prevalence,
+            'daly_loss': self.daly_loss(prevalence)
+        }
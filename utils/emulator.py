@@ -0,0 +1,269 @@
+import concurrent.futures
+import multiprocessing
+
+import numpy as np
+from scipy import linalg, optimize
+from scipy.stats import qmc
+
+from utils.scenario_service import simulate_weekly_totals
+
+class GaussianProcess:
+    def __init__(self, n_restarts=3, seed=None):
+        """
+        Gaussian process regression with an ARD squared-exponential kernel and learned noise.
+
+        Multiple output columns share the kernel hyperparameters, which are fitted by
+        maximising the summed marginal likelihood of the standardised outputs.
+        """
+        self.n_restarts = n_restarts
+        self.rng = np.random.default_rng(seed)
+
+    @staticmethod
+    def _kernel(A, B, lengthscales):
+        scaled_distances = ((A[:, None, :] - B[None, :, :]) / lengthscales) ** 2
+        return np.exp(-0.5 * scaled_distances.sum(axis=2))
+
+    def _negative_log_likelihood(self, log_params, X, Y):
+        lengthscales, noise = np.exp(log_params[:-1]), np.exp(log_params[-1])
+        K = self._kernel(X, X, lengthscales) + (noise + 1e-8) * np.eye(len(X))
+        try:
+            L = linalg.cholesky(K, lower=True)
+        except linalg.LinAlgError:
+            return np.inf
+        alpha = linalg.cho_solve((L, True), Y)
+        return 0.5 * np.sum(Y * alpha) + Y.shape[1] * np.sum(np.log(np.diag(L)))
+
+    def fit(self, X, Y):
+        """
+        Fits the process to inputs X (n, d), scaled to the unit cube, and outputs Y (n, m).
+        """
+        self.X = np.asarray(X, dtype=float)
+        Y = np.asarray(Y, dtype=float).reshape(len(self.X), -1)
+        self.y_mean = Y.mean(axis=0)
+        self.y_std = np.where(Y.std(axis=0) > 0, Y.std(axis=0), 1)
+        Y_standardized = (Y - self.y_mean) / self.y_std
+
+        # Restarts from random lengthscales guard against poor local optima
+        n_dims = self.X.shape[1]
+        best = None
+        for _ in range(self.n_restarts):
+            start = np.append(np.log(self.rng.uniform(0.1, 1, size=n_dims)), np.log(0.1))
+            result = optimize.minimize(
+                self._negative_log_likelihood, start, args=(self.X, Y_standardized), method='L-BFGS-B',
+                bounds=[(np.log(1e-2), np.log(1e2))] * n_dims + [(np.log(1e-6), np.log(1))]
+                )
+            if best is None or result.fun < best.fun:
+                best = result
+
+        self.lengthscales, self.noise = np.exp(best.x[:-1]), np.exp(best.x[-1])
+        K = self._kernel(self.X, self.X, self.lengthscales) + (self.noise + 1e-8) * np.eye(len(self.X))
+        self.L = linalg.cholesky(K, lower=True)
+        self.alpha = linalg.cho_solve((self.L, True), Y_standardized)
+        return self
+
+    def predict(self, X):
+        """
+        Predicts the mean of the simulator output at inputs X.
+
+        Returns:
+        Tuple[np.ndarray, np.ndarray]: Predictive mean and standard deviation, each (n, m).
+        """
+        K_cross = self._kernel(np.asarray(X, dtype=float), self.X, self.lengthscales)
+        mean = K_cross @ self.alpha
+        v = linalg.solve_triangular(self.L, K_cross.T, lower=True)
+        variance = np.clip(1 - np.sum(v ** 2, axis=0), 0, None)
+        return mean * self.y_std + self.y_mean, np.sqrt(variance)[:, None] * self.y_std
+
+
+class DalyLossEmulator:
+    def __init__(
+            self,
+            bounds,
+            df_symptom_integrals,
+            data_daly,
+            years=1,
+            n_simulations=5,
+            fixed_overrides=None,
+            n_workers=1,
+            seed=0
+            ):
+        """
+        Surrogate for the simulator and merger, predicting weekly cases and cumulative DALY loss.
+
+        Trains Gaussian processes on a Latin hypercube design of simulator runs, validates them
+        on held-out runs, and refines them by running the simulator where the cumulative DALY
+        loss prediction is most uncertain.
+
+        Parameters:
+        bounds (dict): Range (low, high) of each varied parameter, e.g. {'infection_rate': (0.0008, 0.0015)}.
+        df_symptom_integrals (pd.DataFrame): Posterior symptom integrals.
+        data_daly (pd.DataFrame): Processed DALY data.
+        years (int): Simulated years per run.
+        n_simulations (int): Simulations averaged per design point.
+        fixed_overrides (dict): Other parameter overrides applied to every run.
+        n_workers (int): Number of simulation worker processes.
+        seed (int): Seed for the design and the simulations.
+        """
+        self.bounds = bounds
+        self.parameter_names = list(bounds)
+        self.lower = np.array([bounds[name][0] for name in self.parameter_names], dtype=float)
+        self.upper = np.array([bounds[name][1] for name in self.parameter_names], dtype=float)
+        self.df_symptom_integrals = df_symptom_integrals
+        self.data_daly = data_daly
+        self.years = years
+        self.n_simulations = n_simulations
+        self.fixed_overrides = fixed_overrides or {}
+        self.n_workers = n_workers
+        self.seed = seed
+        self.sampler = qmc.LatinHypercube(d=len(self.parameter_names), seed=seed)
+        self.n_runs = 0
+
+        self.X = np.empty((0, len(self.parameter_names)))
+        self.weekly_cases = None
+        self.cumulative_daly_loss = np.empty(0)
+        self.cases_model = None
+        self.daly_model = None
+        self.validation = None
+
+    def _to_unit(self, points):
+        return (np.asarray(points, dtype=float) - self.lower) / (self.upper - self.lower)
+
+    def _from_unit(self, unit_points):
+        return self.lower + np.asarray(unit_points) * (self.upper - self.lower)
+
+    def design(self, n_points):
+        """Latin hypercube design of n_points parameter settings."""
+        return self._from_unit(self.sampler.random(n_points))
+
+    def run_simulator(self, points):
+        """
+        Runs the simulator and merger at each parameter setting.
+
+        Every run gets its own seed, so repeated settings give independent replicates.
+
+        Returns:
+        Tuple[np.ndarray, np.ndarray]: Mean weekly cases (n_points, n_weeks) and mean
+        cumulative DALY loss (n_points,) over the simulations at each point.
+        """
+        tasks = []
+        for point in points:
+            overrides = {**self.fixed_overrides, **{name: float(value) for name, value in zip(self.parameter_names, point)}}
+            run_seed = self.seed + 1 + self.n_runs
+            self.n_runs += 1
+            for simulation_id in range(self.n_simulations):
+                tasks.append((overrides, self.years, self.n_simulations, run_seed, simulation_id, self.df_symptom_integrals, self.data_daly))
+
+        if self.n_workers > 1:
+            # Spawned like the pipeline's process pool, as the caller may be running other threads
+            mp_context = multiprocessing.get_context('spawn')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.n_workers, mp_context=mp_context) as executor:
+                weekly_totals = list(executor.map(simulate_weekly_totals, *zip(*tasks)))
+        else:
+            weekly_totals = [simulate_weekly_totals(*task) for task in tasks]
+
+        cases = np.stack([totals['cases'].to_numpy() for totals in weekly_totals]).reshape(len(points), self.n_simulations, -1)
+        daly_loss = np.array([totals['DALY_loss'].sum() for totals in weekly_totals]).reshape(len(points), self.n_simulations)
+        return cases.mean(axis=1), daly_loss.mean(axis=1)
+
+    def _add_runs(self, points, weekly_cases, cumulative_daly_loss):
+        self.X = np.vstack([self.X, points])
+        self.weekly_cases = weekly_cases if self.weekly_cases is None else np.vstack([self.weekly_cases, weekly_cases])
+        self.cumulative_daly_loss = np.append(self.cumulative_daly_loss, cumulative_daly_loss)
+
+    def fit(self):
+        """Refits both surrogates to all simulator runs so far."""
+        X_unit = self._to_unit(self.X)
+        self.cases_model = GaussianProcess(seed=self.seed).fit(X_unit, self.weekly_cases)
+        self.daly_model = GaussianProcess(seed=self.seed).fit(X_unit, self.cumulative_daly_loss)
+        return self
+
+    def predict(self, points):
+        """
+        Predicts simulator output at parameter settings.
+
+        Parameters:
+        points (np.ndarray or dict): Array (n, n_parameters) in bounds order, or a dict of one setting.
+
+        Returns:
+        dict: Mean and standard deviation of weekly cases and of cumulative DALY loss.
+        """
+        if isinstance(points, dict):
+            points = [[points[name] for name in self.parameter_names]]
+        X_unit = self._to_unit(np.atleast_2d(points))
+        cases_mean, cases_sd = self.cases_model.predict(X_unit)
+        daly_mean, daly_sd = self.daly_model.predict(X_unit)
+        return {
+            'weekly_cases_mean': cases_mean,
+            'weekly_cases_sd': cases_sd,
+            'cumulative_daly_loss_mean': daly_mean[:, 0],
+            'cumulative_daly_loss_sd': daly_sd[:, 0]
+        }
+
+    def validate(self, points, weekly_cases, cumulative_daly_loss):
+        """
+        Compares predictions with held-out simulator runs.
+
+        Returns:
+        dict: RMSE, share of runs inside the 95% predictive interval and mean absolute
+        standardised error, for cumulative DALY loss and weekly cases.
+        """
+        prediction = self.predict(points)
+        validation = {}
+        for name, observed, mean, sd in [
+            ('cumulative_daly_loss', cumulative_daly_loss, prediction['cumulative_daly_loss_mean'], prediction['cumulative_daly_loss_sd']),
+            ('weekly_cases', weekly_cases, prediction['weekly_cases_mean'], prediction['weekly_cases_sd'])
+        ]:
+            # The simulator is noisy, so include the fitted noise in the interval
+            model = self.daly_model if name == 'cumulative_daly_loss' else self.cases_model
+            total_sd = np.sqrt(sd ** 2 + model.noise * model.y_std ** 2)
+            errors = np.asarray(observed) - mean
+            validation[name] = {
+                'rmse': float(np.sqrt(np.mean(errors ** 2))),
+                'coverage_95': float(np.mean(np.abs(errors) <= 1.96 * total_sd)),
+                'mean_abs_standardized_error': float(np.mean(np.abs(errors) / total_sd))
+            }
+        self.validation = validation
+        return validation
+
+    def train(self, n_points=20, n_holdout=5):
+        """
+        Runs the initial design, fits the surrogates and validates them on held-out runs.
+
+        Returns:
+        dict: Validation results, see validate().
+        """
+        points = self.design(n_points)
+        self._add_runs(points, *self.run_simulator(points))
+        self.fit()
+
+        holdout_points = self.design(n_holdout)
+        return self.validate(holdout_points, *self.run_simulator(holdout_points))
+
+    def refine(self, n_points=5, n_candidates=1000):
+        """
+        Adds simulator runs where cumulative DALY loss is most uncertain, then refits.
+
+        Points are chosen one at a time among Latin hypercube candidates; each chosen point is
+        provisionally added with its predicted value so the next pick moves elsewhere.
+
+        Returns:
+        np.ndarray: The parameter settings that were run.
+        """
+        candidates = self.design(n_candidates)
+        X_fit, y_fit = self._to_unit(self.X), self.cumulative_daly_loss.copy()
+        model = self.daly_model
+        chosen = []
+        for _ in range(n_points):
+            _, sd = model.predict(self._to_unit(candidates))
+            best = int(np.argmax(sd[:, 0]))
+            chosen.append(candidates[best])
+            mean, _ = model.predict(self._to_unit(candidates[best:best + 1]))
+            X_fit = np.vstack([X_fit, self._to_unit(candidates[best:best + 1])])
+            y_fit = np.append(y_fit, mean[:, 0])
+            candidates = np.delete(candidates, best, axis=0)
+            model = GaussianProcess(seed=self.seed).fit(X_fit, y_fit)
+
+        chosen = np.array(chosen)
+        self._add_runs(chosen, *self.run_simulator(chosen))
+        self.fit()
+        return chosen
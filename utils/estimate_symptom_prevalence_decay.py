@@ -1,4 +1,6 @@
 import pymc as pm
+from pymc.initial_point import make_initial_point_fn
+import arviz as az
 import pandas as pd
 import numpy as np
 from scipy.integrate import quad
@@ -19,10 +21,13 @@ class SymptomPrevalenceEstimator:
             non_centered=False):
         self.data_symptom_prevalence = data_symptom_prevalence
         self.n_symptoms = len(data_symptom_prevalence['symptom'].unique())
-        self.hyperparameters = hyperparameters
+        self.hyperparameters = dict(hyperparameters)
         self.non_centered = non_centered
         self.model = None
         self.trace = None
+        self.diagnostics = None
+        self._nuts_steps = {}
+        self._initial_point_fns = None
 
     @staticmethod
     def _calculate_gamma_params(mean, variance):
@@ -31,18 +36,30 @@ class SymptomPrevalenceEstimator:
         return alpha, theta
 
     def setup_model(self, time, prevalence, symptom_idx, hyperparameters):
-        # Set up hyperparameters
-        baseline_alpha_alpha, baseline_alpha_theta = self._calculate_gamma_params(
-            hyperparameters['baseline_alpha_hyperprior_mean'], hyperparameters['baseline_alpha_hyperprior_var']
-            )
-        baseline_beta_alpha, baseline_beta_theta = self._calculate_gamma_params(
-            hyperparameters['baseline_beta_hyperprior_mean'], hyperparameters['baseline_beta_hyperprior_var']
-            )
-        decayrate_alpha_alpha, decayrate_alpha_theta = self._calculate_gamma_params(
-            hyperparameters['decayrate_mean_hyperprior_mean'], hyperparameters['decayrate_mean_hyperprior_var']
-            )
-        
+        """
+        Builds the model, with the data and hyperparameters held in mutable data containers.
+
+        Refits with new data or hyperparameters update the containers (see set_data and
+        set_hyperparameters) instead of building and compiling a new model.
+        """
         with pm.Model() as self.model:
+            # Hyperparameters, as data so they can change without rebuilding the model
+            hyperparameter_data = {name: pm.Data(name, float(value)) for name, value in hyperparameters.items()}
+
+            time = pm.Data('time', time)
+            prevalence = pm.Data('prevalence', prevalence)
+            symptom_idx = pm.Data('symptom_idx', symptom_idx)
+
+            baseline_alpha_alpha, baseline_alpha_theta = self._calculate_gamma_params(
+                hyperparameter_data['baseline_alpha_hyperprior_mean'], hyperparameter_data['baseline_alpha_hyperprior_var']
+                )
+            baseline_beta_alpha, baseline_beta_theta = self._calculate_gamma_params(
+                hyperparameter_data['baseline_beta_hyperprior_mean'], hyperparameter_data['baseline_beta_hyperprior_var']
+                )
+            decayrate_alpha_alpha, decayrate_alpha_theta = self._calculate_gamma_params(
+                hyperparameter_data['decayrate_mean_hyperprior_mean'], hyperparameter_data['decayrate_mean_hyperprior_var']
+                )
+
             # Set up priors and hyperpriors
             if self.non_centered == True:
                 # Non-centered priors for baseline parameters
@@ -67,33 +84,202 @@ class SymptomPrevalenceEstimator:
                 decay_rate_alpha = pm.Gamma('decay_rate_alpha', alpha=decayrate_alpha_alpha, beta=1/decayrate_alpha_theta, shape=self.n_symptoms)
 
             baseline = pm.Beta('baseline', alpha=baseline_alpha, beta=baseline_beta, shape=self.n_symptoms)
-            decay_rate = pm.Gamma('decay_rate', alpha=decay_rate_alpha, beta=1/hyperparameters['decayrate_prior_var'], shape=self.n_symptoms)
+            decay_rate = pm.Gamma('decay_rate', alpha=decay_rate_alpha, beta=1/hyperparameter_data['decayrate_prior_var'], shape=self.n_symptoms)
 
             # Model for prevalence and Likelihood of observations
             prevalence_est = baseline[symptom_idx] * pm.math.exp(-decay_rate[symptom_idx] * time)
-            Y_obs = pm.Normal('Y_obs', mu=prevalence_est, sigma=0.01, observed=prevalence)
+            Y_obs = pm.Normal('Y_obs', mu=prevalence_est, sigma=0.01, observed=prevalence, shape=time.shape)
+
+        self._nuts_steps = {}
+        self._initial_point_fns = None
+        return self.model
+
+    def _model_data(self):
+        """Model inputs from data_symptom_prevalence; missing prevalences are left out."""
+        time, prevalence, symptom_idx = self.prepare_data(self.data_symptom_prevalence)
+        observed = ~np.isnan(prevalence)
+        return {'time': time[observed], 'prevalence': prevalence[observed], 'symptom_idx': symptom_idx[observed]}
+
+    def build_model(self):
+        """Builds the model on first use; later calls return the existing model."""
+        if self.model is None:
+            data = self._model_data()
+            self.setup_model(data['time'], data['prevalence'], data['symptom_idx'], self.hyperparameters)
+        return self.model
+
+    def set_data(self, data_symptom_prevalence):
+        """
+        Replaces the prevalence data. The compiled model is kept unless the number of symptoms changes.
+        """
+        self.data_symptom_prevalence = data_symptom_prevalence
+        n_symptoms = len(data_symptom_prevalence['symptom'].unique())
+        if self.model is not None and n_symptoms == self.n_symptoms:
+            pm.set_data(self._model_data(), model=self.model)
+        else:
+            self.n_symptoms = n_symptoms
+            self.model = None
+        self.trace = None
+
+    def set_hyperparameters(self, hyperparameters):
+        """Updates some or all hyperparameters, keeping the compiled model."""
+        self.hyperparameters.update(hyperparameters)
+        if self.model is not None:
+            pm.set_data({name: float(value) for name, value in hyperparameters.items()}, model=self.model)
+        self.trace = None
+
+    def _nuts_step(self, target_accept):
+        """
+        NUTS step for the model, compiled once per target_accept and reused by every later fit.
+
+        The compiled log density and gradient read the data containers when called, so they
+        stay valid after set_data and set_hyperparameters; tuning is reset by each pm.sample call.
+        """
+        if target_accept not in self._nuts_steps:
+            with self.build_model():
+                self._nuts_steps[target_accept] = pm.NUTS(target_accept=target_accept)
+        return self._nuts_steps[target_accept]
+
+    def _initial_point_functions(self):
+        """
+        Compiled jittered initial point (constrained and transformed) and log density functions.
+
+        Like the NUTS steps, they read the data containers when called, so they are compiled
+        once per model and reused by every later fit.
+        """
+        if self._initial_point_fns is None:
+            model = self.build_model()
+            jitter_rvs = set(model.free_RVs)
+            self._initial_point_fns = (
+                make_initial_point_fn(model=model, jitter_rvs=jitter_rvs, return_transformed=False),
+                make_initial_point_fn(model=model, jitter_rvs=jitter_rvs, return_transformed=True),
+                model.compile_logp()
+            )
+        return self._initial_point_fns
+
+    def _jittered_initvals(self, chains, rng, max_retries=10):
+        """
+        One jittered starting point per chain, as pm.sample's default 'jitter+adapt_diag' init.
+
+        pm.sample does not jitter when given a step, so without these every chain would start
+        from the same point, which makes R-hat less able to detect non-convergence. Points are
+        redrawn, up to max_retries times, until the model's log density is finite at them.
+        """
+        constrained_point, transformed_point, logp = self._initial_point_functions()
+
+        initvals = []
+        for chain in range(chains):
+            for _ in range(max_retries + 1):
+                seed = int(rng.integers(2 ** 30))
+                if np.isfinite(logp(transformed_point(seed))):
+                    break
+            initvals.append(constrained_point(seed))
+        return initvals
+
+    def sample_model(self, draws=1000, tune=500, chains=4, target_accept=0.99, random_seed=None):
+        rng = np.random.default_rng(random_seed)
+        with self.build_model():
+            self.trace = pm.sample(
+                draws, tune=tune, chains=chains, step=self._nuts_step(target_accept),
+                initvals=self._jittered_initvals(chains, rng), random_seed=int(rng.integers(2 ** 31))
+                )
+
+        return self.trace
+
+    def _convergence_diagnostics(self, trace, var_names):
+        """Worst-case R-hat and bulk/tail ESS over all elements of var_names."""
+        rhat = az.rhat(trace, var_names=var_names)
+        ess_bulk = az.ess(trace, var_names=var_names, method='bulk')
+        ess_tail = az.ess(trace, var_names=var_names, method='tail')
+        return {
+            'max_rhat': float(max(rhat[var].max() for var in var_names)),
+            'min_ess_bulk': float(min(ess_bulk[var].min() for var in var_names)),
+            'min_ess_tail': float(min(ess_tail[var].min() for var in var_names))
+        }
+
+    def sample_model_adaptive(
+            self, 
+            block_draws=250, 
+            tune=500, 
+            block_tune=100,
+            chains=4, 
+            target_accept=0.99,
+            target_rhat=1.01, 
+            target_ess_bulk=400, 
+            target_ess_tail=400, 
+            max_draws=5000,
+            var_names=('baseline', 'decay_rate'),
+            random_seed=None
+            ):
+        """
+        Samples in blocks until the convergence targets are met.
+
+        After each block of `block_draws` draws per chain, R-hat and bulk/tail ESS of
+        `var_names` are computed on all draws so far; sampling stops once every target is met
+        or `max_draws` draws per chain are reached. Each further block continues every chain
+        from its last draw with a short re-tuning phase of `block_tune` steps.
+
+        Returns:
+        InferenceData: The combined trace. Per-block diagnostics are stored in self.diagnostics.
+        """
+        var_names = list(var_names)
+        rng = np.random.default_rng(random_seed)
+        free_variables = [rv.name for rv in self.build_model().free_RVs]
+        step = self._nuts_step(target_accept)
+        trace = None
+        diagnostics = []
 
-    def sample_model(self, draws=1000, tune=500, chains=4, target_accept=0.99):
         with self.model:
-            self.trace = pm.sample(draws, tune=tune, chains=chains, target_accept=target_accept)
+            while trace is None or trace.posterior.sizes['draw'] < max_draws:
+                if trace is None:
+                    initvals, block_tune_steps = self._jittered_initvals(chains, rng), tune
+                else:
+                    last_draw = trace.posterior.isel(draw=-1)
+                    initvals = [
+                        {name: last_draw[name].isel(chain=chain).values for name in free_variables}
+                        for chain in range(chains)
+                    ]
+                    block_tune_steps = block_tune
 
+                block = pm.sample(
+                    block_draws, tune=block_tune_steps, chains=chains, step=step,
+                    initvals=initvals, random_seed=int(rng.integers(2 ** 31)), progressbar=False
+                    )
+                trace = block if trace is None else az.concat(trace, block, dim='draw')
+
+                block_diagnostics = self._convergence_diagnostics(trace, var_names)
+                block_diagnostics['draws'] = trace.posterior.sizes['draw']
+                diagnostics.append(block_diagnostics)
+
+                if (block_diagnostics['max_rhat'] <= target_rhat 
+                    and block_diagnostics['min_ess_bulk'] >= target_ess_bulk 
+                    and block_diagnostics['min_ess_tail'] >= target_ess_tail):
+                    break
+
+        self.diagnostics = pd.DataFrame(diagnostics)
+        self.diagnostics['converged'] = (
+            (self.diagnostics['max_rhat'] <= target_rhat) 
+            & (self.diagnostics['min_ess_bulk'] >= target_ess_bulk) 
+            & (self.diagnostics['min_ess_tail'] >= target_ess_tail)
+        )
+        self.trace = trace
         return self.trace
         
     @staticmethod
     def prepare_data(df):
         # Reshape data and convert to proportions
         melted_df = df.melt(id_vars=['symptom'], var_name='time', value_name='prevalence')
-        melted_df['time'] = melted_df['time'].replace({'prevalence_diff_6m': 6, 'prevalence_diff_12m': 12, 'prevalence_diff_18m': 18})
+        melted_df['time'] = melted_df['time'].str.extract(r'prevalence_diff_(\d+)m', expand=False).astype(int)
         melted_df['prevalence'] = pd.to_numeric(melted_df['prevalence'], errors='coerce')
         melted_df['prevalence'] /= 100  # Convert to proportion
         symptom_idx = pd.Categorical(melted_df['symptom']).codes
         return melted_df['time'].values, melted_df['prevalence'].values, symptom_idx
 
-    def setup_and_sample_model(self):
-        time, prevalence, symptom_idx = self.prepare_data(self.data_symptom_prevalence)
-        with pm.Model() as self.model:
-            self.setup_model(time, prevalence, symptom_idx, self.hyperparameters)
-            self.trace = self.sample_model()
+    def setup_and_sample_model(self, adaptive=False, **sampling_kwargs):
+        self.build_model()
+        if adaptive:
+            self.trace = self.sample_model_adaptive(**sampling_kwargs)
+        else:
+            self.trace = self.sample_model(**sampling_kwargs)
         
         return self.trace
 
@@ -130,3 +316,88 @@ class SymptomPrevalenceEstimator:
         return baseline * np.exp(-decay_rate * t)
     
 
+
+
+class BatchedDecayEstimator:
+    def __init__(self, prevalence, months, symptoms, decay_rate_grid=None, batch_size=256):
+        """
+        Fits the decay model baseline * exp(-decay_rate * t) to many prevalence replicates at once.
+
+        Each replicate and symptom is fitted by maximum likelihood under the Normal likelihood
+        of SymptomPrevalenceEstimator, without its priors. For a given decay rate the best
+        baseline has a closed form, so the likelihood is profiled over a grid of decay rates
+        for all replicates and symptoms with a few array operations, instead of sampling one
+        model per replicate.
+
+        Parameters:
+        prevalence (np.ndarray): Prevalence differences in percent, (n_replicates, n_symptoms,
+            n_months), NaN where missing, e.g. SymptomPrevalenceBootstrap.replicates.
+        months (list): Time point of each month column.
+        symptoms (list): Symptom names.
+        decay_rate_grid (np.ndarray): Candidate decay rates per month.
+        batch_size (int): Replicates processed at a time, which bounds memory use.
+        """
+        self.prevalence = np.asarray(prevalence, dtype=float) / 100  # Convert to proportion
+        self.months = np.asarray(months, dtype=float)
+        self.symptoms = list(symptoms)
+        self.decay_rate_grid = np.geomspace(1e-3, 5, 500) if decay_rate_grid is None else np.asarray(decay_rate_grid)
+        self.batch_size = batch_size
+        self.baseline = None
+        self.decay_rate = None
+
+    def fit(self):
+        """
+        Estimates baseline and decay rate for every replicate and symptom.
+
+        Returns:
+        BatchedDecayEstimator: self, with baseline and decay_rate arrays (n_replicates, n_symptoms).
+        """
+        observed = ~np.isnan(self.prevalence[0])  # (n_symptoms, n_months); the same in every replicate
+        decay = np.exp(-np.outer(self.decay_rate_grid, self.months))  # (n_rates, n_months)
+        decay_norm = np.einsum('sm,km->sk', observed, decay ** 2)
+
+        n_replicates = len(self.prevalence)
+        self.baseline = np.full((n_replicates, len(self.symptoms)), np.nan)
+        self.decay_rate = np.full((n_replicates, len(self.symptoms)), np.nan)
+        for start in range(0, n_replicates, self.batch_size):
+            batch = np.nan_to_num(self.prevalence[start:start + self.batch_size])
+            projection = np.einsum('rsm,km->rsk', batch, decay)
+
+            # Least squares baseline for each candidate rate, kept within (0, 1) as in the Beta prior
+            with np.errstate(divide='ignore', invalid='ignore'):
+                baseline = np.clip(projection / decay_norm, 0, 1)
+            residual = baseline ** 2 * decay_norm - 2 * baseline * projection  # Squared error up to a constant
+            best = np.argmin(np.where(np.isnan(residual), np.inf, residual), axis=2)
+
+            self.baseline[start:start + self.batch_size] = np.take_along_axis(baseline, best[..., None], axis=2)[..., 0]
+            self.decay_rate[start:start + self.batch_size] = self.decay_rate_grid[best]
+
+        # Symptoms without observations have no estimate
+        self.baseline[:, ~observed.any(axis=1)] = np.nan
+        self.decay_rate[:, ~observed.any(axis=1)] = np.nan
+        return self
+
+    def calculate_symptom_integrals(self, max_time=18):
+        """
+        Annualised integrals of the normalised decay curves, as in
+        SymptomPrevalenceEstimator.calculate_symptom_integrals, with one row per replicate.
+        """
+        if self.baseline is None:
+            self.fit()
+        baseline = self.baseline / np.nanmax(self.baseline, axis=0)
+        integrals = baseline * -np.expm1(-self.decay_rate * max_time) / self.decay_rate / 12
+        return pd.DataFrame(integrals, columns=self.symptoms)
+
+    def summary(self, quantiles=(0.05, 0.5, 0.95), max_time=18):
+        """
+        Bootstrap quantiles of baseline, decay rate and symptom integral per symptom.
+
+        Returns:
+        pd.DataFrame: One row per symptom, one column per quantity and quantile.
+        """
+        integrals = self.calculate_symptom_integrals(max_time=max_time).to_numpy()
+        columns = {}
+        for name, values in [('baseline', self.baseline), ('decay_rate', self.decay_rate), ('integral', integrals)]:
+            for q, value in zip(quantiles, np.nanquantile(values, quantiles, axis=0)):
+                columns[f'{name}_q{q:g}'] = value
+        return pd.DataFrame(columns, index=pd.Index(self.symptoms, name='symptom'))
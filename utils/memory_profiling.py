@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+class StageMemoryProfiler:
+    def __init__(self, enabled=False, budgets_mb=None, default_budget_mb=None, top_n=10, report_path=None, sample_interval=0.5):
+        """
+        Records memory use of each pipeline stage.
+
+        For every stage it records peak RSS, the top tracemalloc allocation sites and the size
+        of every DataFrame or array handed to the next stage, and logs a warning when a stage's
+        RSS goes over its budget. RSS is sampled on a background thread while a stage runs, and
+        the report is rewritten when each stage starts and ends, so a stage that is killed for
+        running out of memory still leaves its warning and a report naming it as running.
+        When disabled, stage() and record_output() do nothing.
+
+        Parameters:
+        enabled (bool): Whether to profile.
+        budgets_mb (dict): Peak RSS budget per stage name, in MB.
+        default_budget_mb (float): Budget for stages without their own entry.
+        top_n (int): Number of tracemalloc allocation sites to keep per stage.
+        report_path (str): JSON report rewritten as stages start and end; None to only write
+            it with write_report.
+        sample_interval (float): Seconds between RSS samples while a stage runs.
+        """
+        self.enabled = enabled
+        self.budgets_mb = budgets_mb or {}
+        self.default_budget_mb = default_budget_mb
+        self.top_n = top_n
+        self.report_path = report_path
+        self.sample_interval = sample_interval
+        self.stages = {}
+
+    @staticmethod
+    def _reset_peak_rss():
+        """
+        Resets the kernel's peak RSS counter so the next reading covers one stage only.
+
+        Returns:
+        bool: Whether the reset is supported (Linux only).
+        """
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _peak_rss_mb():
+        """Peak RSS since the last reset (Linux), else since process start."""
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss / 1024 ** 2 if max_rss > 1024 ** 3 else max_rss / 1024
+
+    @staticmethod
+    def _current_rss_mb():
+        """Current RSS (Linux), else the peak RSS since process start."""
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return StageMemoryProfiler._peak_rss_mb()
+
+    def _sample_rss(self, name, record, stop):
+        """Tracks a running stage's RSS and warns as soon as it goes over the stage's budget."""
+        budget_mb = self.budgets_mb.get(name, self.default_budget_mb)
+        warned = False
+        while not stop.wait(self.sample_interval):
+            rss_mb = self._current_rss_mb()
+            record['sampled_peak_rss_mb'] = max(record.get('sampled_peak_rss_mb', 0), rss_mb)
+            if not warned and budget_mb is not None and rss_mb > budget_mb:
+                logging.warning('Stage %s is at %.0f MB RSS, over its %.0f MB budget.', name, rss_mb, budget_mb)
+                self._write_progress()
+                warned = True
+
+    def _write_progress(self):
+        if self.report_path is not None:
+            self.write_report(self.report_path)
+
+    @contextmanager
+    def stage(self, name):
+        """Profiles the enclosed block as stage `name`. Exceptions propagate unchanged."""
+        if not self.enabled:
+            yield
+            return
+
+        logging.info('Stage %s started.', name)
+        record = self.stages.setdefault(name, {'outputs': {}})
+        record['status'] = 'running'
+        self._write_progress()
+        stop_sampling = threading.Event()
+        sampler = threading.Thread(target=self._sample_rss, args=(name, record, stop_sampling), daemon=True)
+        sampler.start()
+
+        per_stage_peak = self._reset_peak_rss()
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.clear_traces()
+        start = time.perf_counter()
+        status = 'failed'
+        try:
+            yield
+            status = 'done'
+        finally:
+            stop_sampling.set()
+            sampler.join()
+            snapshot = tracemalloc.take_snapshot()
+            traced_current, traced_peak = tracemalloc.get_traced_memory()
+            if started_tracing:
+                tracemalloc.stop()
+
+            record.update({
+                'status': status,
+                'seconds': time.perf_counter() - start,
+                'peak_rss_mb': self._peak_rss_mb(),
+                'peak_rss_is_per_stage': per_stage_peak,
+                'traced_peak_mb': traced_peak / 1024 ** 2,
+                'top_allocations': [
+                    {'site': str(stat.traceback), 'size_mb': stat.size / 1024 ** 2, 'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:self.top_n]
+                ]
+            })
+            self._check_budget(name, record['peak_rss_mb'])
+            logging.info('Stage %s %s after %.1f s, peak RSS %.0f MB.', name, status, record['seconds'], record['peak_rss_mb'])
+            self._write_progress()
+
+    def _check_budget(self, name, peak_rss_mb):
+        budget_mb = self.budgets_mb.get(name, self.default_budget_mb)
+        if budget_mb is not None and peak_rss_mb > budget_mb:
+            logging.warning('Stage %s peaked at %.0f MB RSS, over its %.0f MB budget.', name, peak_rss_mb, budget_mb)
+
+    def record_output(self, stage, name, obj):
+        """Records the in-memory size of an object passed from `stage` to later stages."""
+        if not self.enabled or obj is None:
+            return
+        if isinstance(obj, pd.DataFrame):
+            size = obj.memory_usage(index=True, deep=True).sum()
+            shape = list(obj.shape)
+        elif isinstance(obj, np.ndarray):
+            size = obj.nbytes
+            shape = list(obj.shape)
+        else:
+            return
+        record = self.stages.setdefault(stage, {'outputs': {}})
+        record['outputs'][name] = {'type': type(obj).__name__, 'shape': shape, 'size_mb': size / 1024 ** 2}
+
+    def write_report(self, path=None):
+        """Writes all stage records to `path`, by default report_path, as JSON."""
+        path = path if path is not None else self.report_path
+        if not self.enabled or path is None:
+            return
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.stages, f, indent=2, default=float)
+        os.replace(f'{path}.tmp', path)
+        logging.info('Wrote memory profile to %s.', path)
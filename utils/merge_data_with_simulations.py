@@ -1,47 +1,374 @@
 import pandas as pd
+import numpy as np
+import glob
+import json
+import os
+
+import utils.parameters as params
+from utils.posterior_store import PosteriorDrawStore
+from utils.result_writer import SimulationResultWriter
+from utils.simulate_long_covid_cases import LongCovidSimulator
+
+
+def _iter_week_blocks(path, max_memory_bytes=None):
+    """
+    Reads one SimulationResultWriter partition in blocks of whole weeks.
+
+    Only the 'week_start' column is read to find the block boundaries; each block's rows
+    are then read from the memory-mapped column files. Rows are in week order, as the
+    simulations write them. Block sizes come from the deep in-memory size per row of the
+    first week, so string columns are counted as the Python objects they become.
+    """
+    columns, n_rows = SimulationResultWriter.partition_columns(path)
+    if max_memory_bytes is None or n_rows == 0:
+        yield SimulationResultWriter.read_partition(path)
+        return
+
+    week_start = SimulationResultWriter.read_partition(path, columns=['week_start'])['week_start'].to_numpy()
+    week_bounds = np.append(np.flatnonzero(week_start[1:] != week_start[:-1]) + 1, n_rows)
+    first_week = SimulationResultWriter.read_partition(path, rows=slice(0, week_bounds[0]))
+    bytes_per_row = first_week.memory_usage(index=True, deep=True).sum() / len(first_week)
+    max_rows = max(1, int(max_memory_bytes // bytes_per_row))
+    del first_week
+
+    block_start = 0
+    for i, week_end in enumerate(week_bounds):
+        next_end = week_bounds[i + 1] if i + 1 < len(week_bounds) else None
+        # Close the block when the next week would take it over the ceiling; single weeks over it are kept whole
+        if next_end is None or next_end - block_start > max_rows:
+            yield SimulationResultWriter.read_partition(path, rows=slice(block_start, week_end))
+            block_start = week_end
+
+
+def iter_simulation_partitions(source, max_memory_mb=None):
+    """
+    Yields simulation output one simulation, or one block of weeks of a simulation, at a time.
+
+    Parameters:
+    source (pd.DataFrame or str): Combined simulation output with a 'simulation' column, or a
+        directory of SimulationResultWriter partitions or of shards written by run_shard.
+    max_memory_mb (float): Largest in-memory size of a yielded block when reading from a
+        directory; simulations are then read in blocks of whole weeks. Whole simulations if None.
+
+    Yields:
+    pd.DataFrame: Output of a single simulation or a block of its weeks, with a 'simulation' column.
+    """
+    if isinstance(source, pd.DataFrame):
+        for _, partition in source.groupby('simulation', sort=True):
+            yield partition
+        return
+
+    max_memory_bytes = max_memory_mb * 1024 ** 2 if max_memory_mb is not None else None
+    partition_paths = list(SimulationResultWriter.partition_paths(source).items())
+    for shard_path in LongCovidSimulator.shard_paths(source):
+        partition_paths += SimulationResultWriter.partition_paths(shard_path).items()
+
+    for simulation, path in partition_paths:
+        for block in _iter_week_blocks(path, max_memory_bytes):
+            block['simulation'] = simulation
+            yield block
+
+def daly_weights_by_severity(data_daly, symptoms):
+    """
+    Sums DALY adjustments per symptom and severity level.
+
+    Parameters:
+    data_daly (pd.DataFrame): Processed DALY data.
+    symptoms (array-like): Symptoms to include, in output order.
+
+    Returns:
+    np.ndarray: Matrix of shape (n_symptoms, 3) for mild, moderate and severe.
+    """
+    severity_columns = ['mild', 'moderate', 'severe']
+    weights = np.zeros((len(symptoms), len(severity_columns)))
+    for i, symptom in enumerate(symptoms):
+        daly_adjustments = data_daly[data_daly['symptom'] == symptom]
+        weights[i] = daly_adjustments[severity_columns].mul(daly_adjustments['daly_adjustment'], axis=0).sum(axis=0).values
+    return weights
+
+
+class RuleBasedSeverityModel:
+    """
+    Default severity model: shifts cases from mild towards moderate and severe with each
+    prior infection, and back towards mild with each vaccination and later strain.
+
+    The defaults are params.default_severity_params, which keep every case mild;
+    params.illustrative_severity_params has unsourced example coefficients.
+
+    Any callable with the same signature can be passed to DataSimulationsMerger instead.
+    """
+    def __init__(
+            self,
+            base_proportions=params.default_severity_params['base_proportions'],
+            reinfection_factor=params.default_severity_params['reinfection_factor'],
+            vaccination_factor=params.default_severity_params['vaccination_factor'],
+            strain_factor=params.default_severity_params['strain_factor']
+            ):
+        self.base_proportions = base_proportions
+        self.reinfection_factor = reinfection_factor
+        self.vaccination_factor = vaccination_factor
+        self.strain_factor = strain_factor
+
+    def __call__(self, infection_count, vaccination_count, strain, risk):
+        """
+        Calculates severity proportions for a batch of cases.
+
+        Parameters:
+        infection_count (np.ndarray): Number of COVID infections, including the current one.
+        vaccination_count (np.ndarray): Number of vaccinations received.
+        strain (np.ndarray): Strain of the current infection.
+        risk (np.ndarray): Long COVID risk of the current infection (not used by this model).
+
+        Returns:
+        np.ndarray: Matrix of shape (n_cases, 3) with mild, moderate and severe proportions.
+        """
+        prior_infections = np.clip(np.asarray(infection_count, dtype=float) - 1, 0, None)
+        later_strains = np.clip(np.asarray(strain, dtype=float) - 1, 0, None)
+        multiplier = (
+            self.reinfection_factor ** prior_infections
+            * self.vaccination_factor ** np.asarray(vaccination_count, dtype=float)
+            * self.strain_factor ** later_strains
+        )
+
+        moderate = self.base_proportions['moderate'] * multiplier
+        severe = self.base_proportions['severe'] * multiplier ** 2
+
+        # Keep proportions valid when the multiplier is large
+        not_mild = moderate + severe
+        scale = np.where(not_mild > 1, 1 / np.maximum(not_mild, 1), 1)
+        moderate, severe = moderate * scale, severe * scale
+
+        return np.column_stack([1 - moderate - severe, moderate, severe])
+
 
 class DataSimulationsMerger:
-    def __init__(self, df_simulation, df_symptom_integrals, data_daly):
+    def __init__(self, df_simulation, df_symptom_integrals, data_daly, severity_model=None):
+        """
+        Parameters:
+        df_simulation (pd.DataFrame): Simulation output.
+        df_symptom_integrals (pd.DataFrame or PosteriorDrawStore): Posterior symptom integral draws.
+        data_daly (pd.DataFrame): Processed DALY data.
+        severity_model (callable): See RuleBasedSeverityModel.
+        """
         self.df_simulation = df_simulation
         self.df_symptom_integrals = df_symptom_integrals
+        self.posterior = PosteriorDrawStore.coerce(df_symptom_integrals)
         self.data_daly = data_daly
+        self.severity_model = severity_model if severity_model is not None else RuleBasedSeverityModel()
 
     def calculate_individual_severity_proportions(self, individual_characteristics):
-        # Placeholder for actual logic to determine severity based on individual characteristics
-        # For example, this might return {'mild': 0.5, 'moderate': 0.3, 'severe': 0.2}
-        # Adjust this method based on your specific requirements and data
-        return {'mild': 1, 'moderate': 0, 'severe': 0}
+        """
+        Severity proportions for a single case, e.g. {'mild': 0.5, 'moderate': 0.3, 'severe': 0.2}.
+        """
+        proportions = self.calculate_severity_proportions(individual_characteristics.to_frame().T)[0]
+        return dict(zip(['mild', 'moderate', 'severe'], proportions))
+
+    def calculate_severity_proportions(self, cases):
+        """
+        Runs the severity model on all cases at once.
 
-    def calculate_welfare_loss(self):
+        Parameters:
+        cases (pd.DataFrame): Long COVID cases from the simulation output.
+
+        Returns:
+        np.ndarray: Matrix of shape (n_cases, 3) with mild, moderate and severe proportions.
+        """
+        strain = pd.to_numeric(cases['current_strain'], errors='coerce').fillna(0).to_numpy()
+        return self.severity_model(
+            infection_count=cases['covid_infections'].to_numpy(),
+            vaccination_count=cases['vaccination_count'].to_numpy(),
+            strain=strain,
+            risk=cases['long_covid_risk'].to_numpy()
+        )
+
+    def calculate_case_losses(self, cases, symptoms, rng):
+        """
+        Calculates the DALY loss of each case from each symptom.
+
+        Each case gets one random posterior draw of symptom integrals, which is weighted by
+        the severity-weighted DALY adjustment of each symptom and the case's long COVID risk.
+        In weighted-agent simulations, losses are also scaled by the agent's 'weight', so
+        sums over cases estimate population totals.
+
+        Returns:
+        np.ndarray: Matrix of shape (n_cases, n_symptoms).
+        """
+        symptom_dalys = self.calculate_severity_proportions(cases) @ self._daly_weights_by_severity(symptoms).T
+        case_integrals = self.posterior.sample(len(cases), rng, symptoms=symptoms)
+        case_scale = cases['long_covid_risk'].to_numpy()
+        if 'weight' in cases:
+            case_scale = case_scale * cases['weight'].to_numpy()
+        return symptom_dalys * case_integrals * case_scale[:, None]
+
+    def _split_into_week_blocks(self, partition, max_memory_bytes):
+        """
+        Splits a partition into blocks of whole weeks that each stay under the memory ceiling.
+        """
+        partition_bytes = partition.memory_usage(index=True, deep=True).sum()
+        if partition_bytes <= max_memory_bytes:
+            yield partition
+            return
+
+        weeks = np.sort(partition['week_start'].unique())
+        n_blocks = min(len(weeks), int(np.ceil(partition_bytes / max_memory_bytes)))
+        for week_block in np.array_split(weeks, n_blocks):
+            yield partition[partition['week_start'].isin(week_block)]
+
+    def calculate_welfare_loss_chunked(self, partitions, output_dir, max_memory_mb=512, seed=None):
+        """
+        Calculates welfare loss one partition at a time, writing results as it goes.
+
+        Partitions larger than `max_memory_mb` are processed in blocks of weeks, and the long
+        COVID cases with their DALY loss are written to `output_dir` as numbered pickle parts
+        whenever the buffered cases reach `max_memory_mb`. Only one partition is held in
+        memory at a time, so the simulation output never has to fit in memory as a whole.
+
+        Parameters:
+        partitions (iterable): Simulation output chunks, e.g. from iter_simulation_partitions with
+            the same max_memory_mb, so directories are read in blocks rather than whole.
+        output_dir (str): Directory to write the part files to.
+        max_memory_mb (float): Memory ceiling for processing blocks and the output buffer.
+        seed (int): Seed for the posterior draw sampling.
+
+        Returns:
+        pd.DataFrame: Long COVID cases and DALY loss summed per simulation and week.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        max_memory_bytes = max_memory_mb * 1024 ** 2
+        symptoms = self.data_daly['symptom'].unique()
+        rng = np.random.default_rng(seed)
+
+        buffer = []
+        buffer_bytes = 0
+        n_parts = 0
+        weekly_totals = []
+
+        def flush():
+            nonlocal buffer, buffer_bytes, n_parts
+            if buffer:
+                part_path = os.path.join(output_dir, f'part_{n_parts:05d}.pkl')
+                pd.concat(buffer).to_pickle(f'{part_path}.tmp')
+                os.replace(f'{part_path}.tmp', part_path)
+                n_parts += 1
+            buffer, buffer_bytes = [], 0
+
+        for partition in partitions:
+            for block in self._split_into_week_blocks(partition, max_memory_bytes):
+                long_covid_cases = block[block['has_long_covid']].copy()
+                long_covid_cases['DALY_loss'] = self.calculate_case_losses(long_covid_cases, symptoms, rng).sum(axis=1)
+
+                # Totals over the whole block, so weeks without cases are kept as zeros
+                block_cases = block['has_long_covid'] * block['weight'] if 'weight' in block else block['has_long_covid']
+                weekly_cases = block_cases.groupby([block['week_start'], block['simulation']]).sum().rename('has_long_covid')
+                weekly_loss = long_covid_cases.groupby(['week_start', 'simulation'])['DALY_loss'].sum()
+                weekly_totals.append(pd.concat([weekly_cases, weekly_loss], axis=1).fillna({'DALY_loss': 0}))
+                buffer.append(long_covid_cases)
+                buffer_bytes += long_covid_cases.memory_usage(index=True, deep=True).sum()
+                if buffer_bytes >= max_memory_bytes:
+                    flush()
+        flush()
+
+        if not weekly_totals:
+            return pd.DataFrame(columns=['week_start', 'simulation', 'has_long_covid', 'DALY_loss'])
+        return pd.concat(weekly_totals).groupby(level=['week_start', 'simulation']).sum().reset_index()
+
+    @staticmethod
+    def load_welfare_loss_parts(output_dir):
+        """
+        Reads the part files written by calculate_welfare_loss_chunked back into one DataFrame.
+        """
+        part_paths = sorted(glob.glob(os.path.join(output_dir, 'part_*.pkl')))
+        return pd.concat([pd.read_pickle(path) for path in part_paths])
+
+    def calculate_welfare_loss(self, seed=None):
         # Filter for individuals with long COVID
+        long_covid_cases = self.df_simulation[self.df_simulation['has_long_covid']].copy()
+
+        symptoms = self.data_daly['symptom'].unique()
+        rng = np.random.default_rng(seed)
+        long_covid_cases['DALY_loss'] = self.calculate_case_losses(long_covid_cases, symptoms, rng).sum(axis=1)
+
+        return long_covid_cases
+
+    def _daly_weights_by_severity(self, symptoms):
+        return daly_weights_by_severity(self.data_daly, symptoms)
+
+    def calculate_symptom_attribution(self, save_path=None, seed=None):
+        """
+        Attributes DALY loss to symptoms for every simulation and week.
+
+        Each long COVID case gets one posterior draw of symptom integrals, and the per-symptom
+        losses of all cases are summed into their simulation and week in one batched step.
+
+        Parameters:
+        save_path (str): Optional path of a .npy file to write the tensor to. Coordinates are
+            written alongside it as JSON, see load_symptom_attribution.
+        seed (int): Seed for the posterior draw sampling.
+
+        Returns:
+        Tuple[np.ndarray, dict]: Tensor of shape (n_simulations, n_weeks, n_symptoms) and its coordinates.
+        """
+        rng = np.random.default_rng(seed)
+        symptoms = self.data_daly['symptom'].unique()
         long_covid_cases = self.df_simulation[self.df_simulation['has_long_covid']]
+        case_losses = self.calculate_case_losses(long_covid_cases, symptoms, rng)
+        return self._attribute_case_losses(long_covid_cases, case_losses, symptoms, save_path)
 
-        # Create a DataFrame to store the welfare loss for each individual
-        welfare_loss_df = pd.DataFrame(index=long_covid_cases.index)
+    def calculate_welfare_loss_and_attribution(self, save_path=None, seed=None):
+        """
+        Calculates calculate_welfare_loss and calculate_symptom_attribution from the same case losses.
 
-        for index, row in long_covid_cases.iterrows():
-            if index % 1000 == 0:
-                print(f"Processing {index} of {len(long_covid_cases)}")
-            total_welfare_loss = 0
+        Every case keeps one posterior draw in both outputs, so the attribution tensor sums
+        to the 'DALY_loss' column.
 
-            # Get symptom prevalence integrals for this individual by random sampling
-            symptom_prevalences = self.df_symptom_integrals.sample(n=1).iloc[0]
+        Returns:
+        Tuple[pd.DataFrame, np.ndarray, dict]: Long COVID cases with their DALY loss, the
+        attribution tensor and its coordinates.
+        """
+        rng = np.random.default_rng(seed)
+        symptoms = self.data_daly['symptom'].unique()
+        long_covid_cases = self.df_simulation[self.df_simulation['has_long_covid']].copy()
+        case_losses = self.calculate_case_losses(long_covid_cases, symptoms, rng)
+        long_covid_cases['DALY_loss'] = case_losses.sum(axis=1)
+        attribution, coords = self._attribute_case_losses(long_covid_cases, case_losses, symptoms, save_path)
+        return long_covid_cases, attribution, coords
 
-            # Calculate severity proportions for this individual
-            severity_proportions = self.calculate_individual_severity_proportions(row)
+    def _attribute_case_losses(self, long_covid_cases, case_losses, symptoms, save_path=None):
+        """Sums per-symptom case losses into their simulation and week."""
+        simulations = np.sort(self.df_simulation['simulation'].unique())
+        weeks = np.sort(self.df_simulation['week_start'].unique())
 
-            # Iterate over symptoms
-            for symptom in self.data_daly['symptom'].unique():
-                daly_adjustments = self.data_daly[self.data_daly['symptom'] == symptom]
+        # Contract cases into their simulation and week
+        simulation_idx = np.searchsorted(simulations, long_covid_cases['simulation'].to_numpy())
+        week_idx = np.searchsorted(weeks, long_covid_cases['week_start'].to_numpy())
+        shape = (len(simulations), len(weeks), len(symptoms))
+        if save_path is not None:
+            attribution = np.lib.format.open_memmap(save_path, mode='w+', dtype=np.float32, shape=shape)
+            attribution[:] = 0
+        else:
+            attribution = np.zeros(shape, dtype=np.float32)
+        np.add.at(attribution, (simulation_idx, week_idx), case_losses.astype(np.float32))
 
-                # Calculate the weighted DALY adjustment for each symptom
-                weighted_daly = sum(daly_adjustments['daly_adjustment'] * 
-                                    daly_adjustments[severity_proportions.keys()].mul(list(severity_proportions.values()), axis=0).sum(axis=1))
+        coords = {
+            'simulation': simulations.tolist(),
+            'week_start': [str(pd.Timestamp(week).date()) for week in weeks],
+            'symptom': list(symptoms)
+        }
+        if save_path is not None:
+            attribution.flush()
+            with open(f"{save_path}.coords.json", 'w') as f:
+                json.dump(coords, f)
 
-                # Multiply the weighted DALY by the prevalence integral for the symptom
-                symptom_welfare_loss = weighted_daly * symptom_prevalences[symptom]
-                total_welfare_loss += symptom_welfare_loss
+        return attribution, coords
 
-            long_covid_cases.at[index, 'DALY_loss'] = total_welfare_loss * long_covid_cases.at[index, 'long_covid_risk']
+    @staticmethod
+    def load_symptom_attribution(path):
+        """
+        Opens a saved attribution tensor read-only without loading it into memory.
 
-        return long_covid_cases
+        Returns:
+        Tuple[np.memmap, dict]: Memory-mapped tensor and its coordinates.
+        """
+        with open(f"{path}.coords.json") as f:
+            coords = json.load(f)
+        return np.load(path, mmap_mode='r'), coords
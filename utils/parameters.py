@@ -34,6 +34,30 @@ default_params = {
     # Default values for other parameters
 }
 
+severity_param_descriptions = {
+    'base_proportions': 'Mild/moderate/severe split of a first-infection, unvaccinated, first-strain case',
+    'reinfection_factor': 'Multiplier on moderate (squared for severe) share per prior infection',
+    'vaccination_factor': 'Multiplier on moderate (squared for severe) share per vaccination',
+    'strain_factor': 'Multiplier on moderate (squared for severe) share per later strain'
+}
+
+# Default severity model: every case is mild, as before severity was modelled
+default_severity_params = {
+    'base_proportions': {'mild': 1.0, 'moderate': 0.0, 'severe': 0.0},
+    'reinfection_factor': 1.0,
+    'vaccination_factor': 1.0,
+    'strain_factor': 1.0
+}
+
+# Illustrative, unsourced severity coefficients; passing these to RuleBasedSeverityModel
+# moves DALY loss towards moderate and severe cases and changes every DALY output
+illustrative_severity_params = {
+    'base_proportions': {'mild': 0.7, 'moderate': 0.25, 'severe': 0.05},
+    'reinfection_factor': 1.2,
+    'vaccination_factor': 0.9,
+    'strain_factor': 0.95
+}
+
 # Example scenario override
 pessimistic_params = {
     'infection_rate': (25/330)/52,  # Higher infection rate in pessimistic scenario
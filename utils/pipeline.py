@@ -0,0 +1,189 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import traceback
+
+class Stage:
+    def __init__(self, name, function, inputs=(), outputs=(), mode='process'):
+        """
+        A pipeline stage.
+
+        Parameters:
+        name (str): Stage name.
+        function (callable): Called with one keyword argument per input. Must return a tuple
+            with one value per output (or the single value if there is one output). Must be
+            defined at module level when mode is 'process'.
+        inputs (tuple): Names of the values the stage needs.
+        outputs (tuple): Names of the values the stage produces.
+        mode (str): 'process' to run in a worker process, 'thread' to run in this process,
+            e.g. for stages that start their own worker pools or return very large results.
+        """
+        if mode not in ('process', 'thread'):
+            raise ValueError("Mode must be either 'process' or 'thread'.")
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.mode = mode
+
+
+def _run_stage(function, kwargs, n_outputs):
+    result = function(**kwargs)
+    if n_outputs == 1:
+        return (result,)
+    if n_outputs == 0:
+        return ()
+    return tuple(result)
+
+
+class PipelineScheduler:
+    def __init__(self, stages, max_processes=None, max_threads=None, start_method='spawn', transient=()):
+        """
+        Runs stages as soon as their inputs are available, independent stages concurrently.
+
+        A stage that raises is marked 'failed' and every stage that depends on it, directly or
+        indirectly, is marked 'skipped'; unrelated stages still run.
+
+        Parameters:
+        stages (list): Stage objects.
+        max_processes (int): Size of the process pool for 'process' stages.
+        max_threads (int): Size of the thread pool for 'thread' stages.
+        start_method (str): How 'process' workers are started. Workers are created while
+            'thread' stages are running, and forking a multi-threaded process can deadlock, so
+            the default is 'spawn'; 'forkserver' also works where available.
+        transient (tuple): Names of values dropped as soon as every stage reading them has
+            finished, e.g. large frames that later stages no longer need. They are missing from
+            the returned values.
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        self.max_processes = max_processes
+        self.max_threads = max_threads
+        self.start_method = start_method
+        self.transient = set(transient)
+        self._validate()
+
+        self.values = {}
+        self.status = {name: 'pending' for name in self.stages}
+        self.errors = {}
+
+    def _validate(self):
+        """Checks that every input is produced by exactly one stage and there are no cycles."""
+        producers = {}
+        for stage in self.stages.values():
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError(f"Output {output} is produced by both {producers[output]} and {stage.name}.")
+                producers[output] = stage.name
+        for stage in self.stages.values():
+            missing = [name for name in stage.inputs if name not in producers]
+            if missing:
+                raise ValueError(f"Stage {stage.name} needs {missing}, which no stage produces.")
+        self.producers = producers
+
+        # Depth-first search for cycles
+        visiting, done = set(), set()
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage {name} depends on itself.")
+            visiting.add(name)
+            for input_name in self.stages[name].inputs:
+                visit(self.producers[input_name])
+            visiting.remove(name)
+            done.add(name)
+        for name in self.stages:
+            visit(name)
+
+    def _upstream_failed(self, stage):
+        return any(self.status[self.producers[name]] in ('failed', 'skipped') for name in stage.inputs)
+
+    def _ready(self, stage):
+        return all(name in self.values for name in stage.inputs)
+
+    def _skip_unreachable(self):
+        """Marks pending stages with a failed or skipped upstream stage as skipped."""
+        changed = True
+        while changed:
+            changed = False
+            for name, stage in self.stages.items():
+                if self.status[name] == 'pending' and self._upstream_failed(stage):
+                    self.status[name] = 'skipped'
+                    logging.error('Skipping stage %s because an upstream stage failed.', name)
+                    changed = True
+
+    def _ready_stages(self):
+        self._skip_unreachable()
+        return [stage for name, stage in self.stages.items() if self.status[name] == 'pending' and self._ready(stage)]
+
+    def _finish(self, name, get_result):
+        try:
+            self.values.update(zip(self.stages[name].outputs, get_result()))
+            self.status[name] = 'done'
+            logging.info('Finished stage %s.', name)
+        except Exception as e:
+            self.status[name] = 'failed'
+            self.errors[name] = ''.join(traceback.format_exception(e))
+            logging.error('Stage %s failed: %s', name, e)
+        self._drop_consumed()
+
+    def _drop_consumed(self):
+        """Drops transient values that no pending or running stage still reads."""
+        for value_name in self.transient & set(self.values):
+            readers = [stage for stage in self.stages.values() if value_name in stage.inputs]
+            if all(self.status[stage.name] not in ('pending', 'running') for stage in readers):
+                del self.values[value_name]
+
+    def run(self, serial=False, stage_context=None):
+        """
+        Runs all stages.
+
+        Parameters:
+        serial (bool): Run stages one at a time in this process, in dependency order.
+        stage_context (callable): With serial, a context manager factory called with each
+            stage name and entered around the stage, e.g. StageMemoryProfiler.stage.
+
+        Returns:
+        dict: The produced values by name. Outputs of failed or skipped stages are missing;
+        see self.status and self.errors.
+        """
+        if serial:
+            return self._run_serial(stage_context)
+
+        mp_context = multiprocessing.get_context(self.start_method)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_processes, mp_context=mp_context) as processes, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as threads:
+            running = {}
+            while True:
+                for stage in self._ready_stages():
+                    executor = processes if stage.mode == 'process' else threads
+                    kwargs = {input_name: self.values[input_name] for input_name in stage.inputs}
+                    running[executor.submit(_run_stage, stage.function, kwargs, len(stage.outputs))] = stage.name
+                    del kwargs  # So transient inputs are only held by the running stage
+                    self.status[stage.name] = 'running'
+                    logging.info('Started stage %s.', stage.name)
+
+                if not running:
+                    break
+
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    self._finish(running.pop(future), future.result)
+
+        return self.values
+
+    def _run_serial(self, stage_context):
+        while True:
+            ready = self._ready_stages()
+            if not ready:
+                return self.values
+            stage = ready[0]
+            self.status[stage.name] = 'running'
+            # Inputs are looked up inside get_result, so no reference to them outlives the stage
+            def get_result():
+                kwargs = {input_name: self.values[input_name] for input_name in stage.inputs}
+                if stage_context is None:
+                    return _run_stage(stage.function, kwargs, len(stage.outputs))
+                with stage_context(stage.name):
+                    return _run_stage(stage.function, kwargs, len(stage.outputs))
+            self._finish(stage.name, get_result)
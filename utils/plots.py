@@ -1,12 +1,23 @@
+import matplotlib
+matplotlib.use('Agg')  # Figures are only saved to file, also from worker processes
 import matplotlib.dates as mdates
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import pickle
 
-def plot_daly_loss_over_time(df):
+def plot_daly_loss_over_time(df, path='output/plots/daly_loss_over_time.png'):
     # Convert 'DALY_loss' to numeric, coercing any errors to NaN
     df['DALY_loss'] = pd.to_numeric(df['DALY_loss'], errors='coerce')
 
+    # Weighted-agent simulations: count each case as the number of people its agent represents
+    if 'weight' in df.columns:
+        df = df.assign(has_long_covid=df['has_long_covid'] * df['weight'])
+
     # Separate data by simulation and aggregate
     aggregated_data = (
         df.groupby(['week_start', 'simulation'])
@@ -53,10 +64,11 @@ def plot_daly_loss_over_time(df):
     plt.xticks(rotation=45)
     plt.xlabel('Week Start Date')
     plt.tight_layout(rect=[0, 0.03, 1, 0.95])  # Adjust the layout to fit the title
-    plt.savefig('output/plots/daly_loss_over_time.png')
+    plt.savefig(path)
+    plt.close(fig)
 
 
-def plot_symptom_years_histograms(df, num_subplots, alpha=0.5, colors=None):
+def plot_symptom_years_histograms(df, num_subplots, alpha=0.5, colors=None, path='output/plots/symptom_histograms.png'):
     """
     Plots histograms of years of symptom prevalence in subplots, with thresholds automatically calculated.
 
@@ -107,10 +119,11 @@ def plot_symptom_years_histograms(df, num_subplots, alpha=0.5, colors=None):
         ax.legend(loc='upper right', fontsize='small')
 
     plt.tight_layout()
-    plt.savefig('output/plots/symptom_histograms.png')
+    plt.savefig(path)
+    plt.close(fig)
     
 
-def plot_daly_adjustments(data_daly):
+def plot_daly_adjustments(data_daly, path='output/plots/daly_adjustments.png'):
     """
     Plots DALY adjustments per symptom categorized by severity and mean DALY adjustment.
 
@@ -130,7 +143,7 @@ def plot_daly_adjustments(data_daly):
 
     # Create a DataFrame to hold the binned symptom names
     symptom_bins = {bin_num: [] for bin_num in range(3)}
-    for symptom, bin_num in bins.iteritems():
+    for symptom, bin_num in bins.items():
         symptom_bins[bin_num].append(symptom)
 
     # Find the maximum DALY adjustment for y-axis scaling
@@ -159,9 +172,44 @@ def plot_daly_adjustments(data_daly):
             ax.legend(loc='upper right', fontsize='small')
 
     plt.tight_layout()
-    plt.savefig('output/plots/daly_adjustments.png')
+    plt.savefig(path)
+    plt.close(fig)
+
+def posterior_curve_bands(trace, time_points, percentiles=(2.5, 97.5)):
+    """
+    Computes posterior prevalence curves for all symptoms and time points at once.
+
+    Args:
+    trace (InferenceData): Trace with 'baseline' and 'decay_rate' posteriors.
+    time_points (array): Time points in months.
+    percentiles (tuple): Lower and upper percentile of the band.
+
+    Returns:
+    dict: 'mean', 'lower' and 'upper' arrays of shape (n_symptoms, n_time_points).
+    """
+    n_symptoms = trace.posterior['baseline'].shape[-1]
+    baseline_samples = trace.posterior['baseline'].values.reshape(-1, n_symptoms)
+    decay_rate_samples = trace.posterior['decay_rate'].values.reshape(-1, n_symptoms)
+
+    # Draws x symptoms x time points
+    prevalence_pred = baseline_samples[:, :, None] * np.exp(-decay_rate_samples[:, :, None] * np.asarray(time_points)[None, None, :])
+
+    lower, upper = np.percentile(prevalence_pred, percentiles, axis=0)
+    return {'mean': prevalence_pred.mean(axis=0), 'lower': lower, 'upper': upper}
+
+def plot_all_symptoms(trace, symptoms, time_points, path='output/plots/symptom_decay.png', bands=None):
+    """
+    Plots posterior prevalence decay curves per symptom.
+
+    Args:
+    trace (InferenceData): Trace with 'baseline' and 'decay_rate' posteriors; not needed if bands is given.
+    symptoms (list): Symptom names, in trace order.
+    time_points (array): Time points in months.
+    bands (dict): Precomputed output of posterior_curve_bands.
+    """
+    if bands is None:
+        bands = posterior_curve_bands(trace, time_points)
 
-def plot_all_symptoms(trace, symptoms, time_points):
     n_symptoms = len(symptoms)
     n_cols = 3
     n_rows = int(np.ceil(n_symptoms / n_cols))
@@ -169,16 +217,8 @@ def plot_all_symptoms(trace, symptoms, time_points):
     axes = axes.flatten()  # Flatten to simplify indexing
 
     for i, symptom in enumerate(symptoms):
-        baseline_samples = trace.posterior['baseline'].values[:, :, i]
-        decay_rate_samples = trace.posterior['decay_rate'].values[:, :, i]
-
-        # Generate predictions for each sample in the trace
-        prevalence_pred = np.array([[baseline * np.exp(-decay_rate * time) for time in time_points] 
-                                    for baseline, decay_rate in zip(baseline_samples.flatten(), decay_rate_samples.flatten())])
-
-        percentiles = np.percentile(prevalence_pred, [2.5, 97.5], axis=0)
-        axes[i].fill_between(time_points, percentiles[0], percentiles[1], alpha=0.3)
-        axes[i].plot(time_points, np.mean(prevalence_pred, axis=0))
+        axes[i].fill_between(time_points, bands['lower'][i], bands['upper'][i], alpha=0.3)
+        axes[i].plot(time_points, bands['mean'][i])
         axes[i].set_title(symptom)
         axes[i].set_xlabel('Time (months)')
         axes[i].set_ylabel('Prevalence')
@@ -188,4 +228,72 @@ def plot_all_symptoms(trace, symptoms, time_points):
 
     plt.suptitle('Decay of Symptoms Prevalence Over Time')
     plt.tight_layout(rect=[0, 0, 1, 0.97])
-    plt.savefig('output/plots/symptom_decay.png')
\ No newline at end of file
+    plt.savefig(path)
+    plt.close(fig)
+
+def _hash_inputs(kwargs):
+    """Hashes a figure's inputs, using pandas' content hash for DataFrames."""
+    digest = hashlib.sha256()
+    for key in sorted(kwargs):
+        value = kwargs[key]
+        digest.update(key.encode())
+        if isinstance(value, pd.DataFrame):
+            digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+            digest.update(pickle.dumps(list(value.columns)))
+        elif isinstance(value, np.ndarray):
+            digest.update(np.ascontiguousarray(value).tobytes())
+        else:
+            digest.update(pickle.dumps(value))
+    return digest.hexdigest()
+
+def render_figures(figures, n_workers=None, force=False):
+    """
+    Renders independent figures in a process pool, skipping figures whose inputs are unchanged.
+
+    The input hash of each figure is stored next to it as '<path>.hash'.
+
+    Args:
+    figures (list): (plot function, keyword arguments) pairs; the arguments must include 'path'.
+    n_workers (int): Number of worker processes.
+    force (bool): Re-render even if the inputs are unchanged.
+
+    Returns:
+    list: Paths of the figures that were rendered.
+    """
+    pending = []
+    for plot_function, kwargs in figures:
+        input_hash = _hash_inputs({**kwargs, '_function': plot_function.__name__})
+        hash_path = f"{kwargs['path']}.hash"
+        if not force and os.path.exists(kwargs['path']) and os.path.exists(hash_path):
+            with open(hash_path) as f:
+                if f.read() == input_hash:
+                    continue
+        pending.append((plot_function, kwargs, hash_path, input_hash))
+
+    # Spawned, not forked: this runs in a pipeline thread stage while other threads are alive
+    mp_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context) as executor:
+        futures = {executor.submit(plot_function, **kwargs): (kwargs['path'], hash_path, input_hash)
+                   for plot_function, kwargs, hash_path, input_hash in pending}
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+            _, hash_path, input_hash = futures[future]
+            with open(hash_path, 'w') as f:
+                f.write(input_hash)
+
+    return [kwargs['path'] for _, kwargs, _, _ in pending]
+
+def plot_report(data_daly, trace, symptoms, df_symptom_integrals, df_merged, time_points=np.linspace(0, 18, 100), n_workers=None):
+    """
+    Renders all report figures. Posterior bands are computed here so the trace is not sent to workers.
+    """
+    figures = [
+        (plot_daly_adjustments, {'data_daly': data_daly, 'path': 'output/plots/daly_adjustments.png'}),
+        (plot_all_symptoms, {
+            'trace': None, 'symptoms': symptoms, 'time_points': time_points,
+            'bands': posterior_curve_bands(trace, time_points), 'path': 'output/plots/symptom_decay.png'
+            }),
+        (plot_symptom_years_histograms, {'df': df_symptom_integrals, 'num_subplots': 3, 'path': 'output/plots/symptom_histograms.png'}),
+        (plot_daly_loss_over_time, {'df': df_merged, 'path': 'output/plots/daly_loss_over_time.png'})
+    ]
+    return render_figures(figures, n_workers=n_workers)
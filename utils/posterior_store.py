@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+class PosteriorDrawStore:
+    def __init__(self, arrays, symptoms, path=None):
+        """
+        Posterior draws as contiguous float32 draws x symptoms matrices with symptom names.
+
+        All matrices share the same draws, so one set of draw indices selects matching rows,
+        e.g. of 'integral', 'baseline' and 'decay_rate'. A store saved with save() opens as
+        read-only memory maps, so loading is instant and every process reading the same
+        directory shares one copy through the page cache. Pickling a saved store only pickles
+        its path, so stores passed to worker processes are reopened rather than copied.
+
+        Parameters:
+        arrays (dict): Name to matrix of shape (n_draws, n_symptoms).
+        symptoms (list): Symptom names, in column order.
+        path (str): Directory the store was loaded from, if any.
+        """
+        self.arrays = {name: np.ascontiguousarray(array, dtype=np.float32) for name, array in arrays.items()}
+        self.symptoms = list(symptoms)
+        self.path = path
+
+        shapes = {array.shape for array in self.arrays.values()}
+        if len(shapes) != 1 or shapes.pop()[1:] != (len(self.symptoms),):
+            raise ValueError("Every array must have shape (n_draws, n_symptoms) for the same draws.")
+        self.n_draws = len(next(iter(self.arrays.values())))
+        self._column_index = {symptom: i for i, symptom in enumerate(self.symptoms)}
+
+    @classmethod
+    def from_frame(cls, df_symptom_integrals, **arrays):
+        """
+        Store of a DataFrame of integral draws, e.g. from calculate_symptom_integrals.
+
+        Further matrices over the same draws and symptoms, such as baseline and decay rate
+        draws, can be passed as keyword arguments.
+        """
+        return cls({'integral': df_symptom_integrals.to_numpy(), **arrays}, df_symptom_integrals.columns)
+
+    @classmethod
+    def from_estimator(cls, estimator, df_symptom_integrals=None, max_time=18):
+        """Store of the integral, baseline and decay rate draws of a fitted SymptomPrevalenceEstimator."""
+        if df_symptom_integrals is None:
+            df_symptom_integrals = estimator.calculate_symptom_integrals(max_time=max_time)
+        n_symptoms = estimator.n_symptoms
+        return cls.from_frame(
+            df_symptom_integrals,
+            baseline=estimator.trace.posterior['baseline'].values.reshape(-1, n_symptoms),
+            decay_rate=estimator.trace.posterior['decay_rate'].values.reshape(-1, n_symptoms)
+            )
+
+    @classmethod
+    def coerce(cls, posterior):
+        """Returns posterior as a store; DataFrames of integral draws are wrapped with from_frame."""
+        return posterior if isinstance(posterior, cls) else cls.from_frame(posterior)
+
+    def save(self, path):
+        """
+        Writes one .npy file per matrix and the symptom names to directory `path`.
+
+        The directory is written next to its final location and then moved into place, so
+        readers never see a partial store.
+
+        Returns:
+        PosteriorDrawStore: The saved store, opened from disk.
+        """
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, array in self.arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+        with open(os.path.join(tmp_path, 'metadata.json'), 'w') as f:
+            json.dump({'symptoms': self.symptoms, 'arrays': list(self.arrays), 'n_draws': self.n_draws}, f)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        return self.load(path)
+
+    @classmethod
+    def load(cls, path):
+        """Opens a saved store as read-only memory maps, without reading the draws."""
+        with open(os.path.join(path, 'metadata.json')) as f:
+            metadata = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in metadata['arrays']}
+        store = cls.__new__(cls)
+        store.arrays = arrays
+        store.symptoms = metadata['symptoms']
+        store.path = path
+        store.n_draws = metadata['n_draws']
+        store._column_index = {symptom: i for i, symptom in enumerate(store.symptoms)}
+        return store
+
+    def fingerprint(self):
+        """Hash of the symptom names and every matrix, to tell results of different fits apart."""
+        digest = hashlib.sha256(json.dumps(self.symptoms).encode())
+        for name in sorted(self.arrays):
+            digest.update(name.encode())
+            digest.update(np.ascontiguousarray(self.arrays[name]).tobytes())
+        return digest.hexdigest()
+
+    def __getstate__(self):
+        if self.path is not None:
+            return {'path': self.path}
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        if set(state) == {'path'}:
+            state = self.load(state['path']).__dict__
+        self.__dict__.update(state)
+
+    def columns(self, symptoms=None):
+        """Column positions of the given symptoms, in that order; all columns if None."""
+        if symptoms is None:
+            return np.arange(len(self.symptoms))
+        missing = [symptom for symptom in symptoms if symptom not in self._column_index]
+        if missing:
+            raise KeyError(f"Symptoms not in the posterior store: {missing}.")
+        return np.array([self._column_index[symptom] for symptom in symptoms], dtype=int)
+
+    def sample_indices(self, size, rng=None, replace=True):
+        """
+        Draw indices for `size` cases or draws at once.
+
+        Parameters:
+        size (int): Number of indices.
+        rng (np.random.Generator or int): Generator, or seed for a new one.
+        replace (bool): Sample with replacement, e.g. one draw per case; without replacement,
+            size is capped at the number of draws.
+
+        Returns:
+        np.ndarray: Draw indices.
+        """
+        rng = rng if isinstance(rng, np.random.Generator) else np.random.default_rng(rng)
+        if replace:
+            return rng.integers(0, self.n_draws, size=size)
+        return rng.choice(self.n_draws, size=min(size, self.n_draws), replace=False)
+
+    def draws(self, name='integral', indices=None, symptoms=None):
+        """
+        Rows `indices` (all draws if None) and the columns of `symptoms` of one matrix.
+
+        Returns:
+        np.ndarray: float32 matrix of shape (n_indices, n_symptoms).
+        """
+        array = self.arrays[name]
+        rows = slice(None) if indices is None else indices
+        if symptoms is None:
+            return np.asarray(array[rows])
+        return np.asarray(array[rows][:, self.columns(symptoms)])
+
+    def sample(self, size, rng=None, name='integral', symptoms=None):
+        """One posterior draw per case for `size` cases, see sample_indices and draws."""
+        return self.draws(name, self.sample_indices(size, rng), symptoms)
+
+    def to_frame(self, name='integral'):
+        """Matrix as a DataFrame with one column per symptom, like calculate_symptom_integrals."""
+        return pd.DataFrame(np.asarray(self.arrays[name]), columns=self.symptoms)
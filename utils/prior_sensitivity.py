@@ -0,0 +1,174 @@
+import arviz as az
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+class PriorSensitivityAnalyzer:
+    def __init__(self, estimator, k_threshold=0.7, max_time=18, sampling_kwargs=None):
+        """
+        Effect of SymptomPrevalenceEstimator hyperparameters on the symptom integrals, without refitting.
+
+        Only the priors depend on the hyperparameters, so the posterior under new settings is
+        the fitted posterior reweighted by the ratio of the new to the fitted prior density of
+        each draw. The weights are Pareto-smoothed; where the Pareto k diagnostic exceeds
+        k_threshold the reweighted estimates are unreliable and the model is refitted instead.
+
+        Parameters:
+        estimator (SymptomPrevalenceEstimator): Fitted estimator; its trace and hyperparameters
+            are the reference.
+        k_threshold (float): Largest Pareto k for which reweighting is trusted.
+        max_time (int): Integration horizon in months, see calculate_symptom_integrals.
+        sampling_kwargs (dict): Passed to setup_and_sample_model for refits.
+        """
+        if estimator.trace is None:
+            raise ValueError("The estimator has to be fitted first.")
+        self.estimator = estimator
+        self.k_threshold = k_threshold
+        self.max_time = max_time
+        self.sampling_kwargs = sampling_kwargs or {}
+
+        self.reference_hyperparameters = dict(estimator.hyperparameters)
+        self.reference_trace = estimator.trace
+        self.draws = self._posterior_draws(estimator.trace)
+        self.integrals = estimator.calculate_symptom_integrals(max_time=max_time)
+        self.reference_log_prior = self.log_prior(self.reference_hyperparameters)
+
+    def _posterior_draws(self, trace):
+        """Free and prior-dependent variables of the trace, flattened to (n_draws, n_symptoms)."""
+        names = ['baseline', 'decay_rate']
+        if self.estimator.non_centered:
+            names += ['baseline_alpha_offset', 'baseline_beta_offset', 'decay_rate_offset']
+        else:
+            names += ['baseline_alpha', 'baseline_beta', 'decay_rate_alpha']
+        return {name: trace.posterior[name].values.reshape(-1, self.estimator.n_symptoms) for name in names}
+
+    def log_prior(self, hyperparameters):
+        """
+        Log prior density of every posterior draw under the given hyperparameters, as in setup_model.
+
+        Returns:
+        np.ndarray: One value per draw; -inf where a draw is outside the prior's support.
+        """
+        h = {**self.reference_hyperparameters, **hyperparameters}
+        gamma_params = self.estimator._calculate_gamma_params
+        baseline_alpha_alpha, baseline_alpha_theta = gamma_params(h['baseline_alpha_hyperprior_mean'], h['baseline_alpha_hyperprior_var'])
+        baseline_beta_alpha, baseline_beta_theta = gamma_params(h['baseline_beta_hyperprior_mean'], h['baseline_beta_hyperprior_var'])
+        decayrate_alpha_alpha, decayrate_alpha_theta = gamma_params(h['decayrate_mean_hyperprior_mean'], h['decayrate_mean_hyperprior_var'])
+
+        draws = self.draws
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.estimator.non_centered:
+                # The offsets are standard normal whatever the hyperparameters, so their density cancels
+                baseline_alpha = baseline_alpha_alpha + baseline_alpha_theta * draws['baseline_alpha_offset']
+                baseline_beta = baseline_beta_alpha + baseline_beta_theta * draws['baseline_beta_offset']
+                decay_rate_alpha = decayrate_alpha_alpha + decayrate_alpha_theta * draws['decay_rate_offset']
+                log_density = 0
+            else:
+                baseline_alpha, baseline_beta, decay_rate_alpha = draws['baseline_alpha'], draws['baseline_beta'], draws['decay_rate_alpha']
+                log_density = (
+                    stats.gamma.logpdf(baseline_alpha, a=baseline_alpha_alpha, scale=baseline_alpha_theta)
+                    + stats.gamma.logpdf(baseline_beta, a=baseline_beta_alpha, scale=baseline_beta_theta)
+                    + stats.gamma.logpdf(decay_rate_alpha, a=decayrate_alpha_alpha, scale=decayrate_alpha_theta)
+                )
+            log_density = (
+                log_density
+                + stats.beta.logpdf(draws['baseline'], a=baseline_alpha, b=baseline_beta)
+                + stats.gamma.logpdf(draws['decay_rate'], a=decay_rate_alpha, scale=h['decayrate_prior_var'])
+            )
+        log_density = np.where(np.isnan(log_density), -np.inf, log_density)
+        return log_density.sum(axis=1)
+
+    def importance_weights(self, hyperparameters):
+        """
+        Pareto-smoothed importance weights of the posterior draws under new hyperparameters.
+
+        Returns:
+        Tuple[np.ndarray, float, float]: Normalised weights, Pareto k and the effective number
+        of draws 1 / sum(weights ** 2).
+        """
+        log_ratios = self.log_prior(hyperparameters) - self.reference_log_prior
+        if not np.isfinite(log_ratios).any():
+            return np.full(len(log_ratios), np.nan), np.inf, 0.0
+
+        # Draws outside the new prior's support get (almost) zero weight
+        log_ratios = np.where(np.isfinite(log_ratios), log_ratios, np.nanmin(log_ratios[np.isfinite(log_ratios)]) - 100)
+        smoothed_log_weights, pareto_k = az.psislw(log_ratios - log_ratios.max())
+        weights = np.exp(smoothed_log_weights - smoothed_log_weights.max())
+        weights /= weights.sum()
+        return weights, float(pareto_k), float(1 / np.sum(weights ** 2))
+
+    @staticmethod
+    def _summarize(integrals, weights, quantiles):
+        """Weighted mean and quantiles of each symptom's integral."""
+        values = integrals.to_numpy()
+        summary = {'mean': weights @ values}
+        order = np.argsort(values, axis=0)
+        cumulative = np.cumsum(weights[order], axis=0) - 0.5 * weights[order]
+        for q in quantiles:
+            summary[f'q{q:g}'] = [
+                np.interp(q, cumulative[:, j], values[order[:, j], j]) for j in range(values.shape[1])
+            ]
+        return pd.DataFrame(summary, index=pd.Index(integrals.columns, name='symptom'))
+
+    def _refit(self, hyperparameters):
+        """Samples the model under new hyperparameters, then restores the reference fit."""
+        estimator = self.estimator
+        try:
+            estimator.set_hyperparameters(hyperparameters)
+            estimator.setup_and_sample_model(**self.sampling_kwargs)
+            return estimator.calculate_symptom_integrals(max_time=self.max_time)
+        finally:
+            estimator.set_hyperparameters(self.reference_hyperparameters)
+            estimator.trace = self.reference_trace
+
+    def evaluate(self, hyperparameters, quantiles=(0.05, 0.5, 0.95), allow_refit=True):
+        """
+        Symptom integrals under new hyperparameters.
+
+        Parameters:
+        hyperparameters (dict): Hyperparameters to change; the others keep their fitted values.
+        quantiles (tuple): Quantiles of the integrals to report.
+        allow_refit (bool): Refit when the Pareto k exceeds k_threshold; otherwise report the
+            reweighted estimates with method 'importance (unreliable)'.
+
+        Returns:
+        dict: 'summary' (mean and quantiles of each symptom's integral), 'method' ('importance'
+        or 'refit'), 'pareto_k' and 'ess' of the importance weights.
+        """
+        weights, pareto_k, ess = self.importance_weights(hyperparameters)
+        if pareto_k <= self.k_threshold:
+            method, integrals = 'importance', self.integrals
+        elif allow_refit:
+            integrals = self._refit(hyperparameters)
+            method, weights = 'refit', np.full(len(integrals), 1 / len(integrals))
+        else:
+            method, integrals = 'importance (unreliable)', self.integrals
+        return {
+            'summary': self._summarize(integrals, weights, quantiles),
+            'method': method,
+            'pareto_k': pareto_k,
+            'ess': ess
+        }
+
+    def sweep(self, settings, quantiles=(0.05, 0.5, 0.95), allow_refit=True):
+        """
+        Evaluates a list of hyperparameter settings.
+
+        Parameters:
+        settings (list): Dicts of hyperparameters to change, e.g. [{'decayrate_prior_var': 5}, ...].
+
+        Returns:
+        pd.DataFrame: One row per setting and symptom, with the changed hyperparameters,
+        method, Pareto k, ESS and the summary of the integral.
+        """
+        rows = []
+        for setting in settings:
+            result = self.evaluate(setting, quantiles=quantiles, allow_refit=allow_refit)
+            summary = result['summary'].reset_index()
+            for name, value in setting.items():
+                summary[name] = value
+            summary['method'] = result['method']
+            summary['pareto_k'] = result['pareto_k']
+            summary['ess'] = result['ess']
+            rows.append(summary)
+        return pd.concat(rows, ignore_index=True)
@@ -1,139 +1,163 @@
 import pandas as pd
+import numpy as np
+import glob
+import os
+import re
 
 class SymptomPrevalenceDataPreparer:
-    def __init__(self, file_path):
+    def __init__(self, file_path, first_period_months=6):
         """
-        Initializes the DataPreparer with the path to the prevalence and symptoms data file.
+        Initializes the DataPreparer with the path to the prevalence and symptoms data.
 
         Parameters:
-        file_path (str): Path to the CSV file containing prevalence and symptoms data.
+        file_path (str or list): Path to a CSV file, a directory of CSV files (one per study),
+            or a list of CSV file paths.
+        first_period_months (int): Follow-up month of the first period, used when a file has
+            no 'milestone_1st_period' column.
         """
         self.file_path = file_path
+        self.first_period_months = first_period_months
 
     def prepare_data(self):
         """
-        Prepares the raw data by cleaning, calculating, merging, and collapsing it.
+        Prepares the raw data by cleaning, calculating and pivoting it.
 
         Returns:
-        pd.DataFrame: Collapsed and prepared data.
+        pd.DataFrame: One row per symptom and one 'prevalence_diff_<months>m' column per time point.
         """
         data = self._load_data()
         cleaned_data = self._clean_and_subset_data(data)
-        prevalence_diff_6m, prevalence_diff_2nd = self._calculate_prevalence_differences(cleaned_data)
-        merged_data = self._merge_prevalence_data(prevalence_diff_6m, prevalence_diff_2nd)
-        collapsed_data = self._collapse_prevalence_data(merged_data)
+        long_data = self._stack_periods(cleaned_data)
+        prevalence_diff = self._calculate_prevalence_differences(long_data)
+        collapsed_data = self._collapse_prevalence_data(prevalence_diff)
         return collapsed_data
 
-    def _load_data(self):
+    def _list_files(self):
         """
-        Loads data from the CSV file.
+        Resolves file_path into a list of CSV files.
 
         Returns:
-        pd.DataFrame: Data loaded from the CSV file.
+        List[str]: Paths of the CSV files to load.
+        """
+        if isinstance(self.file_path, (list, tuple)):
+            return list(self.file_path)
+        if os.path.isdir(self.file_path):
+            return sorted(glob.glob(os.path.join(self.file_path, '*.csv')))
+        return [self.file_path]
+
+    def _load_data(self):
         """
-        return pd.read_csv(self.file_path)
+        Loads data from all CSV files, tagging each row with the study (file) it came from.
 
-    def _clean_and_subset_data(self, data):
+        Returns:
+        pd.DataFrame: Data loaded from the CSV files.
         """
-        Cleans and subsets the data for relevant columns.
+        files = self._list_files()
+        if not files:
+            raise ValueError("No prevalence and symptoms CSV files found.")
+        return pd.concat(
+            [pd.read_csv(path).assign(study=os.path.splitext(os.path.basename(path))[0]) for path in files],
+            ignore_index=True
+        )
+
+    def _clean_and_subset_data(self, data, keep_counts=False):
+        """
+        Cleans and subsets the data for relevant columns, and parses the milestone months.
 
         Parameters:
         data (pd.DataFrame): The raw data.
+        keep_counts (bool): Also keep the sample sizes 'n_1st_period' and 'n_2nd_period'.
 
         Returns:
         pd.DataFrame: Cleaned and subsetted data.
         """
-        columns = ['symptomatic', 'cohort_period', 'symptom', 'percentage_1st_period', 'percentage_2nd_period']
+        data = data.copy()
+        if 'milestone_1st_period' not in data.columns:
+            data['milestone_1st_period'] = self.first_period_months
+        if 'milestone_2nd_period' not in data.columns:
+            data['milestone_2nd_period'] = np.nan
+        # Fall back to the last number in e.g. '6 and 12 months' where the milestone is missing
+        data['milestone_2nd_period'] = pd.to_numeric(data['milestone_2nd_period'], errors='coerce').fillna(
+            pd.to_numeric(data['cohort_period'].astype(str).str.extract(r'(\d+)\D*$')[0], errors='coerce')
+        )
+
+        columns = [
+            'study', 'symptomatic', 'cohort_period', 'symptom', 
+            'milestone_1st_period', 'percentage_1st_period', 'milestone_2nd_period', 'percentage_2nd_period'
+        ]
+        if keep_counts:
+            columns += ['n_1st_period', 'n_2nd_period']
         return data[columns].dropna()
 
-    def _calculate_prevalence_differences(self, cleaned_data):
+    def _stack_periods(self, cleaned_data):
         """
-        Calculates prevalence differences for different periods.
+        Stacks first and second period observations into one long table.
 
         Parameters:
         cleaned_data (pd.DataFrame): The cleaned data.
 
         Returns:
-        Tuple[pd.DataFrame, pd.DataFrame]: Prevalence differences for 6 months and the second period.
+        pd.DataFrame: One row per observation with 'months' and 'percentage' columns, and 'n'
+        if the sample sizes were kept.
         """
-        grouped = cleaned_data.groupby(['symptom', 'cohort_period'])
-        prevalence_diff_6m = grouped.apply(lambda x: self._calculate_mean_diff(x, 'percentage_1st_period')).reset_index(name='prevalence_diff_6m')
-        prevalence_diff_2nd = grouped.apply(lambda x: self._calculate_mean_diff(x, 'percentage_2nd_period')).reset_index(name='prevalence_diff_2nd')
-        return prevalence_diff_6m, prevalence_diff_2nd
-
-    def _calculate_mean_diff(self, group, column):
+        id_columns = ['study', 'cohort_period', 'symptom', 'symptomatic']
+        keep_counts = 'n_1st_period' in cleaned_data.columns
+        periods = []
+        for period in ['1st', '2nd']:
+            value_columns = [f'milestone_{period}_period', f'percentage_{period}_period'] + ([f'n_{period}_period'] if keep_counts else [])
+            period_data = cleaned_data[id_columns + value_columns]
+            periods.append(period_data.set_axis(id_columns + ['months', 'percentage'] + (['n'] if keep_counts else []), axis=1))
+        long_data = pd.concat(periods, ignore_index=True)
+        long_data['months'] = long_data['months'].astype(int)
+        return long_data
+
+    def _calculate_prevalence_differences(self, long_data):
         """
-        Calculates the mean difference for a given group and column.
+        Calculates symptomatic minus asymptomatic prevalence for every cohort and time point.
 
         Parameters:
-        group (pd.DataFrame): Grouped data.
-        column (str): The column to calculate the mean difference for.
+        long_data (pd.DataFrame): Stacked observations.
 
         Returns:
-        float: Mean difference.
+        pd.DataFrame: Prevalence differences with 'symptom', 'months' and 'prevalence_diff' columns.
         """
-        symptomatic_mean = group[group['symptomatic'] == 1][column].mean()
-        asymptomatic_mean = group[group['symptomatic'] == 0][column].mean()
-        return symptomatic_mean - asymptomatic_mean
-
-    def _merge_prevalence_data(self, prevalence_diff_6m, prevalence_diff_2nd):
+        means = long_data.pivot_table(
+            index=['study', 'cohort_period', 'symptom', 'months'], 
+            columns='symptomatic', 
+            values='percentage', 
+            aggfunc='mean'
+        )
+        prevalence_diff = (means[1] - means[0]).rename('prevalence_diff').reset_index()
+        return prevalence_diff
+
+    def _collapse_prevalence_data(self, prevalence_diff):
         """
-        Merges the 6-month and second period prevalence data.
+        Averages prevalence differences over cohorts and pivots to a single row per symptom.
 
         Parameters:
-        prevalence_diff_6m (pd.DataFrame): Prevalence differences for 6 months.
-        prevalence_diff_2nd (pd.DataFrame): Prevalence differences for the second period.
-
-        Returns:
-        pd.DataFrame: Merged prevalence data.
-        """
-        merged = pd.merge(prevalence_diff_6m, prevalence_diff_2nd, on=['symptom', 'cohort_period'])
-        merged['months_2nd_period'] = merged['cohort_period'].apply(lambda x: 18 if '18' in x else 12)
-        return merged
-
-    def _collapse_prevalence_data(self, merged_data):
-        """
-        Collapses the prevalence data to a single row per symptom.
-
-        Parameters:
-        merged_data (pd.DataFrame): Merged prevalence data.
+        prevalence_diff (pd.DataFrame): Prevalence differences per cohort and time point.
 
         Returns:
         pd.DataFrame: Collapsed prevalence data.
         """
-        mean_prevalence_diff_6m = merged_data.groupby('symptom')['prevalence_diff_6m'].mean().reset_index()
-        merged_data = merged_data.merge(mean_prevalence_diff_6m, on='symptom', suffixes=('', '_mean'))
-        merged_data['prevalence_diff_6m'] = merged_data['prevalence_diff_6m_mean']
-        merged_data = self._separate_and_drop_columns(merged_data)
-        collapsed = merged_data.groupby('symptom').agg({'prevalence_diff_6m': 'first', 'prevalence_diff_12m': 'first', 'prevalence_diff_18m': 'first'}).reset_index()
-        return collapsed
-
-    def _separate_and_drop_columns(self, merged_data):
-        """
-        Separates and drops unnecessary columns from the merged data.
-
-        Parameters:
-        merged_data (pd.DataFrame): Merged prevalence data.
-
-        Returns:
-        pd.DataFrame: Data with separated and dropped columns.
-        """
-        merged_data['prevalence_diff_12m'] = merged_data.apply(lambda row: row['prevalence_diff_2nd'] if row['months_2nd_period'] == 12 else None, axis=1)
-        merged_data['prevalence_diff_18m'] = merged_data.apply(lambda row: row['prevalence_diff_2nd'] if row['months_2nd_period'] == 18 else None, axis=1)
-        return merged_data.drop(columns=['cohort_period', 'months_2nd_period', 'prevalence_diff_2nd', 'prevalence_diff_6m_mean'])
+        collapsed = prevalence_diff.pivot_table(index='symptom', columns='months', values='prevalence_diff', aggfunc='mean')
+        collapsed = collapsed.sort_index(axis=1)
+        collapsed.columns = [f'prevalence_diff_{months}m' for months in collapsed.columns]
+        return collapsed.reset_index()
 
 class SymptomPrevalenceDataAdjuster:
     def __init__(self, prevalence_data):
         """
         Initializes the PrevalenceDataAdjuster with the given data.
 
+        The adjustments apply to every 'prevalence_diff_<months>m' column present, in order of
+        months, e.g. 6, 12 and 18 months.
+
         Parameters:
         prevalence_data (pd.DataFrame): DataFrame containing prevalence data.
         """
         self.prevalence_data = prevalence_data
-        self.col_6m = 'prevalence_diff_6m'
-        self.col_12m = 'prevalence_diff_12m'
-        self.col_18m = 'prevalence_diff_18m'
+        self.month_columns = month_columns(prevalence_data)
 
     def adjust_data(self, method='conservative'):
         """
@@ -154,15 +178,13 @@ class SymptomPrevalenceDataAdjuster:
 
     def _apply_conservative_adjustment(self):
         """
-        Applies a conservative adjustment to the prevalence data.
+        Applies a conservative adjustment to the prevalence data: no time point may exceed an earlier one.
 
         Returns:
         pd.DataFrame: Adjusted prevalence data.
         """
         adjusted = self.prevalence_data.copy()
-        for col_higher, col_lower in [(self.col_18m, self.col_12m), 
-                                      (self.col_12m, self.col_6m), 
-                                      (self.col_18m, self.col_12m)]:
+        for col_lower, col_higher in zip(self.month_columns, self.month_columns[1:]):
             adjusted[col_higher] = adjusted[[col_lower, col_higher]].min(axis=1)
         return adjusted
 
@@ -176,27 +198,210 @@ class SymptomPrevalenceDataAdjuster:
         adjusted = self.prevalence_data.copy()
         adjusted = self._apply_mean_adjustment(adjusted)
         adjusted = self._ensure_non_decreasing_trend(adjusted)
-        return adjusted.drop(columns=[
-            'mean_all', 
-            'mean_prevalence_diff_12m_prevalence_diff_18m', 
-            'mean_prevalence_diff_6m_prevalence_diff_12m'
-        ])
+        return adjusted.drop(columns=['mean_all'] + [f'mean_{earlier}_{later}' for earlier, later in self._consecutive_pairs()])
+
+    def _consecutive_pairs(self):
+        return list(zip(self.month_columns, self.month_columns[1:]))
 
     def _apply_mean_adjustment(self, data):
-        data['mean_all'] = data[[self.col_6m, self.col_12m, self.col_18m]].mean(axis=1)
-        is_non_decreasing = (data[self.col_12m] >= data[self.col_6m]) & (data[self.col_18m] >= data[self.col_12m])
-        data.loc[is_non_decreasing, [self.col_6m, self.col_12m, self.col_18m]] = data['mean_all']
+        data['mean_all'] = data[self.month_columns].mean(axis=1)
+        is_non_decreasing = pd.Series(True, index=data.index)
+        for earlier, later in self._consecutive_pairs():
+            is_non_decreasing &= data[later] >= data[earlier]
+        data.loc[is_non_decreasing, self.month_columns] = data['mean_all']
         return data
 
     def _ensure_non_decreasing_trend(self, data):
-        for pair in [(self.col_12m, self.col_18m), (self.col_6m, self.col_12m)]:
+        # Latest pair first, e.g. (12m, 18m) then (6m, 12m)
+        for pair in reversed(self._consecutive_pairs()):
             mean_col = f'mean_{"_".join(pair)}'
             data[mean_col] = data[list(pair)].mean(axis=1)
-            data.loc[data[pair[1]] >= data[pair[0]], pair] = data[mean_col]
+            data.loc[data[pair[1]] >= data[pair[0]], list(pair)] = data[mean_col]
 
-        data.loc[data[self.col_18m] > data[self.col_12m], [self.col_6m, self.col_12m, self.col_18m]] = data['mean_all']
+        if len(self.month_columns) > 1:
+            data.loc[data[self.month_columns[-1]] > data[self.month_columns[-2]], self.month_columns] = data['mean_all']
         return data
 
+def month_columns(prevalence_data):
+    """'prevalence_diff_<months>m' columns of prepared prevalence data, in order of months."""
+    months = {}
+    for column in prevalence_data.columns:
+        match = re.fullmatch(r'prevalence_diff_(\d+)m', str(column))
+        if match:
+            months[int(match.group(1))] = column
+    return [months[m] for m in sorted(months)]
+
+def _nanmean(*columns):
+    """Elementwise mean of arrays skipping NaN, NaN where all are missing (as pandas' mean)."""
+    stacked = np.stack(columns)
+    valid = ~np.isnan(stacked)
+    counts = valid.sum(axis=0)
+    sums = np.where(valid, stacked, 0).sum(axis=0)
+    return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+def conservative_adjustment(values):
+    """
+    Array version of SymptomPrevalenceDataAdjuster's conservative adjustment.
+
+    Parameters:
+    values (np.ndarray): Prevalence differences with the time points, in order of months, on
+        the last axis.
+
+    Returns:
+    np.ndarray: Adjusted copy of values.
+    """
+    adjusted = np.array(values, dtype=float)
+    for higher in range(1, adjusted.shape[-1]):
+        adjusted[..., higher] = np.fmin(adjusted[..., higher - 1], adjusted[..., higher])
+    return adjusted
+
+def moderate_adjustment(values):
+    """
+    Array version of SymptomPrevalenceDataAdjuster's moderate adjustment.
+
+    Parameters:
+    values (np.ndarray): Prevalence differences with the time points, in order of months, on
+        the last axis.
+
+    Returns:
+    np.ndarray: Adjusted copy of values.
+    """
+    adjusted = np.array(values, dtype=float)
+    columns = [adjusted[..., i] for i in range(adjusted.shape[-1])]  # views into adjusted
+    if len(columns) < 2:
+        return adjusted
+
+    # Mean adjustment
+    mean_all = _nanmean(*columns)
+    is_non_decreasing = np.logical_and.reduce([later >= earlier for earlier, later in zip(columns, columns[1:])])
+    for column in columns:
+        column[is_non_decreasing] = mean_all[is_non_decreasing]
+
+    # Ensure non-decreasing trend, latest pair first
+    for earlier, later in reversed(list(zip(columns, columns[1:]))):
+        pair_mean = _nanmean(earlier, later)
+        not_decreasing = later >= earlier
+        earlier[not_decreasing] = pair_mean[not_decreasing]
+        later[not_decreasing] = pair_mean[not_decreasing]
+
+    increasing = columns[-1] > columns[-2]
+    for column in columns:
+        column[increasing] = mean_all[increasing]
+    return adjusted
+
+def _averaging_matrix(codes, n_groups):
+    """
+    Matrix that averages columns by group: (values @ matrix.T)[:, g] is the mean of the values
+    with code g.
+
+    Returns:
+    Tuple[np.ndarray, np.ndarray]: The (n_groups, len(codes)) matrix, and which groups are non-empty.
+    """
+    matrix = np.zeros((n_groups, len(codes)))
+    matrix[codes, np.arange(len(codes))] = 1
+    counts = matrix.sum(axis=1)
+    return matrix / np.maximum(counts, 1)[:, None], counts > 0
+
+class SymptomPrevalenceBootstrap:
+    def __init__(self, file_path, n_replicates=2000, seed=None, first_period_months=6):
+        """
+        Binomial bootstrap of the prepared prevalence data.
+
+        Every reported percentage is redrawn as a binomial proportion with its period's sample
+        size ('n_1st_period' or 'n_2nd_period'), for all replicates at once. The cohort and
+        study averaging of SymptomPrevalenceDataPreparer only depends on the layout of the
+        data, so it is built once as averaging matrices and applied to all replicates with two
+        matrix products.
+
+        Parameters:
+        file_path (str or list): As for SymptomPrevalenceDataPreparer.
+        n_replicates (int): Number of bootstrap replicates.
+        seed (int): Seed for the resampling.
+        first_period_months (int): As for SymptomPrevalenceDataPreparer.
+        """
+        self.file_path = file_path
+        self.n_replicates = n_replicates
+        self.rng = np.random.default_rng(seed)
+        self.first_period_months = first_period_months
+        self.symptoms = None
+        self.months = None
+        self.replicates = None
+
+    def _load_observations(self):
+        preparer = SymptomPrevalenceDataPreparer(self.file_path, first_period_months=self.first_period_months)
+        cleaned_data = preparer._clean_and_subset_data(preparer._load_data(), keep_counts=True)
+        return preparer._stack_periods(cleaned_data).reset_index(drop=True)
+
+    def resample(self, observations):
+        """
+        Draws bootstrap percentages of every observation.
+
+        Returns:
+        np.ndarray: Percentages, (n_replicates, n_observations).
+        """
+        n = observations['n'].to_numpy(dtype=int)
+        proportion = np.clip(observations['percentage'].to_numpy(dtype=float) / 100, 0, 1)
+        counts = self.rng.binomial(n, proportion, size=(self.n_replicates, len(observations)))
+        return 100 * counts / np.maximum(n, 1)
+
+    def prevalence_differences(self, observations, percentages):
+        """
+        Symptomatic minus asymptomatic prevalence, averaged over cohorts, for every replicate.
+
+        Matches SymptomPrevalenceDataPreparer._calculate_prevalence_differences and
+        _collapse_prevalence_data applied to each replicate's percentages.
+
+        Returns:
+        np.ndarray: Prevalence differences, (n_replicates, n_symptoms, n_months), NaN where a
+        symptom has no observations at a time point.
+        """
+        # Mean percentage per cohort, time point and symptomatic group
+        cell_columns = ['study', 'cohort_period', 'symptom', 'months', 'symptomatic']
+        cell_codes = observations.groupby(cell_columns, sort=True).ngroup().to_numpy()
+        cells = observations[cell_columns].drop_duplicates().sort_values(cell_columns).reset_index(drop=True)
+        cell_average, _ = _averaging_matrix(cell_codes, len(cells))
+        cell_means = percentages @ cell_average.T
+
+        # Pair symptomatic with asymptomatic cells; unpaired cells have no difference
+        cells['cell'] = np.arange(len(cells))
+        pairs = cells[cells['symptomatic'] == 1].merge(
+            cells[cells['symptomatic'] == 0], on=cell_columns[:-1], suffixes=('_symptomatic', '_asymptomatic')
+            )
+        differences = cell_means[:, pairs['cell_symptomatic'].to_numpy()] - cell_means[:, pairs['cell_asymptomatic'].to_numpy()]
+
+        # Mean difference over cohorts per symptom and time point
+        self.symptoms = sorted(pairs['symptom'].unique())
+        self.months = sorted(pairs['months'].unique())
+        symptom_codes = pd.Categorical(pairs['symptom'], categories=self.symptoms).codes
+        month_codes = pd.Categorical(pairs['months'], categories=self.months).codes
+        collapse, has_data = _averaging_matrix(symptom_codes * len(self.months) + month_codes, len(self.symptoms) * len(self.months))
+        collapsed = differences @ collapse.T
+        collapsed[:, ~has_data] = np.nan
+        return collapsed.reshape(self.n_replicates, len(self.symptoms), len(self.months))
+
+    def run(self, adjustment_method='conservative'):
+        """
+        Resamples, prepares and adjusts the data for all replicates.
+
+        Parameters:
+        adjustment_method (str): 'conservative' or 'moderate', applied to the differences at
+            all of self.months as in SymptomPrevalenceDataAdjuster.
+
+        Returns:
+        np.ndarray: Adjusted prevalence differences in percent, (n_replicates, n_symptoms,
+        n_months), for self.symptoms and self.months.
+        """
+        adjustments = {'conservative': conservative_adjustment, 'moderate': moderate_adjustment}
+        if adjustment_method not in adjustments:
+            raise ValueError("Method must be either 'conservative' or 'moderate'.")
+
+        observations = self._load_observations()
+        replicates = self.prevalence_differences(observations, self.resample(observations))
+
+        # self.months is sorted, so the last axis is already in order of months
+        self.replicates = adjustments[adjustment_method](replicates)
+        return self.replicates
+
 class SymptomPrevalenceDataProcessor:
     def __init__(self, file_path):
         """
@@ -225,3 +430,14 @@ class SymptomPrevalenceDataProcessor:
 
         return adjusted_data
 
+    def bootstrap(self, n_replicates=2000, adjustment_method='conservative', seed=None):
+        """
+        Processes binomial bootstrap replicates of the data, see SymptomPrevalenceBootstrap.
+
+        Returns:
+        SymptomPrevalenceBootstrap: With the adjusted replicates, symptoms and months.
+        """
+        bootstrap = SymptomPrevalenceBootstrap(self.file_path, n_replicates=n_replicates, seed=seed)
+        bootstrap.run(adjustment_method=adjustment_method)
+        return bootstrap
+
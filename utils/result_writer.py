@@ -0,0 +1,215 @@
+import glob
+import json
+import os
+import queue
+import re
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+
+class SimulationResultWriter:
+    def __init__(self, output_dir, max_queue_size=2):
+        """
+        Writes simulation results to disk on a background thread.
+
+        Each result becomes one `simulation_<id>` partition directory with one .npy file per
+        column, so readers can memory-map it and read only some rows or columns. At
+        most `max_queue_size` results wait in the queue; put() blocks beyond that, so the
+        simulations slow down to the writer's pace instead of piling up in memory.
+
+        Parameters:
+        output_dir (str): Directory to write the partitions to.
+        max_queue_size (int): Number of results that may wait to be written.
+        """
+        self.output_dir = output_dir
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, simulation_id, result, on_written=None):
+        """
+        Queues a result for writing, blocking while the queue is full.
+
+        `on_written`, if given, is called on the writer thread once the partition is in place,
+        e.g. to remove checkpoints that the partition supersedes.
+        """
+        self._raise_error()
+        self.queue.put((simulation_id, result, on_written))
+
+    def flush(self):
+        """Blocks until every queued result has been written."""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Writes the remaining results and stops the writer thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("Writing simulation results failed.") from self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                # After a failure, keep draining the queue so producers never block forever
+                if self.error is None:
+                    simulation_id, result, on_written = item
+                    self._write(simulation_id, result)
+                    if on_written is not None:
+                        on_written()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, simulation_id, result):
+        self.write_partition(self.output_dir, simulation_id, result)
+
+    @staticmethod
+    def partition_path(output_dir, simulation_id):
+        """Path of the partition of one simulation."""
+        return os.path.join(output_dir, f'simulation_{simulation_id}')
+
+    @staticmethod
+    def partition_paths(output_dir):
+        """
+        Complete partitions in `output_dir`, by simulation id.
+
+        Returns:
+        dict: Simulation id to partition path, in simulation order.
+        """
+        paths = {}
+        for path in glob.glob(os.path.join(output_dir, 'simulation_*')):
+            match = re.search(r'simulation_(\d+)$', path)
+            if match and os.path.isdir(path):
+                paths[int(match.group(1))] = path
+        return dict(sorted(paths.items()))
+
+    @classmethod
+    def write_partition(cls, output_dir, simulation_id, result):
+        """
+        Writes one partition to a temporary directory and moves it into place once complete.
+
+        The index and the original type of nullable object columns, such as 'current_strain',
+        are recorded too, so read_partition returns a frame equal to `result`.
+        """
+        path = cls.partition_path(output_dir, simulation_id)
+        tmp_path = f'{path}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        object_columns, integer_columns = [], []
+        for i, column in enumerate(result.columns):
+            array = cls._column_to_array(result[column])
+            if result[column].dtype == object and array.dtype == float:
+                object_columns.append(str(column))
+                if pd.api.types.infer_dtype(result[column], skipna=True) == 'integer':
+                    integer_columns.append(str(column))
+            np.save(os.path.join(tmp_path, f'{i}.npy'), array)
+        has_index = not result.index.equals(pd.RangeIndex(len(result)))
+        if has_index:
+            np.save(os.path.join(tmp_path, 'index.npy'), result.index.to_numpy())
+        with open(os.path.join(tmp_path, 'columns.json'), 'w') as f:
+            json.dump({
+                'columns': [str(column) for column in result.columns],
+                'n_rows': len(result),
+                'object_columns': object_columns,
+                'integer_columns': integer_columns,
+                'has_index': has_index
+            }, f)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _column_to_array(column):
+        """Converts a column to a plain NumPy array, turning nullable object columns into floats."""
+        if column.dtype != object:
+            return column.to_numpy()
+        try:
+            return pd.to_numeric(column).to_numpy(dtype=float, na_value=np.nan)
+        except (TypeError, ValueError):
+            return column.astype(str).to_numpy()
+
+    @staticmethod
+    def _metadata(path):
+        with open(os.path.join(path, 'columns.json')) as f:
+            return json.load(f)
+
+    @classmethod
+    def partition_columns(cls, path):
+        """Column names and number of rows of one partition."""
+        metadata = cls._metadata(path)
+        return metadata['columns'], metadata['n_rows']
+
+    @staticmethod
+    def _restore_object_column(array, integer):
+        """Turns a float column written by _column_to_array back into objects, with pd.NA for missing values."""
+        missing = np.isnan(array)
+        values = array.astype(object)
+        if integer:
+            values[~missing] = array[~missing].astype(np.int64).astype(object)
+        values[missing] = pd.NA
+        return values
+
+    @classmethod
+    def read_partition(cls, path, rows=None, columns=None):
+        """
+        Reads one partition written by the writer.
+
+        The column files are memory-mapped, so only the requested rows and columns are read.
+
+        Parameters:
+        path (str): Partition directory.
+        rows (slice): Rows to read; all rows if None.
+        columns (list): Columns to read; all columns if None.
+
+        Returns:
+        pd.DataFrame: The simulation result, or the requested part of it.
+        """
+        metadata = cls._metadata(path)
+        all_columns = metadata['columns']
+        rows = slice(None) if rows is None else rows
+        data = {}
+        for column in (all_columns if columns is None else columns):
+            array = np.array(np.load(os.path.join(path, f'{all_columns.index(column)}.npy'), mmap_mode='r')[rows])
+            if column in metadata.get('object_columns', []):
+                array = cls._restore_object_column(array, column in metadata['integer_columns'])
+            data[column] = array
+        index = None
+        if metadata.get('has_index'):
+            index = np.array(np.load(os.path.join(path, 'index.npy'), mmap_mode='r')[rows])
+        elif rows != slice(None):
+            index = pd.RangeIndex(metadata['n_rows'])[rows]
+        return pd.DataFrame(data, index=index)
+
+    @classmethod
+    def read_all(cls, output_dir):
+        """
+        Reads all complete partitions in simulation order, adding a 'simulation' column.
+
+        Returns:
+        pd.DataFrame: Combined results.
+        """
+        partitions = []
+        for simulation_id, path in cls.partition_paths(output_dir).items():
+            partition = cls.read_partition(path)
+            partition['simulation'] = simulation_id
+            partitions.append(partition)
+        return pd.concat(partitions, ignore_index=True)
@@ -0,0 +1,366 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import squigglepy as sq
+
+import utils.parameters as params
+from utils.process_daly_adjustments import DalyDataProcessor
+from utils.simulate_long_covid_cases import LongCovidSimulator
+from utils.merge_data_with_simulations import DataSimulationsMerger
+from utils.posterior_store import PosteriorDrawStore
+
+DISTRIBUTIONS = {'norm': sq.norm, 'beta': sq.beta, 'lognorm': sq.lognorm, 'uniform': sq.uniform}
+
+def parse_overrides(overrides):
+    """
+    Converts JSON parameter overrides into simulation parameters.
+
+    Numbers are used as fixed values, {"distribution": "norm", "mean": ..., "sd": ...} style
+    objects become squigglepy distributions, and initial_vaccination_distribution keys
+    become ints.
+    """
+    parsed = {}
+    for key, value in overrides.items():
+        if key == 'initial_vaccination_distribution':
+            parsed[key] = {int(count): probability for count, probability in value.items()}
+        elif isinstance(value, dict) and 'distribution' in value:
+            arguments = {k: v for k, v in value.items() if k != 'distribution'}
+            parsed[key] = DISTRIBUTIONS[value['distribution']](**arguments)
+        else:
+            parsed[key] = value
+    return parsed
+
+def simulate_weekly_totals(overrides, years, n_simulations, seed, simulation_id, df_symptom_integrals, data_daly):
+    """
+    Runs one simulation of a scenario and reduces it to weekly long COVID cases and DALY loss.
+
+    Every worker draws the same parameter table from `seed`, so simulation `simulation_id`
+    is the same as in a single-process run of the scenario.
+    """
+    simulator = LongCovidSimulator(
+        params={**params.default_params, **parse_overrides(overrides)},
+        years=years,
+        n_simulations=n_simulations,
+        verbose=False,
+        seed=seed
+        )
+    df_simulation = simulator.run_one_simulation(simulation_id=simulation_id)
+    weeks = np.sort(df_simulation['week_start'].unique())
+
+    merger = DataSimulationsMerger(df_simulation, df_symptom_integrals, data_daly)
+    df_merged = merger.calculate_welfare_loss(seed=[seed, simulation_id])
+    weight = df_merged['weight'] if 'weight' in df_merged else 1
+    return pd.DataFrame({
+        'cases': (df_merged['has_long_covid'] * weight).groupby(df_merged['week_start']).sum(),
+        'DALY_loss': df_merged.groupby('week_start')['DALY_loss'].sum()
+    }).reindex(weeks, fill_value=0)
+
+
+class ScenarioService:
+    def __init__(
+            self,
+            df_symptom_integrals,
+            data_daly,
+            cache_dir='temp/scenario_cache',
+            max_memory_entries=64,
+            max_disk_entries=1024,
+            n_workers=None
+            ):
+        """
+        Runs parameter scenarios on a worker pool and caches their aggregate results.
+
+        Requests are identified by a hash of their parameter overrides, years, number of
+        simulations and seed, and of the posterior draws and DALY data they are run with, so
+        results cached before a new fit or DALY update are not served. Identical requests
+        share one run; finished results are kept in an in-memory LRU cache backed by an
+        LRU-evicted directory of JSON files, and leave the job table once cached.
+
+        Parameters:
+        df_symptom_integrals (pd.DataFrame or PosteriorDrawStore): Posterior symptom integrals; a
+            saved store is reopened by the workers instead of being copied to them.
+        data_daly (pd.DataFrame): Processed DALY data.
+        cache_dir (str): Directory for cached results.
+        max_memory_entries (int): Number of results kept in memory.
+        max_disk_entries (int): Number of results kept on disk.
+        n_workers (int): Number of simulation worker processes.
+        """
+        self.df_symptom_integrals = df_symptom_integrals
+        self.data_daly = data_daly
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        # Workers start from the threaded HTTP server, where forking could deadlock
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'))
+
+        # Reentrant, since done callbacks of already finished futures run inside submit()
+        self.lock = threading.RLock()
+        self.memory_cache = OrderedDict()
+        self.jobs = {}
+        self.inputs_fingerprint = self.fingerprint_inputs(df_symptom_integrals, data_daly)
+
+    @staticmethod
+    def fingerprint_inputs(df_symptom_integrals, data_daly):
+        """Hash of the posterior draws and DALY data every scenario is run with."""
+        daly_hash = hashlib.sha256(pd.util.hash_pandas_object(data_daly, index=True).to_numpy().tobytes()).hexdigest()
+        return f"{PosteriorDrawStore.coerce(df_symptom_integrals).fingerprint()}:{daly_hash}"
+
+    def scenario_key(self, scenario):
+        """Hash of the canonical JSON form of a scenario and of the service's inputs."""
+        payload = json.dumps({'scenario': scenario, 'inputs': self.inputs_fingerprint}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def normalize_scenario(request):
+        """Fills in defaults and validates a scenario request."""
+        scenario = {
+            'overrides': request.get('overrides', {}),
+            'years': int(request.get('years', 1)),
+            'n_simulations': int(request.get('n_simulations', 10)),
+            'seed': int(request.get('seed', 0))
+        }
+        unknown = set(scenario['overrides']) - set(params.default_params) - {'n_agents', 'agent_oversampling'}
+        if unknown:
+            raise ValueError(f"Unknown parameters: {sorted(unknown)}.")
+        if scenario['years'] < 1 or scenario['n_simulations'] < 1:
+            raise ValueError("years and n_simulations must be positive.")
+        parse_overrides(scenario['overrides'])
+        return scenario
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def get_cached(self, key):
+        """Looks a result up in memory, then on disk. Must be called with the lock held."""
+        if key in self.memory_cache:
+            self.memory_cache.move_to_end(key)
+            return self.memory_cache[key]
+        path = self._cache_path(key)
+        if os.path.exists(path):
+            with open(path) as f:
+                result = json.load(f)
+            os.utime(path)  # Mark as recently used for disk eviction
+            self._remember(key, result)
+            return result
+        return None
+
+    def _remember(self, key, result):
+        self.memory_cache[key] = result
+        self.memory_cache.move_to_end(key)
+        while len(self.memory_cache) > self.max_memory_entries:
+            self.memory_cache.popitem(last=False)
+
+    def _store(self, key, result):
+        """Caches a result in memory and on disk, evicting the least recently used files."""
+        self._remember(key, result)
+        path = self._cache_path(key)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(result, f)
+        os.replace(f'{path}.tmp', path)
+
+        cached_files = sorted(
+            (os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.json')),
+            key=os.path.getmtime
+        )
+        for stale_path in cached_files[:max(len(cached_files) - self.max_disk_entries, 0)]:
+            os.remove(stale_path)
+
+    def submit(self, request):
+        """
+        Returns the status of a scenario, starting a run unless it is cached or already running.
+
+        Returns:
+        dict: Job status with 'key', 'status', 'completed', 'total' and, once done, 'result'.
+        """
+        scenario = self.normalize_scenario(request)
+        key = self.scenario_key(scenario)
+        with self.lock:
+            cached = self.get_cached(key)
+            if cached is None:
+                if key not in self.jobs or self.jobs[key]['status'] == 'failed':
+                    self._start_job(key, scenario)
+                if key in self.jobs:
+                    return self._job_status(key)
+                # Every simulation finished while the job was being started
+                cached = self.get_cached(key)
+            return {'key': key, 'status': 'done', 'completed': scenario['n_simulations'], 'total': scenario['n_simulations'], 'result': cached}
+
+    def _start_job(self, key, scenario):
+        job = {
+            'status': 'running',
+            'completed': 0,
+            'total': scenario['n_simulations'],
+            'results': {},
+            'result': None,
+            'error': None,
+            'futures': []
+        }
+        self.jobs[key] = job
+        for simulation_id in range(scenario['n_simulations']):
+            future = self.executor.submit(
+                simulate_weekly_totals, scenario['overrides'], scenario['years'], scenario['n_simulations'],
+                scenario['seed'], simulation_id, self.df_symptom_integrals, self.data_daly
+                )
+            job['futures'].append(future)
+            future.add_done_callback(
+                lambda future, simulation_id=simulation_id: self._on_simulation_done(key, job, simulation_id, future)
+                )
+
+    def _on_simulation_done(self, key, job, simulation_id, future):
+        with self.lock:
+            if job['status'] != 'running':
+                return
+            try:
+                job['results'][simulation_id] = future.result()
+            except Exception as e:
+                logging.error('Scenario %s failed: %s', key, e)
+                job['status'], job['error'], job['results'] = 'failed', str(e), {}
+                for pending in job['futures']:
+                    pending.cancel()
+                return
+            job['completed'] += 1
+            if job['completed'] == job['total']:
+                job['result'] = self.aggregate(job['results'])
+                job['results'], job['futures'] = {}, []
+                job['status'] = 'done'
+                self._store(key, job['result'])
+                # The cache holds the result from here on, under its LRU limits
+                del self.jobs[key]
+
+    @staticmethod
+    def aggregate(results):
+        """
+        Summarises per-simulation weekly totals into mean and 90% band curves.
+
+        Returns:
+        dict: Week start dates with mean weekly cases and mean, 5th and 95th percentile
+        cumulative DALY loss across simulations.
+        """
+        weeks = results[0].index
+        cases = np.stack([results[i]['cases'].to_numpy() for i in sorted(results)])
+        cumulative_loss = np.cumsum(np.stack([results[i]['DALY_loss'].to_numpy() for i in sorted(results)]), axis=1)
+        return {
+            'week_start': [str(pd.Timestamp(week).date()) for week in weeks],
+            'mean_weekly_cases': cases.mean(axis=0).tolist(),
+            'mean_cumulative_daly_loss': cumulative_loss.mean(axis=0).tolist(),
+            'p5_cumulative_daly_loss': np.percentile(cumulative_loss, 5, axis=0).tolist(),
+            'p95_cumulative_daly_loss': np.percentile(cumulative_loss, 95, axis=0).tolist()
+        }
+
+    def _job_status(self, key):
+        job = self.jobs[key]
+        status = {'key': key, 'status': job['status'], 'completed': job['completed'], 'total': job['total']}
+        if job['status'] == 'done':
+            status['result'] = job['result']
+        if job['status'] == 'failed':
+            status['error'] = job['error']
+        return status
+
+    def status(self, key):
+        """Status of a submitted or cached scenario, or None if unknown."""
+        with self.lock:
+            if key in self.jobs:
+                return self._job_status(key)
+            cached = self.get_cached(key)
+            if cached is not None:
+                return {'key': key, 'status': 'done', 'result': cached}
+            return None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ScenarioRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of ScenarioService.
+
+    POST /scenarios            submit a scenario, returns its status (with result if cached)
+    GET  /scenarios/<key>      status of a scenario
+    GET  /scenarios/<key>/progress  newline-delimited JSON status updates until the run ends
+    """
+    service = None
+    progress_interval = 1.0
+
+    def _send_json(self, code, body):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/scenarios':
+            return self._send_json(404, {'error': 'Not found'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            status = self.service.submit(request)
+        except (ValueError, TypeError, KeyError) as e:
+            return self._send_json(400, {'error': str(e)})
+        self._send_json(200 if status['status'] == 'done' else 202, status)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) < 2 or parts[0] != 'scenarios':
+            return self._send_json(404, {'error': 'Not found'})
+        key = parts[1]
+        status = self.service.status(key)
+        if status is None:
+            return self._send_json(404, {'error': f'Unknown scenario {key}'})
+        if len(parts) == 2:
+            return self._send_json(200, status)
+
+        # Stream progress; the response ends when the connection closes
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        while True:
+            status = self.service.status(key)
+            finished = status['status'] in ('done', 'failed')
+            line = {k: v for k, v in status.items() if k != 'result'} if not finished else status
+            self.wfile.write((json.dumps(line) + '\n').encode())
+            self.wfile.flush()
+            if finished:
+                return
+            time.sleep(self.progress_interval)
+
+
+def serve(host='127.0.0.1', port=8050, n_workers=None, integrals_path='temp/posterior_draws', daly_path='data/daly.csv'):
+    """
+    Starts the scenario service using the posterior integrals saved by main.py, either the
+    posterior draw store directory or a pickled DataFrame of integrals.
+    """
+    if os.path.isdir(integrals_path):
+        df_symptom_integrals = PosteriorDrawStore.load(integrals_path)
+    else:
+        df_symptom_integrals = pd.read_pickle(integrals_path)
+    data_daly = DalyDataProcessor(daly_path).process_data()
+
+    ScenarioRequestHandler.service = ScenarioService(df_symptom_integrals, data_daly, n_workers=n_workers)
+    server = ThreadingHTTPServer((host, port), ScenarioRequestHandler)
+    logging.info('Scenario service listening on %s:%s.', host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        ScenarioRequestHandler.service.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve DALY-loss scenario queries.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--workers', type=int, default=None, help='Number of simulation worker processes')
+    args = parser.parse_args()
+    serve(host=args.host, port=args.port, n_workers=args.workers)
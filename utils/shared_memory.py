@@ -0,0 +1,84 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+class SharedArrays:
+    def __init__(self):
+        """
+        Named NumPy arrays backed by shared memory blocks.
+
+        The owning process creates the arrays; other processes attach to them through the
+        picklable `handle` without copying. The owner is responsible for calling close().
+        """
+        self.blocks = {}
+        self.arrays = {}
+
+    def create(self, name, shape, dtype):
+        """
+        Allocates an uninitialised shared array.
+
+        Parameters:
+        name (str): Name of the array.
+        shape (tuple): Shape of the array.
+        dtype (str or np.dtype): Data type of the array.
+
+        Returns:
+        np.ndarray: View on the shared memory block.
+        """
+        dtype = np.dtype(dtype)
+        n_bytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        block = shared_memory.SharedMemory(create=True, size=n_bytes)
+        self.blocks[name] = block
+        self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        return self.arrays[name]
+
+    def share(self, name, array):
+        """
+        Copies an existing array into shared memory.
+
+        Returns:
+        np.ndarray: View on the shared memory block.
+        """
+        array = np.asarray(array)
+        shared = self.create(name, array.shape, array.dtype)
+        shared[...] = array
+        return shared
+
+    @property
+    def handle(self):
+        """Picklable description of the arrays, passed to attach() in other processes."""
+        return {
+            name: (self.blocks[name].name, array.shape, array.dtype.str)
+            for name, array in self.arrays.items()
+        }
+
+    @staticmethod
+    def attach(handle, readonly=True):
+        """
+        Attaches to arrays created in another process.
+
+        Parameters:
+        handle (dict): The `handle` of the owning SharedArrays.
+        readonly (bool): Whether to mark the returned arrays as read-only.
+
+        Returns:
+        Tuple[dict, list]: Arrays by name, and the attached blocks, which must stay referenced
+        while the arrays are in use and be closed (not unlinked) afterwards.
+        """
+        arrays, blocks = {}, []
+        for name, (block_name, shape, dtype) in handle.items():
+            # Workers share the owner's resource tracker, so the block stays registered to the
+            # owner, which alone unlinks it
+            block = shared_memory.SharedMemory(name=block_name)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            array.flags.writeable = not readonly
+            arrays[name] = array
+            blocks.append(block)
+        return arrays, blocks
+
+    def close(self):
+        """Releases and unlinks all blocks. Arrays from this object must not be used afterwards."""
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
@@ -3,33 +3,63 @@ import numpy as np
 from datetime import datetime
 import squigglepy as sq
 import concurrent.futures
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+from utils.shared_memory import SharedArrays
+from utils.result_writer import SimulationResultWriter
+
+def _atomic_pickle_dump(obj, path):
+    """Pickle `obj` to a temporary file and move it into place, so readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def _week_partition_dir(checkpoint_path):
+    """Directory of the weekly output partitions that belong to a simulation checkpoint."""
+    return f"{os.path.splitext(checkpoint_path)[0]}_weeks"
+
+default_population_params = {
+    'size': 330_000, 
+    'baseline_risk': sq.norm(mean = 0.15, sd = 0.01), 
+    'infection_rate': sq.norm(mean=(19/330)/52, sd=0.0001),
+    'strain_reduction_factor': sq.norm(mean=0.6, sd=0.1), 
+    'total_strains': 10, 
+    'current_strain': 1, 
+    'strain_decay': 50,
+    'initial_vaccination_distribution': {0: 0.2, 1: 0.2, 2: 0.3, 3:0.2, 4:0.1},
+    'vaccination_reduction': sq.beta(100*0.25, 100*(1-0.25)), 
+    'vaccination_interval': 180, 
+    'vaccination_effectiveness_halflife': 1/365, 
+    'vaccination_hazard_rate': sq.beta(1000*0.01, 1000*(1-0.01)),
+    'aor_value': sq.beta(100*0.72, 100*(1-0.72))
+}
 
 class Population:
     def __init__(
             self, 
-            params = {
-                'size': 330_000, 
-                'baseline_risk': sq.norm(mean = 0.15, sd = 0.01), 
-                'infection_rate': sq.norm(mean=(19/330)/52, sd=0.0001),
-                'strain_reduction_factor': sq.norm(mean=0.6, sd=0.1), 
-                'total_strains': 10, 
-                'current_strain': 1, 
-                'strain_decay': 50,
-                'initial_vaccination_distribution': {0: 0.2, 1: 0.2, 2: 0.3, 3:0.2, 4:0.1},
-                'vaccination_reduction': sq.beta(100*0.25, 100*(1-0.25)), 
-                'vaccination_interval': 180, 
-                'vaccination_effectiveness_halflife': 1/365, 
-                'vaccination_hazard_rate': sq.beta(1000*0.01, 1000*(1-0.01)),
-                'aor_value': sq.beta(100*0.72, 100*(1-0.72))
-            },
-            verbose=True
+            params = default_population_params,
+            verbose=True,
+            start_date=None
             ):
         """
         Initialize the population DataFrame.
+
+        If params contains 'n_agents', the population of 'size' individuals is represented by
+        n_agents weighted agents instead (see initialize_weighted_vaccination_counts).
+        The simulation starts on `start_date`, by default today.
         """
         param_values = self.get_param_values(params)
 
-        self.size = param_values['size']
+        self.population_size = param_values['size']
+        self.n_agents = param_values.get('n_agents')
+        self.agent_oversampling = param_values.get('agent_oversampling') or {}
+        self.size = self.population_size if self.n_agents is None else int(self.n_agents)
         self.baseline_risk = param_values['baseline_risk']
         self.infection_rate = param_values['infection_rate']
         self.total_strains = param_values['total_strains']
@@ -45,12 +75,18 @@ class Population:
 
         self.verbose = verbose
 
-        self.current_date = pd.Timestamp(datetime.now().date())
+        self.current_date = pd.Timestamp(start_date if start_date is not None else datetime.now().date()).normalize()
+
+        if self.n_agents is None:
+            vaccination_counts, weights = self.initialize_vaccination_counts(), np.ones(self.size)
+        else:
+            vaccination_counts, weights = self.initialize_weighted_vaccination_counts()
 
         self.data = pd.DataFrame({
             'individual_id': range(self.size),
+            'weight': weights,
             'covid_infections': np.zeros(self.size),
-            'vaccination_count': self.initialize_vaccination_counts(),
+            'vaccination_count': vaccination_counts,
             'last_vaccination_date': np.full(self.size, self.current_date - pd.Timedelta(days=self.vaccination_interval)),
             'current_strain': pd.Series([pd.NA] * self.size),
             'long_covid_risk': np.full(self.size, self.baseline_risk),
@@ -69,15 +105,62 @@ class Population:
                 # If not a distribution, use the scalar value
                 param_values[key] = value
         return param_values
+
+    @staticmethod
+    def sample_param_table(params, n_simulations):
+        """
+        Draw all simulations' values of every distribution in `params` up front.
+
+        Each distribution is sampled once with `n_simulations` draws; scalar and dictionary
+        parameters are left out since they do not vary between simulations.
+
+        Returns:
+        pd.DataFrame: One row per simulation, one column per sampled parameter.
+        """
+        draws = {}
+        for key, value in params.items():
+            try:
+                draws[key] = np.atleast_1d(value @ n_simulations)
+            except (TypeError, ValueError):
+                continue
+        return pd.DataFrame(draws, index=pd.RangeIndex(n_simulations, name='simulation'))
     
+    def get_vaccination_distribution(self):
+        # Either a {count: probability} dict, or a (counts, probabilities) pair of arrays
+        if isinstance(self.initial_vaccination_distribution, dict):
+            values = list(self.initial_vaccination_distribution.keys())
+            probabilities = list(self.initial_vaccination_distribution.values())
+        else:
+            values, probabilities = self.initial_vaccination_distribution
+        return np.asarray(values), np.asarray(probabilities, dtype=float)
+
     def initialize_vaccination_counts(self):
+        values, probabilities = self.get_vaccination_distribution()
         counts = np.random.choice(
-            a=list(self.initial_vaccination_distribution.keys()), 
-            p=list(self.initial_vaccination_distribution.values()), 
+            a=values, 
+            p=probabilities, 
             size=self.size
         )
         return counts
 
+    def initialize_weighted_vaccination_counts(self):
+        """
+        Draw vaccination counts for weighted agents, oversampling some vaccination strata.
+
+        Agents are drawn with stratum probabilities proportional to the population share times
+        `agent_oversampling[count]` (default 1), and weighted by population share over agent
+        share, so that weighted totals estimate totals over the full population of `size`.
+
+        :return: Vaccination counts and sampling weights of the agents.
+        """
+        values, probabilities = self.get_vaccination_distribution()
+        oversampling = np.array([self.agent_oversampling.get(value, 1.0) for value in values])
+        agent_probabilities = probabilities * oversampling / (probabilities * oversampling).sum()
+
+        stratum = np.random.choice(len(values), p=agent_probabilities, size=self.size)
+        stratum_weights = probabilities / agent_probabilities * self.population_size / self.size
+        return values[stratum], stratum_weights[stratum]
+
 
     def get_strain_distribution(self, week_data):
         """
@@ -197,15 +280,71 @@ class Population:
         return strain_adjustment
 
 
+# Fixed columnar layout of simulation output in shared memory
+SIMULATION_OUTPUT_COLUMNS = {
+    'individual_id': 'int64',
+    'weight': 'float64',
+    'covid_infections': 'float64',
+    'vaccination_count': 'int64',
+    'last_vaccination_date': 'datetime64[ns]',
+    'current_strain': 'float64',
+    'long_covid_risk': 'float64',
+    'has_long_covid': 'bool',
+    'last_infection_date': 'datetime64[ns]',
+    'aor_adjustment': 'float64',
+    'vaccination_adjustment': 'float64',
+    'strain_adjustment': 'float64',
+    'week_start': 'datetime64[ns]',
+    'simulation': 'int64'
+}
+
+def _write_result_to_arrays(result, arrays, row_offset, simulation_id):
+    """Copies one simulation's output into its rows of the shared output arrays."""
+    rows = slice(row_offset, row_offset + len(result))
+    for column, dtype in SIMULATION_OUTPUT_COLUMNS.items():
+        kind = np.dtype(dtype).kind
+        if column == 'simulation':
+            arrays[column][rows] = simulation_id
+        elif column not in result:
+            arrays[column][rows] = {'f': np.nan, 'M': np.datetime64('NaT')}.get(kind, 0)
+        elif kind == 'M':
+            arrays[column][rows] = pd.to_datetime(result[column]).to_numpy(dtype=dtype)
+        elif kind == 'f':
+            # current_strain holds pd.NA for individuals without a current infection
+            arrays[column][rows] = pd.to_numeric(result[column], errors='coerce').to_numpy(dtype=dtype, na_value=np.nan)
+        else:
+            arrays[column][rows] = result[column].to_numpy(dtype=dtype)
+
+def _run_simulation_into_shared_memory(simulator, simulation_id, row_offset, output_handle, input_handle):
+    """Worker process entry point: runs one simulation and writes it into shared output arrays."""
+    inputs, input_blocks = SharedArrays.attach(input_handle)
+    outputs, output_blocks = SharedArrays.attach(output_handle, readonly=False)
+
+    simulator.params = {
+        **simulator.params, 
+        'initial_vaccination_distribution': (inputs['vaccination_values'], inputs['vaccination_probabilities'])
+        }
+    simulator.save_path = None  # The parent persists the result once the simulation is done
+    result = simulator.run_one_simulation(simulation_id=simulation_id, persist=False)
+    _write_result_to_arrays(result, outputs, row_offset, simulation_id)
+
+    del inputs, outputs, simulator
+    for block in input_blocks + output_blocks:
+        block.close()
+    return simulation_id
+
+
 class Simulation:
     def __init__(self, population, verbose=True):
         self.population = population
         self.weekly_data = population.data
         self.size = population.size
         self.data = []
-        self.current_date = pd.Timestamp(datetime.now().date())
+        self.current_date = population.current_date
         self.weekly_summary = []
         self.verbose = verbose
+        self.partition_dir = None
+        self.persisted_weeks = 0
 
     def simulate_week(self, week_data):
         self.population.reset_long_covid_status()
@@ -219,24 +358,36 @@ class Simulation:
         data['week_start'] = week_data['week_start']
         self.data.append(data)
 
+    def _weighted_mean(self, values):
+        """Mean over individuals weighted by agent weight, skipping missing values."""
+        values = pd.to_numeric(values, errors='coerce')
+        valid = values.notna()
+        if not valid.any():
+            return np.nan
+        return np.average(values[valid], weights=self.weekly_data['weight'][valid])
+
+    def _weighted_count(self, mask):
+        """Number of individuals, in population units, for which mask holds."""
+        return self.weekly_data['weight'][mask].sum()
+
     def record_weekly_statistics(self, week_data):
-        weekly_cases = self.weekly_data['has_long_covid'].sum()
-        avg_infections = self.weekly_data['covid_infections'].mean()
-        infection_distribution_by_strain = self.weekly_data.groupby('current_strain')['covid_infections'].count()
-        avg_days_since_vaccination = (week_data['week_start'] - self.weekly_data['last_vaccination_date']).dt.days.mean()
-        avg_vaccinations = (self.weekly_data['vaccination_count']).mean()
-        avg_long_covid_risk = self.weekly_data['long_covid_risk'].mean()
-        avg_strain = self.weekly_data['current_strain'].mean()
-
-        avg_aor_adjustment = self.weekly_data['aor_adjustment'].mean()
-        avg_vaccination_adjustment = self.weekly_data['vaccination_adjustment'].mean()
-        avg_strain_adjustment = self.weekly_data['strain_adjustment'].mean()
+        weekly_cases = self._weighted_count(self.weekly_data['has_long_covid'])
+        avg_infections = self._weighted_mean(self.weekly_data['covid_infections'])
+        infection_distribution_by_strain = self.weekly_data.groupby('current_strain')['weight'].sum()
+        avg_days_since_vaccination = self._weighted_mean((week_data['week_start'] - self.weekly_data['last_vaccination_date']).dt.days)
+        avg_vaccinations = self._weighted_mean(self.weekly_data['vaccination_count'])
+        avg_long_covid_risk = self._weighted_mean(self.weekly_data['long_covid_risk'])
+        avg_strain = self._weighted_mean(self.weekly_data['current_strain'])
+
+        avg_aor_adjustment = self._weighted_mean(self.weekly_data['aor_adjustment'])
+        avg_vaccination_adjustment = self._weighted_mean(self.weekly_data['vaccination_adjustment'])
+        avg_strain_adjustment = self._weighted_mean(self.weekly_data['strain_adjustment'])
 
         # Counting the number of people with different vaccination counts
-        vac_count_0 = (self.weekly_data['vaccination_count'] == 0).sum()
-        vac_count_1_2 = self.weekly_data['vaccination_count'].between(1, 2).sum()
-        vac_count_3_4 = self.weekly_data['vaccination_count'].between(3, 4).sum()
-        vac_count_4_plus = (self.weekly_data['vaccination_count'] >= 4).sum()
+        vac_count_0 = self._weighted_count(self.weekly_data['vaccination_count'] == 0)
+        vac_count_1_2 = self._weighted_count(self.weekly_data['vaccination_count'].between(1, 2))
+        vac_count_3_4 = self._weighted_count(self.weekly_data['vaccination_count'].between(3, 4))
+        vac_count_4_plus = self._weighted_count(self.weekly_data['vaccination_count'] >= 4)
 
         self.weekly_summary.append({
             'week': week_data['week_start'],
@@ -256,8 +407,90 @@ class Simulation:
             'vaccinations_4_plus': vac_count_4_plus
         })
 
-    def run(self, duration):
-        for week in range(duration):
+    def save_checkpoint(self, path, next_week):
+        """
+        Write population state and RNG state to a binary checkpoint.
+
+        Weekly outputs are not part of the checkpoint; run() writes each week to its own
+        partition before checkpointing, so a checkpoint's size does not grow with the weeks
+        simulated. The file is written to a temporary path first and then moved into place,
+        so an interrupted write never leaves a truncated checkpoint behind.
+        """
+        _atomic_pickle_dump(self._checkpoint_state(next_week), path)
+
+    def _checkpoint_state(self, next_week):
+        return {
+            'next_week': next_week,
+            'current_date': self.current_date,
+            'population_data': self.population.data,
+            'population_params': {
+                key: value for key, value in vars(self.population).items() if key != 'data'
+                },
+            'rng_state': np.random.get_state()
+        }
+
+    def load_checkpoint(self, path):
+        """
+        Restore a checkpoint written by save_checkpoint.
+
+        Returns:
+        int: The first week that still has to be simulated.
+        """
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        self._restore_checkpoint_state(state)
+        return state['next_week']
+
+    def _restore_checkpoint_state(self, state):
+        for key, value in state['population_params'].items():
+            setattr(self.population, key, value)
+        self.population.data = state['population_data']
+        self.weekly_data = self.population.data
+        self.size = self.population.size
+        self.current_date = state['current_date']
+        self.data = []
+        self.weekly_summary = []
+        self.persisted_weeks = state['next_week']
+        np.random.set_state(state['rng_state'])
+
+    def _persist_weeks(self):
+        """Writes each week simulated since the last checkpoint to its own partition and drops it from memory."""
+        os.makedirs(self.partition_dir, exist_ok=True)
+        for data, summary in zip(self.data, self.weekly_summary):
+            week_path = os.path.join(self.partition_dir, f"week_{self.persisted_weeks:05d}.pkl")
+            _atomic_pickle_dump({'data': data, 'summary': summary}, week_path)
+            self.persisted_weeks += 1
+        self.data, self.weekly_summary = [], []
+
+    def _load_persisted_weeks(self):
+        """Puts the weeks written by _persist_weeks back in front of the weeks still in memory."""
+        data, weekly_summary = [], []
+        for week in range(self.persisted_weeks):
+            with open(os.path.join(self.partition_dir, f"week_{week:05d}.pkl"), 'rb') as f:
+                partition = pickle.load(f)
+            data.append(partition['data'])
+            weekly_summary.append(partition['summary'])
+        self.data = data + self.data
+        self.weekly_summary = weekly_summary + self.weekly_summary
+
+    def run(self, duration, checkpoint_path=None, checkpoint_every=None):
+        """
+        Simulate `duration` weeks.
+
+        If `checkpoint_path` is given, a checkpoint is written every `checkpoint_every` weeks
+        and an existing checkpoint at that path is resumed from instead of starting over. The
+        weeks simulated up to a checkpoint are kept in partitions next to it, see
+        _week_partition_dir.
+        """
+        start_week = 0
+        if checkpoint_path is not None:
+            self.partition_dir = _week_partition_dir(checkpoint_path)
+            if os.path.exists(checkpoint_path):
+                start_week = self.load_checkpoint(checkpoint_path)
+                if self.verbose:
+                    print(f"Resuming from checkpoint at week {start_week}")
+
+        for week in range(start_week, duration):
             week_start = self.current_date + pd.Timedelta(weeks=week)
 
             year = week // 52
@@ -267,9 +500,233 @@ class Simulation:
 
             week_data = {'week_start': week_start}
             self.simulate_week(week_data)
-        
+
+            weeks_done = year * 52 + week + 1
+            if checkpoint_path is not None and checkpoint_every and weeks_done % checkpoint_every == 0 and weeks_done < duration:
+                self._persist_weeks()
+                self.save_checkpoint(checkpoint_path, weeks_done)
+
+        if self.persisted_weeks:
+            self._load_persisted_weeks()
         self.data = pd.concat(self.data)
 
+
+# Agents per ChunkedSimulation chunk; small enough that a 330k population keeps about 10 threads busy
+DEFAULT_CHUNK_SIZE = 2**15
+
+# Columns of the population kept as arrays by ChunkedSimulation, in output order
+CHUNKED_POPULATION_COLUMNS = {
+    'individual_id': 'int64',
+    'weight': 'float64',
+    'covid_infections': 'float64',
+    'vaccination_count': 'int64',
+    'last_vaccination_date': 'datetime64[ns]',
+    'current_strain': 'float64',
+    'long_covid_risk': 'float64',
+    'has_long_covid': 'bool',
+    'last_infection_date': 'datetime64[ns]',
+    'aor_adjustment': 'float64',
+    'vaccination_adjustment': 'float64',
+    'strain_adjustment': 'float64'
+}
+
+def _update_chunk(population, arrays, rows, rng, week_start, strain_distribution):
+    """
+    Runs one week of infection, vaccination and long COVID updates on rows of the population.
+
+    Mirrors the Population update methods on plain arrays, drawing from the chunk's own
+    generator, and writes only to `rows`, so chunks can be updated from different threads.
+    """
+    n = rows.stop - rows.start
+    covid_infections = arrays['covid_infections'][rows]
+    vaccination_count = arrays['vaccination_count'][rows]
+    last_vaccination_date = arrays['last_vaccination_date'][rows]
+    current_strain = arrays['current_strain'][rows]
+    last_infection_date = arrays['last_infection_date'][rows]
+
+    # reset_long_covid_status
+    current_strain[:] = np.nan
+
+    # update_infection_status
+    new_infections = rng.random(n) < population.infection_rate
+    covid_infections[new_infections] += 1
+    last_infection_date[new_infections] = week_start
+    for strain, proportion in strain_distribution.items():
+        assigned_strain = new_infections & (rng.random(n) < proportion)
+        current_strain[assigned_strain] = strain
+
+    # update_vaccination_status
+    days_since_last_vaccination = (week_start - last_vaccination_date) // np.timedelta64(1, 'D')
+    getting_vaccinated = (days_since_last_vaccination > population.vaccination_interval) & (rng.random(n) < population.vaccination_hazard_rate)
+    last_vaccination_date[getting_vaccinated] = week_start
+    vaccination_count[getting_vaccinated] += 1
+
+    # calculate_long_covid_risk
+    infection_counts = (covid_infections - 1).astype(int)
+    adjusted_risk = np.full(n, population.baseline_risk, dtype=float)
+    for i in range(1, infection_counts.max(initial=0) + 1):
+        is_ith_infection = infection_counts >= i
+        p2 = adjusted_risk * population.aor_value / (1 + adjusted_risk * (population.aor_value - 1))
+        adjusted_risk[is_ith_infection] = p2[is_ith_infection]
+    aor_adjustment = adjusted_risk / population.baseline_risk
+
+    time_since_vaccination = (week_start - last_vaccination_date) // np.timedelta64(1, 'D')
+    vaccinated = vaccination_count > 0
+    vaccination_decayrate = np.log(2) / population.vaccination_effectiveness_halflife
+    vaccination_adjustment = np.ones(n)
+    vaccination_adjustment[vaccinated] = 1 - np.exp(-vaccination_decayrate * time_since_vaccination[vaccinated]) * population.vaccination_reduction
+
+    strain_adjustment = (1 - population.strain_reduction_factor) ** (current_strain - 1)
+    risk = population.baseline_risk * aor_adjustment * vaccination_adjustment * strain_adjustment
+
+    arrays['aor_adjustment'][rows] = aor_adjustment
+    arrays['vaccination_adjustment'][rows] = vaccination_adjustment
+    arrays['strain_adjustment'][rows] = strain_adjustment
+    arrays['long_covid_risk'][rows] = risk
+    # Risk is missing (NaN) for individuals without a current strain, so they never qualify
+    arrays['has_long_covid'][rows] = (rng.random(n) < risk) & (last_infection_date == week_start)
+
+def _chunk_statistics(arrays, rows, week_start, total_strains):
+    """
+    Weighted sums over rows of the population, reduced across chunks by ChunkedSimulation.
+
+    Means are kept as (weighted sum, weight of non-missing values) pairs so missing values
+    are skipped as in Simulation._weighted_mean.
+    """
+    weight = arrays['weight'][rows]
+
+    def weighted_sum(values):
+        valid = ~np.isnan(values)
+        return np.array([np.dot(values[valid], weight[valid]), weight[valid].sum()])
+
+    vaccination_count = arrays['vaccination_count'][rows]
+    current_strain = arrays['current_strain'][rows]
+    has_strain = ~np.isnan(current_strain)
+    days_since_vaccination = ((week_start - arrays['last_vaccination_date'][rows]) // np.timedelta64(1, 'D')).astype(float)
+    return {
+        'new_long_covid_cases': weight[arrays['has_long_covid'][rows]].sum(),
+        'average_infections': weighted_sum(arrays['covid_infections'][rows]),
+        'infection_distribution_by_strain': np.bincount(
+            current_strain[has_strain].astype(int), weights=weight[has_strain], minlength=total_strains
+            ),
+        'average_days_since_last_vaccination': weighted_sum(days_since_vaccination),
+        'average_vaccinations': weighted_sum(vaccination_count.astype(float)),
+        'average_long_covid_risk': weighted_sum(arrays['long_covid_risk'][rows]),
+        'average_strain': weighted_sum(current_strain),
+        'average_aor_adjustment': weighted_sum(arrays['aor_adjustment'][rows]),
+        'average_vaccination_adjustment': weighted_sum(arrays['vaccination_adjustment'][rows]),
+        'average_strain_adjustment': weighted_sum(arrays['strain_adjustment'][rows]),
+        'vaccinations_0': weight[vaccination_count == 0].sum(),
+        'vaccinations_1_2': weight[(vaccination_count >= 1) & (vaccination_count <= 2)].sum(),
+        'vaccinations_3_4': weight[(vaccination_count >= 3) & (vaccination_count <= 4)].sum(),
+        'vaccinations_4_plus': weight[vaccination_count >= 4].sum()
+    }
+
+def _simulate_chunk(population, arrays, rows, rng, week_start, strain_distribution):
+    _update_chunk(population, arrays, rows, rng, week_start, strain_distribution)
+    return _chunk_statistics(arrays, rows, week_start, population.total_strains)
+
+
+class ChunkedSimulation(Simulation):
+    def __init__(self, population, n_threads=None, chunk_size=DEFAULT_CHUNK_SIZE, verbose=True):
+        """
+        Simulation that updates contiguous chunks of one population on a thread pool.
+
+        The population is held as one NumPy array per column and every week each chunk is
+        updated and summarised by a worker thread; NumPy releases the GIL for these array
+        operations, so a single large population uses several cores. Per-chunk weighted sums
+        are then reduced into the same weekly summary Simulation records.
+
+        Each chunk draws from its own generator, spawned from a seed sequence whose entropy
+        comes from the global NumPy RNG, so results are reproducible under np.random.seed
+        and do not depend on n_threads (they do depend on chunk_size). The draws differ from
+        those of Simulation, so the two modes agree in distribution rather than exactly.
+
+        Parameters:
+        population (Population): Population to simulate.
+        n_threads (int): Number of worker threads, by default the number of CPUs.
+        chunk_size (int): Number of agents per chunk.
+        verbose (bool): Print progress.
+        """
+        super().__init__(population, verbose=verbose)
+        self.n_threads = n_threads or os.cpu_count()
+        self.chunk_size = int(chunk_size)
+        self.chunks = [slice(start, min(start + self.chunk_size, self.size)) for start in range(0, self.size, self.chunk_size)]
+        seed_sequence = np.random.SeedSequence(np.random.randint(2**31, size=4))
+        self.rngs = [np.random.default_rng(child) for child in seed_sequence.spawn(len(self.chunks))]
+        self.arrays = self._to_arrays(population.data)
+        self.executor = None
+
+    def _to_arrays(self, data):
+        arrays = {}
+        for column, dtype in CHUNKED_POPULATION_COLUMNS.items():
+            if column not in data:
+                fill = {'f': np.nan, 'M': np.datetime64('NaT')}.get(np.dtype(dtype).kind, 0)
+                arrays[column] = np.full(len(data), fill, dtype=dtype)
+            elif np.dtype(dtype).kind == 'f':
+                # current_strain holds pd.NA for individuals without a current infection
+                arrays[column] = pd.to_numeric(data[column], errors='coerce').to_numpy(dtype=dtype, na_value=np.nan)
+            else:
+                arrays[column] = data[column].to_numpy(dtype=dtype, copy=True)
+        return arrays
+
+    def _sync_population(self):
+        """Copies the array state back into the population's DataFrame."""
+        self.population.data = pd.DataFrame({column: array.copy() for column, array in self.arrays.items()})
+        self.weekly_data = self.population.data
+
+    def simulate_week(self, week_data):
+        week_start = np.datetime64(week_data['week_start'], 'ns')
+        strain_distribution = self.population.get_strain_distribution(week_data)
+
+        partials = list(self.executor.map(
+            lambda chunk: _simulate_chunk(self.population, self.arrays, chunk[0], chunk[1], week_start, strain_distribution),
+            zip(self.chunks, self.rngs)
+            ))
+        self.record_weekly_statistics(week_data, partials)
+
+        # Take a snapshot of the population's data for this week
+        data = pd.DataFrame({column: array.copy() for column, array in self.arrays.items()})
+        data['week_start'] = week_data['week_start']
+        self.data.append(data)
+
+    def record_weekly_statistics(self, week_data, partials):
+        totals = {key: sum(partial[key] for partial in partials) for key in partials[0]}
+        summary = {'week': week_data['week_start']}
+        for key, total in totals.items():
+            if key == 'infection_distribution_by_strain':
+                summary[key] = {strain: weight for strain, weight in enumerate(total) if weight > 0}
+            elif key.startswith('average_'):
+                summary[key] = total[0] / total[1] if total[1] > 0 else np.nan
+            else:
+                summary[key] = total
+        self.weekly_summary.append(summary)
+
+        if self.verbose:
+            print(f"New long COVID cases: {summary['new_long_covid_cases']}")
+            print(f"Adjusted risk: {summary['average_long_covid_risk']}")
+
+    def _checkpoint_state(self, next_week):
+        self._sync_population()
+        state = super()._checkpoint_state(next_week)
+        state['chunk_rng_states'] = [rng.bit_generator.state for rng in self.rngs]
+        return state
+
+    def _restore_checkpoint_state(self, state):
+        super()._restore_checkpoint_state(state)
+        self.arrays = self._to_arrays(self.population.data)
+        for rng, rng_state in zip(self.rngs, state['chunk_rng_states']):
+            rng.bit_generator.state = rng_state
+
+    def run(self, duration, checkpoint_path=None, checkpoint_every=None):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            self.executor = executor
+            try:
+                super().run(duration, checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every)
+            finally:
+                self.executor = None
+        self._sync_population()
+
 class LongCovidSimulator:
     def __init__(
             self, 
@@ -277,50 +734,489 @@ class LongCovidSimulator:
             years=10, 
             n_simulations=300, 
             verbose=True,
-            save_path = None
+            save_path = None,
+            checkpoint_dir = None,
+            checkpoint_every = 52,
+            parameter_table = None,
+            seed = None,
+            output_dir = None,
+            n_threads = 1,
+            chunk_size = DEFAULT_CHUNK_SIZE,
+            start_date = None
             ):
-        self.params = params
+        self.params = params if params is not None else default_population_params
         self.weeks_in_year = 52
         self.years = years
         self.n_simulations = n_simulations
         self.verbose = verbose
         self.save_path = save_path
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.seed = seed
+        self.shared_results = None
+        self.output_dir = output_dir
+        self.writer = None
+        self.n_threads = n_threads
+        # With n_threads > 1, at most ceil(population size / chunk_size) threads have work
+        self.chunk_size = chunk_size
+        # Sharded runs need the same start date in every shard, so they require it explicitly
+        self.start_date_given = start_date is not None
+        self.start_date = pd.Timestamp(start_date if start_date is not None else datetime.now().date()).normalize()
+
+        if self.checkpoint_dir is not None:
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+            self._check_run_fingerprint()
 
-    def run_one_simulation(self, summary=False):
-        if self.params is not None:
-            population = Population(params=self.params, verbose=self.verbose)
+        self.parameter_table = self._prepare_parameter_table(parameter_table)
+
+    def run_fingerprint(self):
+        """
+        Hash of the settings that determine the simulations' results.
+
+        Distributions are described by their string form, e.g. 'norm(mean=0.15, sd=0.01)'.
+        """
+        settings = {
+            'params': self.params,
+            'years': self.years,
+            'seed': self.seed,
+            'n_simulations': self.n_simulations,
+            'start_date': str(self.start_date.date()),
+            'engine': 'chunked' if self.n_threads > 1 else 'serial',
+            'chunk_size': self.chunk_size if self.n_threads > 1 else None
+        }
+        return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+    def parameter_table_hash(self):
+        """Hash of the rows of the parameter table used by this run."""
+        rows = pd.util.hash_pandas_object(self.parameter_table.iloc[:self.n_simulations], index=True)
+        return hashlib.sha256(rows.to_numpy().tobytes()).hexdigest()
+
+    def _check_run_fingerprint(self):
+        """
+        Clears checkpoints left in checkpoint_dir by a run with different settings.
+
+        Without this, a rerun after changing params, years, seed, n_simulations or the start
+        date would resume the old simulations and return their results. Without an explicit
+        start_date, the start date recorded by the first run is reused, so a run resumed on
+        a later day continues its checkpoints rather than clearing them.
+        """
+        fingerprint_path = os.path.join(self.checkpoint_dir, 'run.json')
+        stored_run = {}
+        if os.path.exists(fingerprint_path):
+            with open(fingerprint_path) as f:
+                stored_run = json.load(f)
+        if not self.start_date_given and 'start_date' in stored_run:
+            self.start_date = pd.Timestamp(stored_run['start_date'])
+
+        fingerprint = self.run_fingerprint()
+        stored_fingerprint = stored_run.get('fingerprint')
+
+        if stored_fingerprint != fingerprint:
+            stale = [
+                path for pattern in ['simulation_*_state.pkl', 'simulation_*_state_weeks', 'simulation_*_result.pkl', 'parameter_table.pkl']
+                for path in glob.glob(os.path.join(self.checkpoint_dir, pattern))
+            ] + list(SimulationResultWriter.partition_paths(self._results_dir()).values())
+            if stale and self.verbose:
+                print(f"Checkpoints in {self.checkpoint_dir} are from a run with different settings, clearing them")
+            for path in stale:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            with open(fingerprint_path, 'w') as f:
+                json.dump({'fingerprint': fingerprint, 'start_date': str(self.start_date.date())}, f)
+
+    def _prepare_parameter_table(self, parameter_table):
+        """
+        Use the given per-simulation parameter table, or draw one from `params`.
+
+        A table stored in `checkpoint_dir` takes precedence over a fresh draw, so resumed
+        batches keep the parameters their completed simulations were run with.
+
+        Raises:
+        ValueError: If a given table differs from the one stored in `checkpoint_dir`, whose
+            completed simulations were run with the stored table.
+        """
+        table_path = os.path.join(self.checkpoint_dir, 'parameter_table.pkl') if self.checkpoint_dir is not None else None
+        stored_table = pd.read_pickle(table_path) if table_path is not None and os.path.exists(table_path) else None
+
+        if parameter_table is None and stored_table is not None:
+            parameter_table = stored_table
+        elif parameter_table is None:
+            if self.seed is not None:
+                sq.set_seed(self.seed)
+            parameter_table = Population.sample_param_table(self.params, self.n_simulations)
+
+        parameter_table = parameter_table.reset_index(drop=True)
+        parameter_table.index.name = 'simulation'
+        if len(parameter_table) < self.n_simulations:
+            raise ValueError("Parameter table has fewer rows than n_simulations.")
+        if stored_table is not None and not parameter_table.equals(stored_table):
+            raise ValueError(
+                f"Parameter table differs from the one stored in {self.checkpoint_dir}; "
+                "use a new checkpoint_dir to run simulations with a different table."
+                )
+
+        if table_path is not None:
+            parameter_table.to_pickle(table_path)
+
+        return parameter_table
+
+    def params_for_simulation(self, simulation_id):
+        """Parameters of one simulation, with its row of the parameter table in place of distributions."""
+        return {**self.params, **self.parameter_table.loc[simulation_id].to_dict()}
+
+    def save_parameter_table(self):
+        """Write the parameter table next to `save_path` and into `output_dir`."""
+        table_paths = []
+        if self.save_path is not None:
+            table_paths.append(f"{os.path.splitext(self.save_path)[0]}_parameters.csv")
+        if self.output_dir is not None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            table_paths.append(os.path.join(self.output_dir, 'parameters.csv'))
+        for table_path in table_paths:
+            self.parameter_table.iloc[:self.n_simulations].to_csv(table_path)
+
+    def _checkpoint_path(self, simulation_id, kind):
+        """Path of the in-progress ('state') checkpoint of one simulation."""
+        return os.path.join(self.checkpoint_dir, f"simulation_{simulation_id}_{kind}.pkl")
+
+    def _results_dir(self):
+        """Directory of the finished-result partitions: output_dir, else checkpoint_dir."""
+        return self.output_dir if self.output_dir is not None else self.checkpoint_dir
+
+    def _clear_simulation_state(self, simulation_id):
+        """Drops the in-progress checkpoint of a simulation once its result partition is written."""
+        state_path = self._checkpoint_path(simulation_id, 'state')
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        shutil.rmtree(_week_partition_dir(state_path), ignore_errors=True)
+
+    def run_one_simulation(self, summary=False, simulation_id=None, persist=True):
+        """
+        Runs one simulation.
+
+        With checkpoint_dir set, a simulation whose result partition already exists is read
+        back instead of rerun. Finished results are persisted through the background writer
+        when run_many_simulations has started one, else written here; with persist=False the
+        caller persists the result, as the parent of shared-memory workers does.
+        """
+        checkpointing = self.checkpoint_dir is not None and simulation_id is not None
+        if checkpointing:
+            result_path = SimulationResultWriter.partition_path(self._results_dir(), simulation_id)
+            if os.path.exists(result_path):
+                if self.verbose:
+                    print(f"Simulation {simulation_id} already completed, loading result")
+                return SimulationResultWriter.read_partition(result_path)
+
+        # Seed each simulation from its id, so it does not matter which process runs it
+        if self.seed is not None and simulation_id is not None:
+            np.random.seed([self.seed, simulation_id])
+
+        if simulation_id is not None:
+            population = Population(params=self.params_for_simulation(simulation_id), verbose=self.verbose, start_date=self.start_date)
+        else:
+            population = Population(params=self.params, verbose=self.verbose, start_date=self.start_date)
+        if self.n_threads > 1:
+            simulation = ChunkedSimulation(population, n_threads=self.n_threads, chunk_size=self.chunk_size, verbose=self.verbose)
         else:
-            population = Population(verbose=self.verbose)
-        simulation = Simulation(population, verbose=self.verbose)
-        simulation.run(self.weeks_in_year * self.years)
+            simulation = Simulation(population, verbose=self.verbose)
+        simulation.run(
+            self.weeks_in_year * self.years,
+            checkpoint_path=self._checkpoint_path(simulation_id, 'state') if checkpointing else None,
+            checkpoint_every=self.checkpoint_every
+            )
         df_weekly_summary = pd.DataFrame(simulation.weekly_summary)
         result = df_weekly_summary if summary else simulation.data
 
         # Save the result to a file
+        self._append_to_save_path(result)
+
+        # Record the finished simulation; its in-progress state is dropped once the result is on disk
+        if persist and simulation_id is not None:
+            clear_state = (lambda: self._clear_simulation_state(simulation_id)) if checkpointing else None
+            if self.writer is not None:
+                self.writer.put(simulation_id, result, on_written=clear_state)
+            elif checkpointing:
+                SimulationResultWriter.write_partition(self._results_dir(), simulation_id, result)
+                clear_state()
+
+        return result
+
+    def _append_to_save_path(self, result):
         if self.save_path is not None:
             with open(self.save_path, 'a') as f:
                 result.to_csv(f, index=False)
 
-        return result
+    def run_many_simulations(self, n_workers=1):
+        """
+        Runs all simulations and combines their output.
+
+        With n_workers > 1, simulations run in worker processes that write straight into
+        shared memory, see _run_many_simulations_shared.
+        """
+        if self._results_dir() is not None:
+            self.writer = SimulationResultWriter(self._results_dir())
+        try:
+            if n_workers > 1:
+                combined_dataframe = self._run_many_simulations_shared(n_workers)
+                self._close_writer()
+                return combined_dataframe
+
+            self.save_parameter_table()
+
+            results = {}
+            for simulation in range(self.n_simulations):
+                if simulation % 1 == 0:
+                    print(f"Running simulation {simulation}")
+                results[simulation] = self.run_one_simulation(simulation_id=simulation)
+            print("Done running simulations.")
+        except BaseException as error:
+            self._close_writer(error)
+            raise
+        self._close_writer()
+
+        combined_dataframe = self.combine_results(results)
+        print("Done combining DataFrames.")
+
+        return combined_dataframe
+
+    def _close_writer(self, error=None):
+        """
+        Writes the queued results and stops the writer.
 
-    def run_many_simulations(self):
-        results = []
+        A failed write is raised, unless `error` is already propagating; then it is only
+        printed, so it does not mask the error that stopped the simulations.
+        """
+        if self.writer is None:
+            return
+        writer, self.writer = self.writer, None
+        try:
+            writer.close()
+        except Exception as close_error:
+            if error is None:
+                raise
+            print(f"Writing simulation results also failed: {close_error!r} (caused by {close_error.__cause__!r})")
+
+    def _run_many_simulations_shared(self, n_workers):
+        """
+        Runs simulations in a process pool, returning results through shared memory.
+
+        The parent allocates one shared array per column of SIMULATION_OUTPUT_COLUMNS, large
+        enough for every simulation; each worker writes its rows in place, so nothing is
+        pickled back and the combined DataFrame is a view on the shared arrays rather than a
+        copy. The initial vaccination distribution is shared with workers the same way.
+
+        The returned DataFrame is only valid until release_shared_memory() is called.
+        """
+        self.save_parameter_table()
+
+        # Rows per simulation are agents per week; weighted-agent runs have n_agents rather than size agents
+        sizes = set()
         for simulation in range(self.n_simulations):
-            if simulation % 1 == 0:
-                print(f"Running simulation {simulation}")
-            results.append(self.run_one_simulation())
+            simulation_params = self.params_for_simulation(simulation)
+            sizes.add(int(simulation_params.get('n_agents') or simulation_params['size']))
+        if len(sizes) > 1:
+            raise ValueError("Shared-memory runs need the same population size in every simulation.")
+        rows_per_simulation = sizes.pop() * self.weeks_in_year * self.years
+
+        shared_inputs = SharedArrays()
+        distribution = self.params['initial_vaccination_distribution']
+        shared_inputs.share('vaccination_values', np.array(list(distribution.keys())))
+        shared_inputs.share('vaccination_probabilities', np.array(list(distribution.values()), dtype=float))
+
+        self.release_shared_memory()
+        self.shared_results = SharedArrays()
+        for column, dtype in SIMULATION_OUTPUT_COLUMNS.items():
+            self.shared_results.create(column, (rows_per_simulation * self.n_simulations,), dtype)
+
+        # Simulations with a result partition are read back by the workers and need no rewrite
+        restored = {
+            simulation for simulation in range(self.n_simulations)
+            if self.checkpoint_dir is not None
+            and os.path.exists(SimulationResultWriter.partition_path(self._results_dir(), simulation))
+        }
+
+        try:
+            # Spawned, not forked: this process may be running the writer and other threads
+            mp_context = multiprocessing.get_context('spawn')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context) as executor:
+                futures = [
+                    executor.submit(
+                        _run_simulation_into_shared_memory, self, simulation, simulation * rows_per_simulation,
+                        self.shared_results.handle, shared_inputs.handle
+                        )
+                    for simulation in range(self.n_simulations)
+                ]
+                for future in concurrent.futures.as_completed(futures):
+                    simulation = future.result()
+                    print(f"Finished simulation {simulation}")
+                    if simulation not in restored and (self.save_path is not None or self.writer is not None):
+                        rows = slice(simulation * rows_per_simulation, (simulation + 1) * rows_per_simulation)
+                        result = pd.DataFrame(
+                            {column: array[rows] for column, array in self.shared_results.arrays.items() if column != 'simulation'}
+                            )
+                        self._append_to_save_path(result)
+                        if self.writer is not None:
+                            clear_state = (lambda simulation=simulation: self._clear_simulation_state(simulation)) if self.checkpoint_dir is not None else None
+                            self.writer.put(simulation, result, on_written=clear_state)
+        finally:
+            shared_inputs.close()
         print("Done running simulations.")
 
+        return pd.DataFrame(self.shared_results.arrays, copy=False)
+
+    def release_shared_memory(self):
+        """Frees the shared output of the last shared-memory run; drop any views on it first."""
+        if self.shared_results is not None:
+            self.shared_results.close()
+            self.shared_results = None
+
+    def __getstate__(self):
+        # Workers receive a copy of the simulator; the parent's shared blocks stay with the parent
+        state = self.__dict__.copy()
+        state['shared_results'] = None
+        state['writer'] = None
+        return state
+
+    @staticmethod
+    def combine_results(results):
+        """
+        Concatenates per-simulation results in simulation order, adding a 'simulation' column.
+
+        Parameters:
+        results (dict): Mapping of simulation id to its result DataFrame.
+
+        Returns:
+        pd.DataFrame: Combined results.
+        """
         # Initialize an empty list to store the modified DataFrames
         modified_dataframes = []
 
         # Iterate over the results, adding a 'simulation' column
-        for i, df in enumerate(results):
+        for i in sorted(results):
+            df = results[i]
             df['simulation'] = i  # Add a simulation identifier column
             modified_dataframes.append(df)
 
         # Concatenate all DataFrames into one, while keeping the simulation identifier
-        combined_dataframe = pd.concat(modified_dataframes)
-        print("Done combining DataFrames.")
+        return pd.concat(modified_dataframes)
+
+    @staticmethod
+    def shard_simulation_ids(shard_index, n_shards, n_simulations):
+        """Simulation ids run by one shard: every n_shards-th id, starting at shard_index."""
+        return list(range(shard_index, n_simulations, n_shards))
+
+    @staticmethod
+    def shard_paths(shard_dir):
+        """Complete shard directories in `shard_dir`, i.e. those with their shard.json written."""
+        return sorted(
+            path for path in glob.glob(os.path.join(shard_dir, 'shard_*_of_*'))
+            if os.path.exists(os.path.join(path, 'shard.json'))
+        )
+
+    @staticmethod
+    def read_shard_metadata(shard_path):
+        """Run settings and simulation ids of one shard, as written by run_shard."""
+        with open(os.path.join(shard_path, 'shard.json')) as f:
+            return json.load(f)
+
+    def run_shard(self, shard_index, n_shards, shard_dir):
+        """
+        Runs one shard of the simulations and writes it to `shard_dir`.
+
+        Shards are disjoint and every simulation is seeded from `seed` and its id and starts
+        on `start_date`, so merging all shards with merge_shards gives the same result as
+        run_many_simulations. A shard is a directory with one SimulationResultWriter
+        partition per simulation and a shard.json of its run settings, so readers can load
+        one simulation at a time.
+
+        Returns:
+        str: Path of the written shard directory.
+        """
+        if self.seed is None:
+            raise ValueError("Sharded runs need a seed so every shard draws the same parameters.")
+        if not self.start_date_given:
+            raise ValueError("Sharded runs need a start_date so every shard simulates the same weeks.")
+        if not 0 <= shard_index < n_shards:
+            raise ValueError(f"Shard index {shard_index} is outside 0..{n_shards - 1}.")
+
+        os.makedirs(shard_dir, exist_ok=True)
+        if shard_index == 0:
+            self.parameter_table.iloc[:self.n_simulations].to_csv(os.path.join(shard_dir, 'parameters.csv'))
+
+        shard_path = os.path.join(shard_dir, f"shard_{shard_index}_of_{n_shards}")
+        tmp_path = f"{shard_path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        simulations = self.shard_simulation_ids(shard_index, n_shards, self.n_simulations)
+        for simulation in simulations:
+            print(f"Running simulation {simulation} (shard {shard_index}/{n_shards})")
+            result = self.run_one_simulation(simulation_id=simulation)
+            SimulationResultWriter.write_partition(tmp_path, simulation, result)
+            del result
+
+        with open(os.path.join(tmp_path, 'shard.json'), 'w') as f:
+            json.dump({
+                'shard_index': shard_index,
+                'n_shards': n_shards,
+                'n_simulations': self.n_simulations,
+                'seed': self.seed,
+                'years': self.years,
+                'start_date': str(self.start_date.date()),
+                'run_fingerprint': self.run_fingerprint(),
+                'parameter_table_hash': self.parameter_table_hash(),
+                'simulations': simulations
+            }, f, default=str)
 
-        return combined_dataframe
\ No newline at end of file
+        shutil.rmtree(shard_path, ignore_errors=True)
+        os.replace(tmp_path, shard_path)
+        return shard_path
+
+    @classmethod
+    def merge_shards(cls, shard_dir):
+        """
+        Checks that all shards in `shard_dir` are present and consistent, then combines them.
+
+        Raises:
+        ValueError: If shards are missing, duplicated, or come from different runs.
+
+        Returns:
+        pd.DataFrame: Combined results, as run_many_simulations would return them.
+        """
+        shard_paths = cls.shard_paths(shard_dir)
+        if not shard_paths:
+            raise ValueError(f"No shards found in {shard_dir}.")
+
+        shards = [cls.read_shard_metadata(path) for path in shard_paths]
+
+        run_keys = ['n_shards', 'n_simulations', 'seed', 'years', 'start_date', 'run_fingerprint', 'parameter_table_hash']
+        runs = {tuple(shard.get(key) for key in run_keys) for shard in shards}
+        if len(runs) > 1:
+            raise ValueError(f"Shards come from different runs ({', '.join(run_keys)}): {sorted(runs, key=str)}.")
+        n_shards, n_simulations = runs.pop()[:2]
+
+        shard_indices = [shard['shard_index'] for shard in shards]
+        missing_shards = sorted(set(range(n_shards)) - set(shard_indices))
+        if missing_shards:
+            raise ValueError(f"Missing shards: {missing_shards}.")
+
+        partition_paths = {}
+        duplicated_simulations = []
+        for shard_path in shard_paths:
+            for simulation, path in SimulationResultWriter.partition_paths(shard_path).items():
+                if simulation in partition_paths:
+                    duplicated_simulations.append(simulation)
+                partition_paths[simulation] = path
+        if duplicated_simulations:
+            raise ValueError(f"Simulations present in more than one shard: {sorted(set(duplicated_simulations))}.")
+
+        missing_simulations = sorted(set(range(n_simulations)) - set(partition_paths))
+        if missing_simulations:
+            raise ValueError(f"Missing simulations: {missing_simulations}.")
+
+        return cls.combine_results({
+            simulation: SimulationResultWriter.read_partition(path)
+            for simulation, path in sorted(partition_paths.items())
+        })
@@ -0,0 +1,184 @@
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from utils.simulate_long_covid_cases import LongCovidSimulator
+from utils.merge_data_with_simulations import DataSimulationsMerger
+
+def make_simulator_engine(params=None, years=1, simulator_class=LongCovidSimulator, **simulator_kwargs):
+    """
+    Wraps a simulator class as an engine: a callable from seed to one simulation's output.
+
+    Parameters:
+    params (dict): Simulation parameters, see utils/parameters.py.
+    years (int): Number of simulated years.
+    simulator_class (type): LongCovidSimulator or a drop-in replacement.
+
+    Returns:
+    callable: Engine returning the simulation output DataFrame for a seed.
+    """
+    def engine(seed):
+        simulator = simulator_class(
+            params=params, years=years, n_simulations=1, verbose=False, seed=seed, **simulator_kwargs
+            )
+        return simulator.run_one_simulation(simulation_id=0)
+    return engine
+
+def check_shard_merge(n_shards=2, shard_dir=None, params=None, years=1, n_simulations=4, seed=0, start_date='2024-01-01'):
+    """
+    Checks that merging the shards of a run gives exactly the result of the unsharded run.
+
+    Runs the simulations once with run_many_simulations and once as `n_shards` shards
+    combined with merge_shards, and compares the two frames, including index and dtypes.
+
+    Parameters:
+    n_shards (int): Number of shards.
+    shard_dir (str): Empty directory for the shards; a temporary directory if None.
+
+    Raises:
+    AssertionError: If the merged shards differ from the unsharded run.
+
+    Returns:
+    pd.DataFrame: The merged shards.
+    """
+    simulator_kwargs = dict(params=params, years=years, n_simulations=n_simulations, verbose=False, seed=seed, start_date=start_date)
+    unsharded = LongCovidSimulator(**simulator_kwargs).run_many_simulations()
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        shard_dir = shard_dir if shard_dir is not None else temporary_dir
+        for shard_index in range(n_shards):
+            LongCovidSimulator(**simulator_kwargs).run_shard(shard_index, n_shards, shard_dir)
+        merged = LongCovidSimulator.merge_shards(shard_dir)
+
+    pd.testing.assert_frame_equal(merged, unsharded)
+    return merged
+
+
+class EngineEquivalenceTester:
+    def __init__(
+            self, 
+            reference_engine, 
+            candidate_engine, 
+            seeds=range(30), 
+            alpha=0.05,
+            df_symptom_integrals=None, 
+            data_daly=None
+            ):
+        """
+        Checks that a candidate simulation engine simulates the same model as a reference.
+
+        Random streams differ between engines, so instead of matching outputs exactly, each
+        engine is run over many seeds and the distributions of per-run outcomes are compared
+        with two-sample Kolmogorov-Smirnov tests. Holm's correction keeps the chance of any
+        false alarm across all metrics at `alpha`.
+
+        Parameters:
+        reference_engine (callable): Maps a seed to simulation output, see make_simulator_engine.
+        candidate_engine (callable): Same, for the engine under test.
+        seeds (iterable): Seeds to run each engine with.
+        alpha (float): Family-wise false alarm rate.
+        df_symptom_integrals (pd.DataFrame): Posterior symptom integrals; with data_daly, enables the DALY loss metric.
+        data_daly (pd.DataFrame): Processed DALY data.
+        """
+        self.reference_engine = reference_engine
+        self.candidate_engine = candidate_engine
+        self.seeds = list(seeds)
+        self.alpha = alpha
+        self.df_symptom_integrals = df_symptom_integrals
+        self.data_daly = data_daly
+
+    def calculate_metrics(self, df_simulation, seed):
+        """
+        Summarises one run into one value per metric.
+
+        Returns:
+        dict: Weekly means of infections, vaccinations, long COVID cases, risk and, if
+        enabled, DALY loss.
+        """
+        week_start = df_simulation['week_start']
+        weight = df_simulation['weight'] if 'weight' in df_simulation else pd.Series(1.0, index=df_simulation.index)
+
+        def weekly_total(mask):
+            return (mask * weight).groupby(week_start).sum().mean()
+
+        weighted_risk = (df_simulation['long_covid_risk'] * weight).groupby(week_start).sum() / weight.groupby(week_start).sum()
+        metrics = {
+            'weekly_infections': weekly_total(df_simulation['last_infection_date'] == week_start),
+            'weekly_vaccinations': weekly_total(df_simulation['last_vaccination_date'] == week_start),
+            'weekly_long_covid_cases': weekly_total(df_simulation['has_long_covid']),
+            'mean_long_covid_risk': weighted_risk.mean()
+        }
+        if self.df_symptom_integrals is not None and self.data_daly is not None:
+            merger = DataSimulationsMerger(df_simulation, self.df_symptom_integrals, self.data_daly)
+            n_weeks = week_start.nunique()
+            metrics['weekly_daly_loss'] = merger.calculate_welfare_loss(seed=seed)['DALY_loss'].sum() / n_weeks
+        return metrics
+
+    def _run_engine(self, engine):
+        """
+        Runs an engine over all seeds.
+
+        Returns:
+        Tuple[pd.DataFrame, np.ndarray]: Metrics per seed and run times in seconds.
+        """
+        rows, timings = [], []
+        for seed in self.seeds:
+            start = time.perf_counter()
+            df_simulation = engine(seed)
+            timings.append(time.perf_counter() - start)
+            rows.append(self.calculate_metrics(df_simulation, seed))
+        return pd.DataFrame(rows, index=pd.Index(self.seeds, name='seed')), np.array(timings)
+
+    def run(self):
+        """
+        Runs both engines and tests every metric.
+
+        Returns:
+        dict: 'report' (one row per metric with test statistic, p-value, Holm threshold and
+        pass/fail), 'passed' (whether all metrics passed) and 'timing' (run time summary,
+        including the candidate-to-reference ratio of median run times).
+        """
+        reference_metrics, reference_timings = self._run_engine(self.reference_engine)
+        candidate_metrics, candidate_timings = self._run_engine(self.candidate_engine)
+
+        rows = []
+        for metric in reference_metrics.columns:
+            statistic, p_value = stats.ks_2samp(reference_metrics[metric], candidate_metrics[metric])
+            rows.append({
+                'metric': metric,
+                'reference_mean': reference_metrics[metric].mean(),
+                'candidate_mean': candidate_metrics[metric].mean(),
+                'ks_statistic': statistic,
+                'p_value': p_value
+            })
+        report = pd.DataFrame(rows)
+
+        # Holm step-down: compare the k-th smallest p-value to alpha / (m - k), stop at the first failure
+        order = report['p_value'].sort_values().index
+        thresholds = pd.Series(self.alpha / (len(report) - np.arange(len(report))), index=order)
+        rejected = (report.loc[order, 'p_value'] <= thresholds).astype(int).cummin().astype(bool)
+        report['holm_threshold'] = thresholds
+        report['passed'] = ~rejected
+
+        timing = {
+            'reference_median_seconds': float(np.median(reference_timings)),
+            'candidate_median_seconds': float(np.median(candidate_timings)),
+            'speedup': float(np.median(reference_timings) / np.median(candidate_timings))
+        }
+
+        return {'report': report, 'passed': bool(report['passed'].all()), 'timing': timing}
+
+    @staticmethod
+    def format_report(result):
+        """Formats the output of run() as a plain-text pass/fail report."""
+        lines = [
+            f"Engine equivalence: {'PASS' if result['passed'] else 'FAIL'}",
+            result['report'].to_string(index=False),
+            f"Median run time: reference {result['timing']['reference_median_seconds']:.2f}s, "
+            f"candidate {result['timing']['candidate_median_seconds']:.2f}s "
+            f"(speed-up {result['timing']['speedup']:.2f}x)"
+        ]
+        return '\n'.join(lines)